@@ -1,9 +1,65 @@
 import database as db
+import sketches
+import analyse_stats
+import pstat_store
+import pstats
+import json_ui
+import call_graph_cache
 import sqlalchemy
 from sqlalchemy import func, and_, or_
 import cherrypy
+import hashlib
+import re
+import time
+from functools import wraps
 from cgi import escape as html_escape
-from operator import itemgetter
+from lru_cache import LRUCache
+
+# AggregateAPI results, keyed by method and arguments
+result_cache = LRUCache(1000)
+# filtered counts and known page boundaries of the aggregate tables, keyed by filters (and sort)
+# and reused until stats of the table's type are ingested
+count_cache = LRUCache(1000)
+page_boundary_cache = LRUCache(1000)
+# the function totals of each side of a profile diff, keyed by the profiles on that side
+diff_cache = LRUCache(100)
+# the gzipped folded stacks of merged profiles, keyed by the profiles and flame graph options
+flame_graph_cache = LRUCache(100)
+# the most recent profiles merged on each side of a diff, and functions listed
+diff_max_profiles = 1000
+diff_limit = 200
+# sides filtered by hour aligned dates alone read the hourly merged profiles
+use_merged_profiles = True
+# the most points an item's timing series is sent as
+series_points = 1000
+# the most values a facet lists
+facet_limit = 1000
+# the most N+1 suspects listed
+repeated_query_limit = 100
+# how the SQL statements table is searched, substring or fulltext
+sql_search_mode = 'substring'
+# tables estimated to hold more rows than this are counted from the planner's estimate
+exact_count_limit = 100000
+# names whose sketches are merged to sort by a percentile, see json_aggregate
+percentile_sort_limit = 5000
+
+def setup(cfg):
+    global exact_count_limit, sql_search_mode, series_points, facet_limit, percentile_sort_limit
+    global diff_max_profiles, diff_limit, use_merged_profiles, repeated_query_limit
+    diff_cache.resize(int(cfg.get('diff_cache_size', 100)))
+    flame_graph_cache.resize(int(cfg.get('flame_graph_cache_size', 100)))
+    diff_max_profiles = int(cfg.get('diff_max_profiles', 1000))
+    diff_limit = int(cfg.get('diff_limit', 200))
+    use_merged_profiles = cfg.get('merge_profiles', 'true').lower() == 'true'
+    facet_limit = int(cfg.get('facet_limit', 1000))
+    repeated_query_limit = int(cfg.get('repeated_query_limit', 100))
+    series_points = int(cfg.get('item_series_points', 1000))
+    sql_search_mode = cfg.get('sql_search_mode', 'substring')
+    result_cache.resize(int(cfg.get('aggregate_cache_size', 1000)))
+    count_cache.resize(int(cfg.get('aggregate_cache_size', 1000)))
+    page_boundary_cache.resize(int(cfg.get('aggregate_cache_size', 1000)))
+    exact_count_limit = int(cfg.get('exact_count_limit', 100000))
+    percentile_sort_limit = int(cfg.get('percentile_sort_limit', 5000))
 
 def parse_kwargs(kwargs):
 
@@ -23,9 +79,13 @@ def parse_kwargs(kwargs):
 
     # move filters to another dict
     filter_kwargs = kwargs
-    for key in ('start_date', 'end_date', 'start', 'limit'):
+    for key in ('start', 'limit'):
         if key in filter_kwargs:
             filter_kwargs[key] = int(filter_kwargs[key])
+    # fractional seconds let the timing graph zoom into windows shorter than a second
+    for key in ('start_date', 'end_date', 'resolution'):
+        if key in filter_kwargs:
+            filter_kwargs[key] = float(filter_kwargs[key])
 
     if 'sort' in filter_kwargs:
         if type(filter_kwargs['sort']) in (unicode, str):
@@ -41,13 +101,16 @@ column_name_dict = {db.CallStack: 'full_name',
                     db.SQLStatement: 'sql_string',
                     db.FileAccess: 'filename'}
 
+percentiles = (50, 90, 95, 99)
+percentile_columns = tuple('p{0}'.format(percentile) for percentile in percentiles)
+
 # Decorator for dealing with server-side datatables kwargs
 def datatables(query_func):
     def dt_wrapped(table_class, filter_kwargs, table_kwargs):
         if table_kwargs:
             # parse datatables kwargs
             sort = []
-            cols = (None, column_name_dict[table_class], 'count', 'total', 'avg', 'min', 'max')
+            cols = (None, column_name_dict[table_class], 'count', 'total', 'avg', 'min', 'max') + percentile_columns
             for i in xrange(int(table_kwargs['iSortingCols'])):
                 sort_col = cols[int(table_kwargs['iSortCol_' + str(i)])]
                 sort_dir = 'DESC' if table_kwargs['sSortDir_' + str(i)] == 'desc' else 'ASC'
@@ -61,7 +124,9 @@ def datatables(query_func):
                                                                 search = table_kwargs['sSearch'],
                                                                 sort = sort,
                                                                 start = int(table_kwargs['iDisplayStart']),
-                                                                limit = int(table_kwargs['iDisplayLength'])
+                                                                # -1 shows every row
+                                                                limit = max(int(table_kwargs['iDisplayLength']), 0) or None,
+                                                                count = True
                                                             )
             return {
                     'aaData':data,
@@ -82,13 +147,29 @@ def datatables(query_func):
 
     return dt_wrapped
 
-def filter_query(query, filter_kwargs, table_class):
+def metadata_set_ids(metadata_filters):
+    '''Ids of the metadata sets containing every one of a list of (key, value) pairs.'''
+    metadata_ids = []
+    for key, value in metadata_filters:
+        metadata = db.session.query(db.MetaData.id).filter(db.MetaData.key == key, db.MetaData.value == value).first()
+        if metadata is None:
+            return []
+        metadata_ids.append(metadata[0])
+    return [row[0] for row in db.session.query(db.MetadataSet.id).filter(db.MetadataSet.metadata_ids.contains(metadata_ids))]
+
+def filter_query(query, filter_kwargs, table_class, metadata_set_column=None):
+    '''
+    Filters by the key/value pairs picked in the side bar. General metadata filters are
+    resolved to the matching metadata sets first, then applied as a single IN on the
+    metadata_set_column (by default the table_class' own).
+    '''
     call_stack_metadata_dict = {
             'module': db.CallStackName.module_name,
             'class':  db.CallStackName.class_name,
             'method': db.CallStackName.fn_name
         }
 
+    metadata_filters = []
     for k in filter_kwargs:
         if 'key_' in k:
             v = k.replace('key', 'value')
@@ -99,7 +180,13 @@ def filter_query(query, filter_kwargs, table_class):
                 call_stack_attr = call_stack_metadata_dict[filter_kwargs[k]]
                 query = query.filter(call_stack_attr == filter_kwargs[v])
             else: # General metadata filter args
-                query = query.filter(table_class.metadata_items.any(and_(db.MetaData.key == filter_kwargs[k], db.MetaData.value == filter_kwargs[v])))
+                metadata_filters.append((filter_kwargs[k], filter_kwargs[v]))
+
+    if metadata_filters:
+        if metadata_set_column is None:
+            metadata_set_column = table_class.metadata_set_id
+        # no matching sets matches nothing
+        query = query.filter(metadata_set_column.in_(metadata_set_ids(metadata_filters) or [-1]))
     return query
 
 metadata_table_dict = {
@@ -118,62 +205,305 @@ searchable_columns_dict = {
         db.FileAccess: [db.FileName.filename]
     }
 
-# Get JSON aggregate data for main aggregate pages
-@datatables
-def json_aggregate(table_class, filter_kwargs=None, search=None, sort=[('avg','DESC')], start=None, limit=None):
-    # Get specific table info (call stack/sql statement/file access)
-    column_name = column_name_dict[table_class]
+rollup_stat_types = {db.CallStack: 'callstacks',
+                     db.SQLStatement: 'sqlstatements',
+                     db.FileAccess: 'fileaccesses'}
+stat_type_classes = dict((stat_type, table_class) for table_class, stat_type in rollup_stat_types.items())
+
+def rollup_resolution(filter_kwargs):
+    '''
+    The coarsest rollup resolution whose buckets line up with the start and end dates,
+    or None if neither does and the raw rows must be aggregated instead.
+    '''
+    for resolution in reversed(db.rollup_resolutions):
+        if all(filter_kwargs.get(date_key) is None or filter_kwargs[date_key] % resolution == 0
+               for date_key in ('start_date', 'end_date')):
+            return resolution
+    return None
+
+def filtered_stat_query(table_class, filter_kwargs, resolution, *columns):
+    '''
+    A query of columns over the StatRollups of the given resolution, or over the raw rows
+    if resolution is None, filtered by the side bar and date filters.
+    '''
     metadata_table = metadata_table_dict[table_class][0]
-    metadata_value = metadata_table_dict[table_class][1]
     table_class_column = metadata_table_dict[table_class][2]
+    start_date = filter_kwargs.get('start_date', None)
+    end_date = filter_kwargs.get('end_date', None)
 
-    total_num_items = db.session.query(metadata_table).count()
-    
-    # Get aggregate data for datatable/d3 bar graph
-    query = db.session.query(
-            metadata_table.id,
-            metadata_value.label(column_name),
-            func.count(table_class.id).label('count'),
-            sqlalchemy.cast(func.sum(table_class.duration), sqlalchemy.Numeric(10, 5)).label('total'),
-            sqlalchemy.cast(func.avg(table_class.duration), sqlalchemy.Numeric(10, 5)).label('avg'),
-            sqlalchemy.cast(func.min(table_class.duration), sqlalchemy.Numeric(10, 5)).label('min'),
-            sqlalchemy.cast(func.max(table_class.duration), sqlalchemy.Numeric(10, 5)).label('max')
-        )
-    # Only get information for current tab (e.g. Call Stacks)
-    query = query.join(table_class_column)
-    
-    # Filter data based on the key/value pairs picked in the side bar
-    query = filter_query(query, filter_kwargs, table_class)
-    query = query.group_by(metadata_table.id)
+    query = db.session.query(*columns)
+    if resolution:
+        # from the names, columns may be only the rollup's (e.g. the facet counts)
+        query = query.select_from(metadata_table).join(db.StatRollup, and_(db.StatRollup.name_id == metadata_table.id,
+                                               db.StatRollup.stat_type == rollup_stat_types[table_class],
+                                               db.StatRollup.resolution == resolution))
+        query = filter_query(query, filter_kwargs, table_class, db.StatRollup.metadata_set_id)
+        if start_date:
+            query = query.filter(db.StatRollup.bucket >= start_date)
+        if end_date:
+            query = query.filter(db.StatRollup.bucket < end_date)
+    else:
+        # Only get information for current tab (e.g. Call Stacks)
+        query = query.join(table_class_column)
+        # Filter data based on the key/value pairs picked in the side bar
+        query = filter_query(query, filter_kwargs, table_class)
+        if start_date:
+            query = query.filter(table_class.datetime > start_date)
+        if end_date:
+            query = query.filter(table_class.datetime < end_date)
+    return query
+
+def escape_like(term):
+    '''Escapes LIKE's wildcards so a search term only matches itself.'''
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def full_text_query(search):
+    '''A tsquery matching SQL containing every token of the search, the last token as a prefix.'''
+    tokens = re.findall(r'\w+', search.lower())
+    if not tokens:
+        return None
+    return ' & '.join(tokens[:-1] + [tokens[-1] + ':*'])
 
+def search_query(query, table_class, search, search_mode=None):
+    '''
+    Filters by a datatables search. By default a case insensitive substring search over
+    the searchable columns (served by trigram indexes), SQL can also be searched by
+    whole tokens with search_mode = fulltext.
+    '''
     if search:
+        if table_class == db.SQLStatement and (search_mode or sql_search_mode) == 'fulltext':
+            tsquery = full_text_query(search)
+            if tsquery:
+                # the same expression as the full text index, database.sql_search_vector
+                search_vector = func.to_tsvector('simple', func.regexp_replace(db.SQLString.sql, '[^[:alnum:]_]+', ' ', 'g'))
+                query = query.filter(search_vector.op('@@')(func.to_tsquery('simple', tsquery)))
+            return query
         search_clauses = []
         for column in searchable_columns_dict[table_class]:
-            search_clauses.append(column.ilike('%{0}%'.format(search)))
+            search_clauses.append(column.ilike(u'%{0}%'.format(escape_like(search)), escape='\\'))
         query = query.filter(or_(*search_clauses))
+    return query
 
-    for sorter in sort:
-        query = query.order_by('{0} {1}'.format(*sorter))
+def aggregate_query(table_class, filter_kwargs):
+    '''
+    The grouped count/total/avg/min/max query for a stat type, read from the StatRollups
+    when the date filters line up with a rollup resolution, otherwise from the raw rows.
+    '''
+    column_name = column_name_dict[table_class]
+    metadata_table = metadata_table_dict[table_class][0]
+    metadata_value = metadata_table_dict[table_class][1]
+    resolution = rollup_resolution(filter_kwargs)
+
+    if resolution:
+        columns = [sqlalchemy.cast(func.sum(db.StatRollup.count), sqlalchemy.Integer).label('count'),
+                   sqlalchemy.cast(func.sum(db.StatRollup.total), sqlalchemy.Numeric(10, 5)).label('total'),
+                   sqlalchemy.cast(func.sum(db.StatRollup.total) / func.sum(db.StatRollup.count), sqlalchemy.Numeric(10, 5)).label('avg'),
+                   sqlalchemy.cast(func.min(db.StatRollup.min), sqlalchemy.Numeric(10, 5)).label('min'),
+                   sqlalchemy.cast(func.max(db.StatRollup.max), sqlalchemy.Numeric(10, 5)).label('max')]
+    else:
+        columns = [func.count(table_class.id).label('count'),
+                   sqlalchemy.cast(func.sum(table_class.duration), sqlalchemy.Numeric(10, 5)).label('total'),
+                   sqlalchemy.cast(func.avg(table_class.duration), sqlalchemy.Numeric(10, 5)).label('avg'),
+                   sqlalchemy.cast(func.min(table_class.duration), sqlalchemy.Numeric(10, 5)).label('min'),
+                   sqlalchemy.cast(func.max(table_class.duration), sqlalchemy.Numeric(10, 5)).label('max')]
+
+    query = filtered_stat_query(table_class, filter_kwargs, resolution,
+                                metadata_table.id, metadata_value.label(column_name), *columns)
+    return query.group_by(metadata_table.id)
+
+def aggregate_sketches(table_class, filter_kwargs, search=None, ids=None):
+    '''
+    Returns a dictionary of name id -> sketches.LogHistogram of the filtered durations,
+    merged from the rollups' sketches or, when the dates do not line up with a rollup
+    resolution, histogrammed in SQL from the raw rows.
+    '''
+    metadata_table = metadata_table_dict[table_class][0]
+    resolution = rollup_resolution(filter_kwargs)
+    name_sketches = {}
+
+    if resolution:
+        query = filtered_stat_query(table_class, filter_kwargs, resolution, metadata_table.id, db.StatRollup.sketch)
+    else:
+        bucket_index = sqlalchemy.cast(func.ceil(func.ln(func.greatest(table_class.duration, sketches.MIN_VALUE)) /
+                                                 sketches.LOG_GAMMA), sqlalchemy.Integer)
+        query = filtered_stat_query(table_class, filter_kwargs, None,
+                                    metadata_table.id, bucket_index, func.count(table_class.id))
+        query = query.filter(table_class.duration != None).group_by(metadata_table.id, bucket_index)
+    query = search_query(query, table_class, search, filter_kwargs.get('search_mode'))
+    if ids is not None:
+        if not ids:
+            return name_sketches
+        query = query.filter(metadata_table.id.in_(ids))
+
+    for row in query:
+        sketch = name_sketches.setdefault(row[0], sketches.LogHistogram())
+        if resolution:
+            sketch.merge(sketches.LogHistogram.from_bytes(row[1]))
+        else:
+            sketch.add_bucket(row[1], row[2])
+    return name_sketches
+
+def sketch_percentiles(sketch):
+    if sketch is None:
+        return [None] * len(percentiles)
+    return [None if value is None else round(value, 5) for value in sketch.percentiles(percentiles)]
+
+def sort_results(results, sort, cols):
+    '''Sorts result lists in Python, by (column name, direction) pairs as ORDER BY would.'''
+    # sorted is stable, so sort by the least significant column first
+    for sort_col, sort_dir in reversed(sort):
+        if sort_col not in cols:
+            continue
+        index = cols.index(sort_col)
+        descending = sort_dir.upper() == 'DESC'
+        # missing values last either way
+        results = sorted(results, key=lambda result: (result[index] is not None if descending else result[index] is None,
+                                                      result[index]),
+                         reverse=descending)
+    return results
+
+# Get JSON aggregate data for main aggregate pages
+def estimated_count(table):
+    '''
+    Number of rows in a table, taken from the planner's statistics once they put it
+    over exact_count_limit rather than counting every row.
+    '''
+    estimate = db.session.execute(sqlalchemy.text('SELECT reltuples::bigint FROM pg_class WHERE relname = :table'),
+                                  {'table': table.__tablename__}).scalar()
+    if estimate is not None and estimate > exact_count_limit:
+        return int(estimate)
+    return db.session.query(table).count()
+
+def cached_value(cache, key, generation):
+    '''A value from a cache of (generation, value) pairs, if it was cached at this generation.'''
+    cached = cache.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    return None
+
+def filtered_count(query, key, generation):
+    '''Number of rows of a grouped aggregate query, counted once per filter set and generation and cached.'''
+    count = cached_value(count_cache, key, generation)
+    if count is None:
+        count = query.order_by(None).count()
+        count_cache.set(key, (generation, count))
+    return count
+
+def page_query(query, key, generation, sort, start, limit, count):
+    '''
+    Sorts and pages a grouped aggregate query. Rather than an OFFSET scanning and
+    discarding every earlier row, a page which follows one already served seeks past
+    the last row of that page by its sort value (and id, which breaks ties) in the
+    HAVING clause. The boundary of every page served is cached for the next request,
+    until the generation of the table's stats moves on and the boundaries may have too.
+    Pages without a known boundary near the end of the results are read backwards.
+
+    Returns the page's rows as lists.
+    '''
+    start = start or 0
+    names = [description['name'] for description in query.column_descriptions]
+    columns = dict((description['name'], description['expr']) for description in query.column_descriptions)
+    id_column = query.column_descriptions[0]['expr']
+    # only known columns, the sort values come from the request
+    sort = [(sort_col, 'ASC' if sort_dir.upper() == 'ASC' else 'DESC') for sort_col, sort_dir in sort if sort_col in columns]
+    id_dir = sort[0][1] if sort else 'DESC'
+    can_seek = len(sort) == 1 and limit
 
-    if start:
-        query = query.offset(start)
+    boundaries = cached_value(page_boundary_cache, key, generation) or {}
+    boundary = boundaries.get(start) if can_seek and start else None
+    reverse = False
+    if boundary is not None:
+        sort_expr = getattr(columns[sort[0][0]], 'element', columns[sort[0][0]])
+        seek_clause = sqlalchemy.tuple_(sort_expr, id_column)
+        if sort[0][1] == 'DESC':
+            query = query.having(seek_clause < sqlalchemy.tuple_(*boundary))
+        else:
+            query = query.having(seek_clause > sqlalchemy.tuple_(*boundary))
+        offset = 0
+    elif count is not None and limit and start > count / 2:
+        # e.g. the last page, read from the other end
+        reverse = True
+        offset = max(count - start - limit, 0)
+        limit = min(limit, count - start)
+    else:
+        offset = start
+
+    def direction(sort_dir):
+        if reverse:
+            return 'ASC' if sort_dir == 'DESC' else 'DESC'
+        return sort_dir
+    for sort_col, sort_dir in sort:
+        query = query.order_by('{0} {1}'.format(sort_col, direction(sort_dir)))
+    query = query.order_by(id_column.asc() if direction(id_dir) == 'ASC' else id_column.desc())
+
+    if limit is not None and limit <= 0:
+        return []
+    if offset:
+        query = query.offset(offset)
     if limit:
         query = query.limit(limit)
 
-    # Convert to lists from keyedTuples
     results = [list(result) for result in query.all()]
+    if reverse:
+        results.reverse()
+
+    if can_seek and results:
+        boundaries[start + len(results)] = (results[-1][names.index(sort[0][0])], results[-1][0])
+        page_boundary_cache.set(key, (generation, boundaries))
+    return results
+
+# Get JSON aggregate data for main aggregate pages
+@datatables
+def json_aggregate(table_class, filter_kwargs=None, search=None, sort=[('avg','DESC')], start=None, limit=None, count=False):
+    '''
+    Returns a page of aggregate rows, the number of names and, when count is set, the
+    number of names matching the filters (otherwise the number of rows returned).
+    '''
+    # Get specific table info (call stack/sql statement/file access)
+    metadata_table = metadata_table_dict[table_class][0]
+
+    total_num_items = estimated_count(metadata_table)
+    # read before querying, counts and boundaries racing an ingest are cached as the older generation
+    generation = db.get_generation(db.session, rollup_stat_types[table_class])
+    
+    # Get aggregate data for datatable/d3 bar graph
+    query = aggregate_query(table_class, filter_kwargs)
+    query = search_query(query, table_class, search, filter_kwargs.get('search_mode'))
+    filter_key = (column_name_dict[table_class], cache_key(filter_kwargs), search)
+
+    # Percentiles come from merged sketches, so sorting by them must happen here rather
+    # than in SQL. Only the percentile_sort_limit names with the highest max (lowest min
+    # when ascending) are merged and sorted, no percentile is above the max or below the
+    # min, so beyond that many names the order is approximate.
+    filtered_num_items = filtered_count(query, filter_key, generation) if count else None
+    percentile_sort = [sort_dir for sort_col, sort_dir in sort if sort_col in percentile_columns]
+    if percentile_sort:
+        bound_sort = [('min', 'ASC')] if percentile_sort[0].upper() == 'ASC' else [('max', 'DESC')]
+        results = page_query(query, filter_key + (tuple(bound_sort),), generation, bound_sort, 0,
+                             percentile_sort_limit or None, None)
+    else:
+        results = page_query(query, filter_key + (tuple(sort),), generation, sort, start, limit, filtered_num_items)
+
+    name_sketches = aggregate_sketches(table_class, filter_kwargs, search, [result[0] for result in results])
     # Convert call stack name objects to strings
     for result in results:
         result[1] = str(result[1])
+        result += sketch_percentiles(name_sketches.get(result[0]))
 
-    return results, total_num_items, len(results)
+    if percentile_sort:
+        cols = ('id', column_name_dict[table_class], 'count', 'total', 'avg', 'min', 'max') + percentile_columns
+        results = sort_results(results, sort, cols)
+        start = start or 0
+        results = results[start:start + limit] if limit else results[start:]
+
+    if filtered_num_items is None:
+        filtered_num_items = len(results)
+    return results, total_num_items, filtered_num_items
 
 # Get JSON aggregate data for aggregate item pages
 def json_aggregate_item(table_class, filter_kwargs, id):
     # Get specific table info (call stack/sql statement/file access)
-    column_name = column_name_dict[table_class]
     metadata_table = metadata_table_dict[table_class][0]
-    metadata_value = metadata_table_dict[table_class][1]
     table_class_column = metadata_table_dict[table_class][2]
     
     sort = filter_kwargs.get('sort', [('avg','DESC')])
@@ -195,32 +525,11 @@ def json_aggregate_item(table_class, filter_kwargs, id):
     if end_date:
         times_query = times_query.filter(table_class.datetime < end_date)
 
-    times = [(time[2], time[3], time[1]) for time in times_query.all()]
-    times = sorted(times, key=itemgetter(1))
-    
+    times, resolution = item_series(table_class, times_query, filter_kwargs.get('resolution'))
+
     # Get aggregate item data
-    query = db.session.query(
-            metadata_table.id,
-            metadata_value.label(column_name),
-            func.count(table_class.id).label('count'),
-            sqlalchemy.cast(func.sum(table_class.duration), sqlalchemy.Numeric(10, 5)).label('total'),
-            sqlalchemy.cast(func.avg(table_class.duration), sqlalchemy.Numeric(10, 5)).label('avg'),
-            sqlalchemy.cast(func.min(table_class.duration), sqlalchemy.Numeric(10, 5)).label('min'),
-            sqlalchemy.cast(func.max(table_class.duration), sqlalchemy.Numeric(10, 5)).label('max')
-        )
-    # Only get information for current tab (e.g. Call Stacks)
-    query = query.join(table_class_column)
-    
-    # Filter data based on the key/value pairs picked in the side bar
-    query = filter_query(query, filter_kwargs, table_class)
-    
-    query = query.group_by(metadata_table.id)
+    query = aggregate_query(table_class, filter_kwargs)
     query = query.filter(metadata_table.id == id)
-    
-    if start_date:
-        query = query.filter(table_class.datetime > start_date)
-    if end_date:
-        query = query.filter(table_class.datetime < end_date)
 
     for sorter in sort:
         query = query.order_by('{0} {1}'.format(*sorter))
@@ -232,14 +541,435 @@ def json_aggregate_item(table_class, filter_kwargs, id):
         result = list(query.first())
         # Convert call stack name object to string
         result[1] = str(result[1])
+        result += sketch_percentiles(aggregate_sketches(table_class, filter_kwargs, ids=[result[0]]).get(result[0]))
         result.append(times)
+        result.append(resolution)
         return result,1,1
     except:
         return [],0,0
 
+def item_series(table_class, times_query, resolution=None):
+    '''
+    The timing series of an item's filtered calls. While there are at most series_points
+    calls each is sent as [duration, datetime, id], otherwise the calls are bucketed in the
+    database into [avg duration, bucket midpoint, id, min, max, count] per resolution
+    seconds (widened so there are never more than series_points buckets). A bucket of a
+    single call keeps its id, zooming into a narrow enough window reaches every call.
+    Returns the series and the resolution of its buckets, None for individual calls.
+    '''
+    count, first, last = times_query.with_entities(func.count(table_class.id),
+                                                   func.min(table_class.datetime),
+                                                   func.max(table_class.datetime)).one()
+    if not count:
+        return [], None
+    if not resolution and count <= series_points:
+        rows = times_query.with_entities(table_class.duration, table_class.datetime, table_class.id) \
+                          .order_by(table_class.datetime).all()
+        return [list(row) for row in rows], None
+
+    # all the calls at one instant are one bucket of any size
+    resolution = max(resolution or 0, (last - first) / series_points) or 1.0
+    bucket = func.floor((table_class.datetime - first) / resolution).label('bucket')
+    rows = times_query.with_entities(bucket,
+                                     func.avg(table_class.duration),
+                                     func.min(table_class.id),
+                                     func.min(table_class.duration),
+                                     func.max(table_class.duration),
+                                     func.count(table_class.id)) \
+                      .group_by('bucket').order_by('bucket').all()
+    series = []
+    for bucket, avg, min_id, min_duration, max_duration, bucket_count in rows:
+        series.append([avg,
+                       first + (bucket + 0.5) * resolution,
+                       min_id if bucket_count == 1 else None,
+                       min_duration, max_duration, bucket_count])
+    return series, resolution
+
+def name_strings(table_class, ids):
+    '''A dictionary of name id -> the name's string (call stack name, SQL or file name).'''
+    metadata_table, metadata_value = metadata_table_dict[table_class][:2]
+    if not ids:
+        return {}
+    query = db.session.query(metadata_table.id, metadata_value).filter(metadata_table.id.in_(set(ids)))
+    return dict((name_id, unicode(name)) for name_id, name in query.all())
+
+def json_anomalies(table_class, since, limit=100):
+    '''The anomalies (see anomalies.py) of a stat type flagged since a time, most recent first, with their names.'''
+    query = db.session.query(db.Anomaly).filter(db.Anomaly.stat_type == rollup_stat_types[table_class],
+                                                db.Anomaly.window_end >= since)
+    anomalies = query.order_by(db.Anomaly.window_end.desc(), db.Anomaly.score.desc()).limit(limit).all()
+    names = name_strings(table_class, [anomaly.name_id for anomaly in anomalies])
+    return [dict(anomaly.to_dict(), name=names.get(anomaly.name_id)) for anomaly in anomalies]
+
+def json_repeated_queries(filter_kwargs, name_id=None, limit=None):
+    '''
+    N+1 suspects, the statements handler requests ran repeatedly from one call site (see
+    RepeatedQuery) under the filters, grouped by handler, fingerprint and call site and
+    ranked by the time wasted in total. Only the handler name_id's if given.
+    '''
+    wasted = func.sum(db.RepeatedQuery.wasted)
+    query = filtered_stat_query(db.CallStack, filter_kwargs, None,
+                                db.CallStack.call_stack_name_id,
+                                db.RepeatedQuery.fingerprint,
+                                db.RepeatedQuery.call_site,
+                                func.max(db.RepeatedQuery.sql_string_id),
+                                func.max(db.RepeatedQuery.sql),
+                                func.count(db.RepeatedQuery.id),
+                                func.sum(db.RepeatedQuery.count),
+                                func.sum(db.RepeatedQuery.duration),
+                                wasted)
+    query = query.join(db.RepeatedQuery, db.RepeatedQuery.call_stack_id == db.CallStack.id)
+    # the same bounds on the suspects' own datetime, so their index can be used
+    if filter_kwargs.get('start_date'):
+        query = query.filter(db.RepeatedQuery.datetime > filter_kwargs['start_date'])
+    if filter_kwargs.get('end_date'):
+        query = query.filter(db.RepeatedQuery.datetime < filter_kwargs['end_date'])
+    if name_id:
+        query = query.filter(db.CallStack.call_stack_name_id == name_id)
+    query = query.group_by(db.CallStack.call_stack_name_id, db.RepeatedQuery.fingerprint, db.RepeatedQuery.call_site)
+    results = query.order_by(wasted.desc()).limit(limit or repeated_query_limit).all()
+
+    names = name_strings(db.CallStack, [result[0] for result in results])
+    return [{'call_stack_name_id': call_stack_name_id,
+             'name': names.get(call_stack_name_id),
+             'fingerprint': fingerprint,
+             'call_site': call_site,
+             'sql_string_id': sql_string_id,
+             'sql': sql,
+             'requests': requests,
+             'count': int(count),
+             'per_request': float(count) / requests,
+             'duration': duration,
+             'wasted': total_wasted}
+            for call_stack_name_id, fingerprint, call_site, sql_string_id, sql, requests, count, duration, total_wasted in results]
+
+call_stack_facet_columns = {'module': db.CallStackName.module_name,
+                            'class':  db.CallStackName.class_name,
+                            'method': db.CallStackName.fn_name}
+
+def json_facet(table_class, key, filter_kwargs):
+    '''
+    The distinct values of a filter key, with the number of stats having each value under
+    the filters already picked, most common first. Counted from the rollups when the dates
+    line up with a rollup resolution. Metadata values are counted per metadata set first,
+    of which there are far fewer than stats, then summed per value. The key's own filters
+    are left out, so its other values can still be picked.
+    '''
+    filter_kwargs = dict(filter_kwargs)
+    for k in filter_kwargs.keys():
+        if 'key_' in k and filter_kwargs[k] == key:
+            del(filter_kwargs[k])
+            filter_kwargs.pop(k.replace('key', 'value'), None)
+    resolution = rollup_resolution(filter_kwargs)
+    if resolution:
+        count = sqlalchemy.cast(func.sum(db.StatRollup.count), sqlalchemy.Integer)
+        metadata_set_column = db.StatRollup.metadata_set_id
+    else:
+        count = func.count(table_class.id)
+        metadata_set_column = table_class.metadata_set_id
+
+    if table_class == db.CallStack and key in call_stack_facet_columns:
+        value = call_stack_facet_columns[key]
+        query = filtered_stat_query(table_class, filter_kwargs, resolution, value, count.label('count'))
+        query = query.filter(value != None).group_by(value)
+    else:
+        set_counts = filtered_stat_query(table_class, filter_kwargs, resolution,
+                                         metadata_set_column.label('metadata_set_id'), count.label('count'))
+        set_counts = set_counts.group_by(metadata_set_column).subquery()
+        query = db.session.query(db.MetaData.value, sqlalchemy.cast(func.sum(set_counts.c.count), sqlalchemy.Integer).label('count'))
+        query = query.join(db.MetadataSet, db.MetaData.id == func.any(db.MetadataSet.metadata_ids))
+        query = query.join(set_counts, set_counts.c.metadata_set_id == db.MetadataSet.id)
+        query = query.filter(db.MetaData.key == key, db.MetaData.value != None).group_by(db.MetaData.value)
+
+    return [list(row) for row in query.order_by(sqlalchemy.desc('count')).limit(facet_limit)]
+
+function_stats_columns = ('profiles', 'ncalls', 'tottime', 'cumtime')
+
+def resolve_function_ids(function):
+    '''Ids of the profile functions matching a "file::line::name" key or a bare function name.'''
+    query = db.session.query(db.ProfileFunction.id)
+    parts = function.rsplit('::', 2)
+    if len(parts) == 3:
+        query = query.filter(db.ProfileFunction.filename == parts[0],
+                             db.ProfileFunction.line == int(parts[1]),
+                             db.ProfileFunction.name == parts[2])
+    else:
+        query = query.filter(db.ProfileFunction.name == function)
+    return [row[0] for row in query.all()]
+
+def filter_function_stats(query, filter_kwargs):
+    '''Time and side bar filters for queries over CallStackFunction, which must already join CallStackName.'''
+    start_date = filter_kwargs.get('start_date', None)
+    end_date = filter_kwargs.get('end_date', None)
+    if start_date:
+        query = query.filter(db.CallStackFunction.datetime > start_date)
+    if end_date:
+        query = query.filter(db.CallStackFunction.datetime < end_date)
+    if any('key_' in k for k in filter_kwargs):
+        query = query.join(db.CallStack, db.CallStack.id == db.CallStackFunction.call_stack_id)
+        query = filter_query(query, filter_kwargs, db.CallStack)
+    return query
+
+def order_function_stats(query, filter_kwargs, default_sort):
+    for sort_col, sort_dir in filter_kwargs.get('sort', [(default_sort, 'DESC')]):
+        if sort_col in function_stats_columns:
+            query = query.order_by('{0} {1}'.format(sort_col, 'ASC' if sort_dir.upper() == 'ASC' else 'DESC'))
+    return query.limit(filter_kwargs.get('limit', 50))
+
+def function_stats_aggregates():
+    return [func.count(sqlalchemy.distinct(db.CallStackFunction.call_stack_id)).label('profiles'),
+            func.sum(db.CallStackFunction.ncalls).label('ncalls'),
+            sqlalchemy.cast(func.sum(db.CallStackFunction.tottime), sqlalchemy.Numeric(12, 6, asdecimal=False)).label('tottime'),
+            sqlalchemy.cast(func.sum(db.CallStackFunction.cumtime), sqlalchemy.Numeric(12, 6, asdecimal=False)).label('cumtime')]
+
+# Get the call stacks (handlers) which spend the most time in a function
+def json_function_callers(function, filter_kwargs):
+    function_ids = resolve_function_ids(function)
+    if not function_ids:
+        return []
+
+    query = db.session.query(db.CallStackName.id,
+                             metadata_table_dict[db.CallStack][1].label('full_name'),
+                             *function_stats_aggregates())
+    query = query.join(db.CallStackFunction, db.CallStackFunction.call_stack_name_id == db.CallStackName.id)
+    query = query.filter(db.CallStackFunction.function_id.in_(function_ids))
+    query = filter_function_stats(query, filter_kwargs)
+    query = query.group_by(db.CallStackName.id)
+    query = order_function_stats(query, filter_kwargs, 'cumtime')
+    return [list(result) for result in query.all()]
+
+# Get the functions which directly call a function, ranked by the function's time under them
+def json_function_direct_callers(function, filter_kwargs):
+    function_ids = resolve_function_ids(function)
+    if not function_ids:
+        return []
+
+    callers = db.session.query(func.unnest(db.CallStackFunction.caller_ids).label('caller_id'),
+                               db.CallStackFunction.call_stack_id,
+                               db.CallStackFunction.ncalls,
+                               db.CallStackFunction.tottime,
+                               db.CallStackFunction.cumtime)
+    callers = callers.join(db.CallStackName, db.CallStackFunction.call_stack_name_id == db.CallStackName.id)
+    callers = callers.filter(db.CallStackFunction.function_id.in_(function_ids))
+    callers = filter_function_stats(callers, filter_kwargs).subquery()
+
+    query = db.session.query(db.ProfileFunction.id,
+                             db.ProfileFunction.filename,
+                             db.ProfileFunction.line,
+                             db.ProfileFunction.name,
+                             func.count(sqlalchemy.distinct(callers.c.call_stack_id)).label('profiles'),
+                             func.sum(callers.c.ncalls).label('ncalls'),
+                             sqlalchemy.cast(func.sum(callers.c.tottime), sqlalchemy.Numeric(12, 6, asdecimal=False)).label('tottime'),
+                             sqlalchemy.cast(func.sum(callers.c.cumtime), sqlalchemy.Numeric(12, 6, asdecimal=False)).label('cumtime'))
+    query = query.join(callers, callers.c.caller_id == db.ProfileFunction.id)
+    query = query.group_by(db.ProfileFunction.id)
+    query = order_function_stats(query, filter_kwargs, 'cumtime')
+    return [[result[0], db.ProfileFunction({'filename': result[1], 'line': result[2], 'name': result[3]}).to_str()] + list(result[4:])
+            for result in query.all()]
+
+# Get the functions a call stack name spends the most time in
+def json_stack_functions(id, filter_kwargs):
+    query = db.session.query(db.ProfileFunction.id,
+                             db.ProfileFunction.filename,
+                             db.ProfileFunction.line,
+                             db.ProfileFunction.name,
+                             *function_stats_aggregates())
+    query = query.join(db.CallStackFunction, db.CallStackFunction.function_id == db.ProfileFunction.id)
+    query = query.join(db.CallStackName, db.CallStackFunction.call_stack_name_id == db.CallStackName.id)
+    query = query.filter(db.CallStackFunction.call_stack_name_id == id)
+    query = filter_function_stats(query, filter_kwargs)
+    query = query.group_by(db.ProfileFunction.id)
+    query = order_function_stats(query, filter_kwargs, 'tottime')
+    return [[result[0], db.ProfileFunction({'filename': result[1], 'line': result[2], 'name': result[3]}).to_str()] + list(result[4:])
+            for result in query.all()]
+
+def diff_sides(kwargs):
+    '''
+    Splits a diff's arguments into the filters of its two sides, arguments prefixed a_ or
+    b_ filter one side (e.g. a_key_1=version&a_value_1=0.0.1), the rest filter both.
+    '''
+    shared, sides = {}, ({}, {})
+    for key, value in kwargs.items():
+        if key[:2] in ('a_', 'b_'):
+            side = key[0]
+            key = key[2:]
+            # numbered apart from the shared metadata filters
+            if key.startswith('key_') or key.startswith('value_'):
+                key = key.replace('_', '_' + side, 1)
+            sides[side == 'b'][key] = value
+        else:
+            shared[key] = value
+    return [parse_kwargs(dict(shared, **side_kwargs))[1] for side_kwargs in sides]
+
+def diff_side_profiles(name_id, filter_kwargs):
+    '''
+    The profiles on one side of a diff, ('merged', [(bucket, count)]) of the hourly merged
+    profiles if the side is only filtered by hour aligned dates, otherwise ('profiles',
+    [uuid]) of its most recent diff_max_profiles profiles.
+    '''
+    start_date = filter_kwargs.get('start_date')
+    end_date = filter_kwargs.get('end_date')
+    if (use_merged_profiles and not any('key_' in key for key in filter_kwargs) and
+            all(date is None or date % 3600 == 0 for date in (start_date, end_date))):
+        query = db.session.query(db.MergedProfile.bucket, db.MergedProfile.count)
+        query = query.filter(db.MergedProfile.call_stack_name_id == name_id, db.MergedProfile.count > 0)
+        if start_date:
+            query = query.filter(db.MergedProfile.bucket >= start_date)
+        if end_date:
+            query = query.filter(db.MergedProfile.bucket < end_date)
+        return 'merged', sorted(tuple(row) for row in query.all())
+
+    query = filtered_stat_query(db.CallStack, filter_kwargs, None, db.CallStack.pstat_uuid)
+    query = query.filter(db.CallStack.call_stack_name_id == name_id)
+    query = query.order_by(db.CallStack.datetime.desc()).limit(diff_max_profiles)
+    return 'profiles', sorted(row[0] for row in query.all())
+
+def diff_side_totals(name_id, side):
+    '''
+    The analyse_stats.add_function_totals of one side's profiles and the number of
+    profiles, cached by the profiles so only a side with new profiles is read again.
+    '''
+    key = (name_id, hashlib.md5(repr(side)).hexdigest())
+    cached = diff_cache.get(key)
+    if cached is not None:
+        return cached
+
+    kind, profiles = side
+    totals, count = {}, 0
+    if kind == 'merged':
+        buckets = [bucket for bucket, bucket_count in profiles]
+        # a day of hours at a time
+        for i in xrange(0, len(buckets), 24):
+            query = db.session.query(db.MergedProfile.stats, db.MergedProfile.count)
+            query = query.filter(db.MergedProfile.call_stack_name_id == name_id,
+                                 db.MergedProfile.bucket.in_(buckets[i:i + 24]))
+            for stats, bucket_count in query.all():
+                analyse_stats.add_function_totals(totals, pstat_store.unpack_stats(stats))
+                count += bucket_count
+    else:
+        for uuid in profiles:
+            try:
+                stats = pstat_store.store.read(uuid)
+            except KeyError:
+                # expired
+                continue
+            analyse_stats.add_function_totals(totals, stats)
+            count += 1
+
+    diff_cache.set(key, (totals, count))
+    return totals, count
+
+def json_profile_diff(name_id, a_kwargs, b_kwargs, sort='tottime', limit=None):
+    '''
+    Compares the functions of a call stack name's profiles under two sets of filters, e.g.
+    two date ranges or two versions. Returns the number of profiles on each side, and
+    whether they were read from the merged profiles, and the functions' per profile
+    ncalls, tottime and cumtime on each side and their deltas, largest regressions of
+    sort (by absolute delta) first.
+    '''
+    sides = [diff_side_profiles(name_id, filter_kwargs) for filter_kwargs in (a_kwargs, b_kwargs)]
+    (a_totals, a_count), (b_totals, b_count) = [diff_side_totals(name_id, side) for side in sides]
+    return {'a': {'profiles': a_count, 'merged': sides[0][0] == 'merged'},
+            'b': {'profiles': b_count, 'merged': sides[1][0] == 'merged'},
+            'functions': analyse_stats.diff_function_totals(a_totals, a_count, b_totals, b_count,
+                                                            sort, limit or diff_limit)}
+
+def merged_side_stats(name_id, side):
+    '''
+    The pstats dictionary of the profiles of diff_side_profiles merged into one, merged as
+    they are read so only one profile besides the merge is held at a time. Raises
+    KeyError if none of the profiles could be read.
+    '''
+    kind, profiles = side
+    merged = None
+    if kind == 'merged':
+        buckets = [bucket for bucket, bucket_count in profiles]
+        # a day of hours at a time
+        for i in xrange(0, len(buckets), 24):
+            query = db.session.query(db.MergedProfile.stats)
+            query = query.filter(db.MergedProfile.call_stack_name_id == name_id,
+                                 db.MergedProfile.bucket.in_(buckets[i:i + 24]))
+            for (stats,) in query.all():
+                stats = pstat_store.unpack_stats(stats)
+                merged = stats if merged is None else pstat_store.merge_stats([merged, stats])
+    else:
+        for uuid in profiles:
+            try:
+                stats = pstat_store.store.read(uuid)
+            except KeyError:
+                # expired
+                continue
+            merged = stats if merged is None else pstat_store.merge_stats([merged, stats])
+    if merged is None:
+        raise KeyError(name_id)
+    return merged
+
+def folded_side(name_id, side, options):
+    '''
+    The gzipped analyse_stats.folded_stacks of one side's profiles merged, cached by the
+    profiles so they are only merged again once new profiles match.
+    '''
+    key = (name_id, hashlib.md5(repr(side)).hexdigest(), cache_key(options))
+    data = flame_graph_cache.get(key)
+    if data is None:
+        stats = merged_side_stats(name_id, side)
+        graph = analyse_stats.call_graph(pstats.Stats(pstat_store.BogusStats(stats)))
+        data = call_graph_cache.compress(analyse_stats.folded_stacks(graph, **options))
+        flame_graph_cache.set(key, data)
+    return data
+
+# request arguments which never change a result, e.g. datatables' draw counter and jQuery's cache buster
+uncached_kwargs = ('sEcho', '_')
+
+def cache_key(kwargs):
+    '''An order independent, hashable key of request arguments.'''
+    return tuple(sorted((key, tuple(value) if isinstance(value, list) else value)
+                        for key, value in kwargs.items() if key not in uncached_kwargs))
+
+def cached_result(stat_type):
+    '''
+    Caches an AggregateAPI method's results by its arguments and the generation of the
+    stat type's data, so repeated requests only query the database after stats of that
+    type have been ingested. Responses carry an ETag of the generation and arguments,
+    a matching If-None-Match is answered with a 304. With a stat_type of None the stat
+    type is the method's first argument.
+    '''
+    def decorator(method):
+        @wraps(method)
+        def cached_method(self, *args, **kwargs):
+            method_stat_type = stat_type or (args[0] if args else kwargs.get('stat_type'))
+            if method_stat_type not in db.generation_stat_types:
+                raise cherrypy.NotFound
+            db_session = db.session()
+            # read before computing, a result racing an ingest is cached as the older generation
+            generation = db.get_generation(db_session, method_stat_type)
+            db_session.commit()
+
+            key = (method.__name__, args, cache_key(kwargs))
+            etag = '"{0}-{1}"'.format(generation, hashlib.md5(repr(key)).hexdigest())
+            cherrypy.response.headers['ETag'] = etag
+            cherrypy.response.headers['Cache-Control'] = 'no-cache'
+            if etag in [tag.strip() for tag in cherrypy.request.headers.get('If-None-Match', '').split(',')]:
+                raise cherrypy.HTTPRedirect([], 304)
+
+            cached = result_cache.get(key)
+            if cached is not None and cached[0] == generation:
+                result = cached[1]
+            else:
+                # parse_kwargs consumes the arguments, so pass a copy
+                result = method(self, *args, **dict(kwargs))
+                result_cache.set(key, (generation, result))
+
+            if isinstance(result, dict) and 'sEcho' in kwargs:
+                result = dict(result, sEcho=int(kwargs['sEcho']))
+            return result
+        return cached_method
+    return decorator
+
 class AggregateAPI(object):
     @cherrypy.expose
     @cherrypy.tools.json_out()
+    @cached_result('callstacks')
     def callstacks(self, id=None, **kwargs):
         table_kwargs, filter_kwargs = parse_kwargs(kwargs)
         if id:
@@ -249,6 +979,7 @@ class AggregateAPI(object):
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
+    @cached_result('sqlstatements')
     def sqlstatements(self, id=None, **kwargs):
         table_kwargs, filter_kwargs = parse_kwargs(kwargs)
         if id:
@@ -258,6 +989,7 @@ class AggregateAPI(object):
     
     @cherrypy.expose
     @cherrypy.tools.json_out()
+    @cached_result('fileaccesses')
     def fileaccesses(self, id=None, **kwargs):
         table_kwargs, filter_kwargs = parse_kwargs(kwargs)
         if id:
@@ -265,5 +997,72 @@ class AggregateAPI(object):
         else:
             return json_aggregate(db.FileAccess, filter_kwargs, table_kwargs)
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def callstackdiff(self, id, sort='tottime', limit=None, **kwargs):
+        '''
+        The per function differences between the profiles of a call stack name under the
+        a_ prefixed filters and the b_ prefixed filters, see json_profile_diff.
+        '''
+        if sort not in analyse_stats.diff_sorts:
+            raise cherrypy.HTTPError(400, 'sort must be one of {0}'.format(', '.join(analyse_stats.diff_sorts)))
+        a_kwargs, b_kwargs = diff_sides(kwargs)
+        return json_profile_diff(int(id), a_kwargs, b_kwargs, sort, int(limit) if limit else None)
+
+    @cherrypy.expose
+    def callstackflamegraph(self, id, min_fraction=None, max_depth=None, max_stacks=None, **kwargs):
+        '''
+        The folded stacks of the profiles of a call stack name under the filters merged
+        together, read as the profiles of a diff are (see diff_side_profiles). The ETag is
+        of the profiles merged, so it changes once new profiles match.
+        '''
+        options = json_ui.flame_graph_options(min_fraction, max_depth, max_stacks)
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        name_id = int(id)
+        side = diff_side_profiles(name_id, filter_kwargs)
+        etag = '"{0}"'.format(hashlib.md5(repr((name_id, side, sorted(options.items())))).hexdigest())
+        return json_ui.serve_gzipped(etag, 'text/plain', lambda: folded_side(name_id, side, options), 'no-cache')
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def anomalies(self, stat_type, since=None, limit=100, **kwargs):
+        '''Anomalies of a stat type flagged since a time (by default the last day).'''
+        if stat_type not in stat_type_classes:
+            raise cherrypy.NotFound
+        since = float(since) if since else time.time() - 86400
+        return json_anomalies(stat_type_classes[stat_type], since, int(limit))
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cached_result('callstacks')
+    def repeatedqueries(self, id=None, limit=None, **kwargs):
+        '''N+1 suspects under the filters, of every handler or the call stack name id's, see json_repeated_queries.'''
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        return json_repeated_queries(filter_kwargs, int(id) if id else None, int(limit) if limit else None)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cached_result(None)
+    def facets(self, stat_type, key, **kwargs):
+        '''The values of a filter key with their counts under the other filters, as [[value, count]].'''
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        return json_facet(stat_type_classes[stat_type], key, filter_kwargs)
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cached_result('callstacks')
+    def functioncallers(self, function, by='handler', **kwargs):
+        '''Top call stacks (by=handler) or direct callers (by=caller) of a function.'''
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        if by == 'caller':
+            return json_function_direct_callers(function, filter_kwargs)
+        else:
+            return json_function_callers(function, filter_kwargs)
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cached_result('callstacks')
+    def stackfunctions(self, id, **kwargs):
+        '''Top functions within the profiles of a call stack name.'''
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        return json_stack_functions(id, filter_kwargs)
@@ -39,6 +39,51 @@ class AggregatePages(object):
             mytemplate = Template(filename=os.path.join(self.templates_dir,'aggregatecallstacks.html'), lookup=self.template_lookup)
             return mytemplate.render()
 
+    @cherrypy.expose
+    def callstackdiff(self, id, **kwargs):
+        call_stack_name = db.session.query(db.CallStackName).get(id)
+        if call_stack_name == None:
+            raise cherrypy.HTTPError(404)
+
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        for k in filter_kwargs:
+            filter_kwargs[k] = str(filter_kwargs[k])
+
+        mytemplate = Template(filename=os.path.join(self.templates_dir,'aggregatecallstackdiff.html'), lookup=self.template_lookup)
+        return mytemplate.render(call_stack_id=call_stack_name.id, call_stack_name=str(call_stack_name.full_name), kwargs=filter_kwargs)
+
+    @cherrypy.expose
+    def callstackflamegraph(self, id, **kwargs):
+        call_stack_name = db.session.query(db.CallStackName).get(id)
+        if call_stack_name == None:
+            raise cherrypy.HTTPError(404)
+
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        for k in filter_kwargs:
+            filter_kwargs[k] = str(filter_kwargs[k])
+
+        breadcrumbs = [('/callstacks', 'Aggregation'), ('/callstacks/{0}'.format(call_stack_name.id), call_stack_name.id)]
+        mytemplate = Template(filename=os.path.join(self.templates_dir,'flamegraph.html'), lookup=self.template_lookup)
+        return mytemplate.render(call_stack_name=str(call_stack_name.full_name), breadcrumbs=breadcrumbs, kwargs=filter_kwargs,
+                                 data_url='/api/callstackflamegraph/{0}'.format(call_stack_name.id), filtered=True)
+
+    @cherrypy.expose
+    def repeatedqueries(self, id=None, **kwargs):
+        call_stack_name = None
+        if id:
+            call_stack_name = db.session.query(db.CallStackName).get(id)
+            if call_stack_name == None:
+                raise cherrypy.HTTPError(404)
+
+        table_kwargs, filter_kwargs = parse_kwargs(kwargs)
+        for k in filter_kwargs:
+            filter_kwargs[k] = str(filter_kwargs[k])
+
+        mytemplate = Template(filename=os.path.join(self.templates_dir,'aggregaterepeatedqueries.html'), lookup=self.template_lookup)
+        return mytemplate.render(call_stack_id=call_stack_name.id if call_stack_name else None,
+                                 call_stack_name=str(call_stack_name.full_name) if call_stack_name else None,
+                                 kwargs=filter_kwargs)
+
     @cherrypy.expose
     def sqlstatements(self, id=None, **kwargs):
         if id:
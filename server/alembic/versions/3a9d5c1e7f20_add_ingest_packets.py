@@ -0,0 +1,31 @@
+"""add ingest packets
+
+Revision ID: 3a9d5c1e7f20
+Revises: 237e13a3f51b
+Create Date: 2026-10-18 09:12:41.204000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a9d5c1e7f20'
+down_revision = '237e13a3f51b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+                    'ingest_packets',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('stat_type', sa.String),
+                    sa.Column('received', sa.Float),
+                    sa.Column('payload', sa.LargeBinary),
+                    sa.Column('attempts', sa.Integer),
+                    sa.Column('last_error', sa.String)
+                    )
+    op.create_index('ix_ingest_packets_attempts_id', 'ingest_packets', ['attempts', 'id'])
+
+def downgrade():
+    op.drop_index('ix_ingest_packets_attempts_id', 'ingest_packets')
+    op.drop_table('ingest_packets')
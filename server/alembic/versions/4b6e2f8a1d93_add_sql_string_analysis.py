@@ -0,0 +1,27 @@
+"""add sql string analysis
+
+Revision ID: 4b6e2f8a1d93
+Revises: 3a9d5c1e7f20
+Create Date: 2026-10-18 10:03:17.512000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b6e2f8a1d93'
+down_revision = '3a9d5c1e7f20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('sql_strings', sa.Column('identifiers', sa.String))
+    op.add_column('sql_strings', sa.Column('statement_type', sa.String))
+    op.add_column('sql_strings', sa.Column('fingerprint', sa.String))
+    op.create_index('ix_sql_strings_fingerprint', 'sql_strings', ['fingerprint'])
+
+def downgrade():
+    op.drop_index('ix_sql_strings_fingerprint', 'sql_strings')
+    op.drop_column('sql_strings', 'fingerprint')
+    op.drop_column('sql_strings', 'statement_type')
+    op.drop_column('sql_strings', 'identifiers')
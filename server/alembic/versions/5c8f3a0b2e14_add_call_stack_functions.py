@@ -0,0 +1,46 @@
+"""add call stack functions
+
+Revision ID: 5c8f3a0b2e14
+Revises: 4b6e2f8a1d93
+Create Date: 2026-10-18 11:26:52.338000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c8f3a0b2e14'
+down_revision = '4b6e2f8a1d93'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+
+def upgrade():
+    op.create_table(
+                    'profile_functions',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('filename', sa.String),
+                    sa.Column('line', sa.Integer),
+                    sa.Column('name', sa.String),
+                    sa.UniqueConstraint('filename', 'line', 'name', name='_profile_function_uc')
+                    )
+    op.create_table(
+                    'call_stack_functions',
+                    sa.Column('call_stack_id', sa.Integer, sa.ForeignKey('call_stacks.id'), primary_key=True),
+                    sa.Column('function_id', sa.Integer, sa.ForeignKey('profile_functions.id'), primary_key=True),
+                    sa.Column('call_stack_name_id', sa.Integer, sa.ForeignKey('call_stack_names.id')),
+                    sa.Column('datetime', sa.Float),
+                    sa.Column('ncalls', sa.Integer),
+                    sa.Column('primcalls', sa.Integer),
+                    sa.Column('tottime', sa.Float),
+                    sa.Column('cumtime', sa.Float),
+                    sa.Column('caller_ids', ARRAY(sa.Integer))
+                    )
+    op.create_index('ix_call_stack_functions_function_datetime', 'call_stack_functions', ['function_id', 'datetime'])
+    op.create_index('ix_call_stack_functions_name_datetime', 'call_stack_functions', ['call_stack_name_id', 'datetime'])
+
+def downgrade():
+    op.drop_index('ix_call_stack_functions_name_datetime', 'call_stack_functions')
+    op.drop_index('ix_call_stack_functions_function_datetime', 'call_stack_functions')
+    op.drop_table('call_stack_functions')
+    op.drop_table('profile_functions')
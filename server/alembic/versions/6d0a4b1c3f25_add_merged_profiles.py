@@ -0,0 +1,28 @@
+"""add merged profiles
+
+Revision ID: 6d0a4b1c3f25
+Revises: 5c8f3a0b2e14
+Create Date: 2026-10-18 12:40:09.761000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d0a4b1c3f25'
+down_revision = '5c8f3a0b2e14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+                    'merged_profiles',
+                    sa.Column('call_stack_name_id', sa.Integer, sa.ForeignKey('call_stack_names.id'), primary_key=True),
+                    sa.Column('bucket', sa.Integer, primary_key=True),
+                    sa.Column('count', sa.Integer),
+                    sa.Column('total_tt', sa.Float),
+                    sa.Column('stats', sa.LargeBinary)
+                    )
+
+def downgrade():
+    op.drop_table('merged_profiles')
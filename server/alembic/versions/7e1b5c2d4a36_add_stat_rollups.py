@@ -0,0 +1,64 @@
+"""add stat rollups
+
+Revision ID: 7e1b5c2d4a36
+Revises: 6d0a4b1c3f25
+Create Date: 2026-10-18 13:52:33.107000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e1b5c2d4a36'
+down_revision = '6d0a4b1c3f25'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+
+# stat type, raw table, name id column, metadata association table, association's stat id column
+stat_tables = [('callstacks', 'call_stacks', 'call_stack_name_id', 'call_stack_metadata_association', 'call_stack_id'),
+               ('sqlstatements', 'sql_statements', 'sql_string_id', 'sql_statement_metadata_association', 'sql_statement_id'),
+               ('fileaccesses', 'file_accesses', 'file_name_id', 'file_access_metadata_association', 'file_access_id')]
+
+backfill_sql = """
+INSERT INTO stat_rollups (stat_type, resolution, bucket, name_id, metadata_key, metadata_ids, count, total, min, max)
+SELECT '{0}', r.resolution, (floor(s.datetime / r.resolution) * r.resolution)::integer, s.{2},
+       coalesce(m.metadata_key, ''), coalesce(m.metadata_ids, '{{}}'),
+       count(*), sum(s.duration), min(s.duration), max(s.duration)
+FROM {1} s
+CROSS JOIN (VALUES (60), (3600)) AS r(resolution)
+LEFT JOIN LATERAL (
+    SELECT array_to_string(array_agg(a.metadata_id ORDER BY a.metadata_id), ',') AS metadata_key,
+           array_agg(a.metadata_id ORDER BY a.metadata_id) AS metadata_ids
+    FROM {3} a WHERE a.{4} = s.id
+) m ON true
+WHERE s.{2} IS NOT NULL AND s.datetime IS NOT NULL AND s.duration IS NOT NULL
+GROUP BY 2, 3, 4, 5, 6
+"""
+
+
+def upgrade():
+    op.create_table(
+                    'stat_rollups',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('stat_type', sa.String),
+                    sa.Column('resolution', sa.Integer),
+                    sa.Column('bucket', sa.Integer),
+                    sa.Column('name_id', sa.Integer),
+                    sa.Column('metadata_key', sa.String),
+                    sa.Column('metadata_ids', ARRAY(sa.Integer)),
+                    sa.Column('count', sa.Integer),
+                    sa.Column('total', sa.Float),
+                    sa.Column('min', sa.Float),
+                    sa.Column('max', sa.Float),
+                    sa.UniqueConstraint('stat_type', 'resolution', 'bucket', 'name_id', 'metadata_key', name='_stat_rollup_uc')
+                    )
+    op.execute('CREATE INDEX ix_stat_rollups_metadata_ids ON stat_rollups USING gin (metadata_ids)')
+
+    # Roll up everything ingested so far
+    for stat_table in stat_tables:
+        op.execute(backfill_sql.format(*stat_table))
+
+def downgrade():
+    op.drop_index('ix_stat_rollups_metadata_ids', 'stat_rollups')
+    op.drop_table('stat_rollups')
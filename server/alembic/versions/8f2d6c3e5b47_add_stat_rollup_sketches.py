@@ -0,0 +1,65 @@
+"""add stat rollup sketches
+
+Revision ID: 8f2d6c3e5b47
+Revises: 7e1b5c2d4a36
+Create Date: 2026-10-18 15:20:41.472000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f2d6c3e5b47'
+down_revision = '7e1b5c2d4a36'
+
+from alembic import op
+import sqlalchemy as sa
+import sketches
+
+
+# stat type, raw table, name id column, metadata association table, association's stat id column
+stat_tables = [('callstacks', 'call_stacks', 'call_stack_name_id', 'call_stack_metadata_association', 'call_stack_id'),
+               ('sqlstatements', 'sql_statements', 'sql_string_id', 'sql_statement_metadata_association', 'sql_statement_id'),
+               ('fileaccesses', 'file_accesses', 'file_name_id', 'file_access_metadata_association', 'file_access_id')]
+
+# the histogram bucket counts of every rollup, as stat_rollups was backfilled
+histogram_sql = """
+SELECT r.resolution, (floor(s.datetime / r.resolution) * r.resolution)::integer, s.{2},
+       coalesce(m.metadata_key, ''),
+       ceil(ln(greatest(s.duration, {5})) / {6})::integer, count(*)
+FROM {1} s
+CROSS JOIN (VALUES (60), (3600)) AS r(resolution)
+LEFT JOIN LATERAL (
+    SELECT array_to_string(array_agg(a.metadata_id ORDER BY a.metadata_id), ',') AS metadata_key
+    FROM {3} a WHERE a.{4} = s.id
+) m ON true
+WHERE s.{2} IS NOT NULL AND s.datetime IS NOT NULL AND s.duration IS NOT NULL
+GROUP BY 1, 2, 3, 4, 5
+ORDER BY 1, 2, 3, 4
+"""
+
+update_sql = sa.text('UPDATE stat_rollups SET sketch = :sketch WHERE stat_type = :stat_type AND resolution = :resolution '
+                     'AND bucket = :bucket AND name_id = :name_id AND metadata_key = :metadata_key',
+                     bindparams=[sa.bindparam('sketch', type_=sa.LargeBinary)])
+
+
+def upgrade():
+    op.add_column('stat_rollups', sa.Column('sketch', sa.LargeBinary))
+
+    # Sketch the durations already rolled up
+    connection = op.get_bind()
+    for stat_table in stat_tables:
+        stat_type = stat_table[0]
+        key, sketch = None, None
+        rows = connection.execute(histogram_sql.format(*(stat_table + (sketches.MIN_VALUE, sketches.LOG_GAMMA))))
+        for resolution, bucket, name_id, metadata_key, index, count in rows:
+            if (resolution, bucket, name_id, metadata_key) != key:
+                if key:
+                    connection.execute(update_sql, sketch=sketch.to_bytes(), stat_type=stat_type, resolution=key[0],
+                                       bucket=key[1], name_id=key[2], metadata_key=key[3])
+                key, sketch = (resolution, bucket, name_id, metadata_key), sketches.LogHistogram()
+            sketch.add_bucket(index, count)
+        if key:
+            connection.execute(update_sql, sketch=sketch.to_bytes(), stat_type=stat_type, resolution=key[0],
+                               bucket=key[1], name_id=key[2], metadata_key=key[3])
+
+def downgrade():
+    op.drop_column('stat_rollups', 'sketch')
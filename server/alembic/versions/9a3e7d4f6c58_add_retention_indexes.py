@@ -0,0 +1,26 @@
+"""add retention indexes
+
+Revision ID: 9a3e7d4f6c58
+Revises: 8f2d6c3e5b47
+Create Date: 2026-10-18 16:05:12.318000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9a3e7d4f6c58'
+down_revision = '8f2d6c3e5b47'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_call_stacks_datetime', 'call_stacks', ['datetime'])
+    op.create_index('ix_call_stacks_pstat_uuid', 'call_stacks', ['pstat_uuid'])
+    op.create_index('ix_sql_statements_datetime', 'sql_statements', ['datetime'])
+    op.create_index('ix_file_accesses_datetime', 'file_accesses', ['datetime'])
+
+def downgrade():
+    op.drop_index('ix_file_accesses_datetime', 'file_accesses')
+    op.drop_index('ix_sql_statements_datetime', 'sql_statements')
+    op.drop_index('ix_call_stacks_pstat_uuid', 'call_stacks')
+    op.drop_index('ix_call_stacks_datetime', 'call_stacks')
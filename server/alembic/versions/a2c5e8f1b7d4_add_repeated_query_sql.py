@@ -0,0 +1,39 @@
+"""add repeated query sql
+
+Revision ID: a2c5e8f1b7d4
+Revises: f1a4c7e9d2b3
+Create Date: 2026-10-19 14:02:51.406000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a2c5e8f1b7d4'
+down_revision = 'f1a4c7e9d2b3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# SQL strings only ever seen as a repeated query's example, with no statements, rollups
+# or anomalies of their own
+repeat_only_sql_strings = """
+SELECT s.id FROM sql_strings s
+WHERE EXISTS (SELECT 1 FROM repeated_queries r WHERE r.sql_string_id = s.id)
+AND NOT EXISTS (SELECT 1 FROM sql_statements t WHERE t.sql_string_id = s.id)
+AND NOT EXISTS (SELECT 1 FROM stat_rollups u WHERE u.stat_type = 'sqlstatements' AND u.name_id = s.id)
+AND NOT EXISTS (SELECT 1 FROM anomalies a WHERE a.stat_type = 'sqlstatements' AND a.name_id = s.id)
+"""
+
+
+def upgrade():
+    op.add_column('repeated_queries', sa.Column('sql', sa.String))
+    op.execute('UPDATE repeated_queries r SET sql = s.sql FROM sql_strings s WHERE r.sql_string_id = s.id')
+
+    # drop the SQL strings repeated queries added, they were never run as statements
+    op.execute('CREATE TEMPORARY TABLE repeat_only_sql_strings ON COMMIT DROP AS ' + repeat_only_sql_strings)
+    op.execute('UPDATE repeated_queries SET sql_string_id = NULL '
+               'WHERE sql_string_id IN (SELECT id FROM repeat_only_sql_strings)')
+    op.execute('DELETE FROM sql_strings WHERE id IN (SELECT id FROM repeat_only_sql_strings)')
+
+def downgrade():
+    op.drop_column('repeated_queries', 'sql')
@@ -0,0 +1,102 @@
+"""add metadata sets
+
+Revision ID: a4b8e5f7d069
+Revises: 9a3e7d4f6c58
+Create Date: 2026-10-18 17:12:09.561000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4b8e5f7d069'
+down_revision = '9a3e7d4f6c58'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+
+# raw table, metadata association table, association's stat id column
+stat_tables = [('call_stacks', 'call_stack_metadata_association', 'call_stack_id'),
+               ('sql_statements', 'sql_statement_metadata_association', 'sql_statement_id'),
+               ('file_accesses', 'file_access_metadata_association', 'file_access_id')]
+
+# the hash matches database.metadata_set_hash, pairs sorted bytewise as Python sorts them
+pairs_sql = """
+    SELECT array_agg(mi.id ORDER BY mi.id) AS metadata_ids,
+           md5(coalesce(string_agg(mi.key || '=' || coalesce(mi.value, ''), E'\\n'
+                                   ORDER BY mi.key COLLATE "C", coalesce(mi.value, '') COLLATE "C"), '')) AS hash
+    FROM metadata_items mi
+"""
+
+backfill_sql = """
+CREATE TEMPORARY TABLE row_metadata_sets AS
+SELECT s.id, m.hash, coalesce(m.metadata_ids, '{{}}') AS metadata_ids
+FROM {0} s
+CROSS JOIN LATERAL ({3} JOIN {1} a ON a.metadata_id = mi.id WHERE a.{2} = s.id) m;
+
+INSERT INTO metadata_sets (hash, metadata_ids)
+SELECT DISTINCT ON (hash) hash, metadata_ids FROM row_metadata_sets
+ON CONFLICT (hash) DO NOTHING;
+
+UPDATE {0} s SET metadata_set_id = ms.id
+FROM row_metadata_sets r JOIN metadata_sets ms ON ms.hash = r.hash
+WHERE s.id = r.id;
+
+DROP TABLE row_metadata_sets;
+"""
+
+# rollups may outlive the raw rows of their metadata combination
+rollup_sets_sql = """
+INSERT INTO metadata_sets (hash, metadata_ids)
+SELECT m.hash, coalesce(m.metadata_ids, '{{}}')
+FROM (SELECT DISTINCT metadata_ids FROM stat_rollups) r
+CROSS JOIN LATERAL ({0} WHERE mi.id = ANY(r.metadata_ids)) m
+ON CONFLICT (hash) DO NOTHING;
+
+UPDATE stat_rollups r SET metadata_set_id = ms.id
+FROM metadata_sets ms
+WHERE array_to_string(ms.metadata_ids, ',') = r.metadata_key;
+"""
+
+
+def upgrade():
+    op.create_table(
+                    'metadata_sets',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('hash', sa.String, unique=True),
+                    sa.Column('metadata_ids', ARRAY(sa.Integer))
+                    )
+    op.execute('CREATE INDEX ix_metadata_sets_metadata_ids ON metadata_sets USING gin (metadata_ids)')
+
+    for table, association_table, stat_id_column in stat_tables:
+        op.add_column(table, sa.Column('metadata_set_id', sa.Integer, sa.ForeignKey('metadata_sets.id')))
+        op.execute(backfill_sql.format(table, association_table, stat_id_column, pairs_sql))
+        op.create_index('ix_{0}_metadata_set_id'.format(table), table, ['metadata_set_id'])
+
+    # Rollups are keyed by metadata set rather than their sorted metadata ids
+    op.add_column('stat_rollups', sa.Column('metadata_set_id', sa.Integer))
+    op.execute(rollup_sets_sql.format(pairs_sql))
+    op.drop_constraint('_stat_rollup_uc', 'stat_rollups')
+    op.drop_index('ix_stat_rollups_metadata_ids', 'stat_rollups')
+    op.drop_column('stat_rollups', 'metadata_key')
+    op.drop_column('stat_rollups', 'metadata_ids')
+    op.create_unique_constraint('_stat_rollup_uc', 'stat_rollups',
+                                ['stat_type', 'resolution', 'bucket', 'name_id', 'metadata_set_id'])
+
+def downgrade():
+    op.drop_constraint('_stat_rollup_uc', 'stat_rollups')
+    op.add_column('stat_rollups', sa.Column('metadata_key', sa.String))
+    op.add_column('stat_rollups', sa.Column('metadata_ids', ARRAY(sa.Integer)))
+    op.execute('UPDATE stat_rollups r SET metadata_ids = ms.metadata_ids, '
+               "metadata_key = array_to_string(ms.metadata_ids, ',') "
+               'FROM metadata_sets ms WHERE ms.id = r.metadata_set_id')
+    op.drop_column('stat_rollups', 'metadata_set_id')
+    op.execute('CREATE INDEX ix_stat_rollups_metadata_ids ON stat_rollups USING gin (metadata_ids)')
+    op.create_unique_constraint('_stat_rollup_uc', 'stat_rollups',
+                                ['stat_type', 'resolution', 'bucket', 'name_id', 'metadata_key'])
+
+    for table, association_table, stat_id_column in reversed(stat_tables):
+        op.drop_index('ix_{0}_metadata_set_id'.format(table), table)
+        op.drop_column(table, 'metadata_set_id')
+    op.drop_index('ix_metadata_sets_metadata_ids', 'metadata_sets')
+    op.drop_table('metadata_sets')
@@ -0,0 +1,26 @@
+"""add generation sequences
+
+Revision ID: b5c9f6a8e17a
+Revises: a4b8e5f7d069
+Create Date: 2026-10-18 18:03:27.904000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5c9f6a8e17a'
+down_revision = 'a4b8e5f7d069'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+stat_types = ('callstacks', 'sqlstatements', 'fileaccesses')
+
+
+def upgrade():
+    for stat_type in stat_types:
+        op.execute(sa.schema.CreateSequence(sa.Sequence('{0}_generation'.format(stat_type))))
+
+def downgrade():
+    for stat_type in stat_types:
+        op.execute(sa.schema.DropSequence(sa.Sequence('{0}_generation'.format(stat_type))))
@@ -0,0 +1,35 @@
+"""add search indexes
+
+Revision ID: c6d0a7b9f28b
+Revises: b5c9f6a8e17a
+Create Date: 2026-10-18 19:26:48.113000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c6d0a7b9f28b'
+down_revision = 'b5c9f6a8e17a'
+
+from alembic import op
+
+
+trigram_indexes = [('sql_strings', 'sql'),
+                   ('file_names', 'filename'),
+                   ('call_stack_names', 'module_name'),
+                   ('call_stack_names', 'class_name'),
+                   ('call_stack_names', 'fn_name')]
+
+# must match database.sql_search_vector for the index to be used
+sql_search_vector = "to_tsvector('simple', regexp_replace(sql, '[^[:alnum:]_]+', ' ', 'g'))"
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table_name, column_name in trigram_indexes:
+        op.execute('CREATE INDEX ix_{0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'.format(table_name, column_name))
+    op.execute('CREATE INDEX ix_sql_strings_sql_tsvector ON sql_strings USING gin (({0}))'.format(sql_search_vector))
+
+def downgrade():
+    op.drop_index('ix_sql_strings_sql_tsvector', 'sql_strings')
+    for table_name, column_name in reversed(trigram_indexes):
+        op.drop_index('ix_{0}_{1}_trgm'.format(table_name, column_name), table_name)
@@ -0,0 +1,36 @@
+"""add anomalies
+
+Revision ID: d7e1b8c0a39c
+Revises: c6d0a7b9f28b
+Create Date: 2026-10-18 21:12:05.640000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7e1b8c0a39c'
+down_revision = 'c6d0a7b9f28b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+                    'anomalies',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('stat_type', sa.String),
+                    sa.Column('name_id', sa.Integer),
+                    sa.Column('kind', sa.String),
+                    sa.Column('detected', sa.Float),
+                    sa.Column('window_start', sa.Integer),
+                    sa.Column('window_end', sa.Integer),
+                    sa.Column('value', sa.Float),
+                    sa.Column('baseline', sa.Float),
+                    sa.Column('deviation', sa.Float),
+                    sa.Column('score', sa.Float)
+                   )
+    op.create_index('ix_anomalies_stat_type_window_end', 'anomalies', ['stat_type', 'window_end'])
+
+def downgrade():
+    op.drop_index('ix_anomalies_stat_type_window_end', 'anomalies')
+    op.drop_table('anomalies')
@@ -0,0 +1,39 @@
+"""add repeated queries
+
+Revision ID: e8f2c9d1b4ad
+Revises: d7e1b8c0a39c
+Create Date: 2026-10-18 23:41:27.310000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e8f2c9d1b4ad'
+down_revision = 'd7e1b8c0a39c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+                    'repeated_queries',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('call_stack_id', sa.Integer, sa.ForeignKey('call_stacks.id')),
+                    sa.Column('call_stack_name_id', sa.Integer, sa.ForeignKey('call_stack_names.id')),
+                    sa.Column('sql_string_id', sa.Integer, sa.ForeignKey('sql_strings.id')),
+                    sa.Column('fingerprint', sa.String),
+                    sa.Column('call_site', sa.String),
+                    sa.Column('datetime', sa.Float),
+                    sa.Column('count', sa.Integer),
+                    sa.Column('duration', sa.Float),
+                    sa.Column('wasted', sa.Float)
+                   )
+    op.create_index('ix_repeated_queries_name_datetime', 'repeated_queries', ['call_stack_name_id', 'datetime'])
+    op.create_index('ix_repeated_queries_datetime', 'repeated_queries', ['datetime'])
+    op.create_index('ix_repeated_queries_call_stack_id', 'repeated_queries', ['call_stack_id'])
+
+def downgrade():
+    op.drop_index('ix_repeated_queries_call_stack_id', 'repeated_queries')
+    op.drop_index('ix_repeated_queries_datetime', 'repeated_queries')
+    op.drop_index('ix_repeated_queries_name_datetime', 'repeated_queries')
+    op.drop_table('repeated_queries')
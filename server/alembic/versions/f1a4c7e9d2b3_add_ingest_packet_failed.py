@@ -0,0 +1,27 @@
+"""add ingest packet failed
+
+Revision ID: f1a4c7e9d2b3
+Revises: e8f2c9d1b4ad
+Create Date: 2026-10-19 10:26:03.118000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f1a4c7e9d2b3'
+down_revision = 'e8f2c9d1b4ad'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('ingest_packets', sa.Column('failed', sa.Boolean, server_default='false'))
+    # packets which used up the default ingest_max_attempts
+    op.execute('UPDATE ingest_packets SET failed = attempts >= 5')
+    op.drop_index('ix_ingest_packets_attempts_id', 'ingest_packets')
+    op.create_index('ix_ingest_packets_failed_id', 'ingest_packets', ['failed', 'id'])
+
+def downgrade():
+    op.drop_index('ix_ingest_packets_failed_id', 'ingest_packets')
+    op.create_index('ix_ingest_packets_attempts_id', 'ingest_packets', ['attempts', 'id'])
+    op.drop_column('ingest_packets', 'failed')
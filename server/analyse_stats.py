@@ -1,14 +1,19 @@
-import pstats
-import os
-import json
+import pstat_store
 
 
 def load(uuid):
-    stats = pstats.Stats(os.path.join('pstats',uuid))
+    stats = pstat_store.load_stats(uuid)
     stats.calc_callees()
-    stats.sort_stats('cum')
+    stats.sort_stats('cumulative')
     return stats
 
+def call_graph(stats):
+    '''The stats and callees of a pstats.Stats object in a JSON serialisable dictionary.'''
+    stats.calc_callees()
+    callees = keys_to_str(stats.all_callees)
+    total_tt = stats.total_tt
+    return {'stats':keys_to_str(stats.stats),'callees':callees,'total_tt':total_tt}
+
 def keys_to_str(dictionary):
     for key in dictionary.keys():
         str_key = to_str(key)
@@ -19,27 +24,160 @@ def keys_to_str(dictionary):
             keys_to_str(dictionary[str_key][4])
     return dictionary
 
-def to_str(tup):
-    if tup[0]=='~' and tup[1]==0:
-        return tup[2]
+# the index of each sort in a stats entry (call count, primitive call count, tottime, cumtime, callers)
+call_graph_sorts = {'tottime': 2, 'cumtime': 3}
+
+def prune_call_graph(graph, threshold=0, top=None, sort='cumtime', depth=None, root=None):
+    '''
+    Cuts a call graph (as call_graph returns) down to the part of the tree the call stack
+    page shows. Starting from the root functions, or the callees of root, callees taking
+    less than threshold percent of the total time are dropped, as are all but the top
+    (by sort) callees of each function, and the tree is only followed depth levels down.
+
+    The result lists its starting functions in roots and has stats only for the functions
+    kept, with their callers narrowed to those kept (and root). Functions whose callees
+    were not followed because of the depth are counted in truncated, callees dropped by
+    the threshold or top in omitted, so they can be fetched later with root.
+    '''
+    stats, callees, total_tt = graph['stats'], graph['callees'], graph['total_tt']
+    sort_index = call_graph_sorts[sort]
+    min_time = total_tt * threshold / 100.0
+
+    def keep(entries):
+        kept = sorted([(key, stat) for key, stat in entries if stat[3] >= min_time],
+                      key=lambda entry: entry[1][sort_index], reverse=True)
+        return kept[:top] if top else kept
+
+    if root is None:
+        starts = [(key, stat) for key, stat in stats.iteritems() if not stat[4] or key in stat[4]]
     else:
-        return '{0}::{1}::{2}'.format(tup[0],tup[1],tup[2])
+        starts = callees[root].items()
+    start_keys = [key for key, stat in keep(starts)]
+
+    pruned = {'total_tt': total_tt, 'roots': start_keys,
+              'stats': {}, 'callees': {}, 'truncated': {}, 'omitted': {}}
+    if root is not None:
+        pruned['callees'][root] = dict((key, callees[root][key]) for key in start_keys)
+        if len(start_keys) < len(starts):
+            pruned['omitted'][root] = len(starts) - len(start_keys)
 
+    level, level_depth = start_keys, 1
+    while level:
+        next_level = []
+        for key in level:
+            if key in pruned['stats']:
+                continue
+            pruned['stats'][key] = list(stats[key])
+            children = callees.get(key, {})
+            if depth is not None and level_depth >= depth:
+                if children:
+                    pruned['truncated'][key] = len(children)
+                continue
+            kept = keep(children.iteritems())
+            pruned['callees'][key] = dict(kept)
+            if len(kept) < len(children):
+                pruned['omitted'][key] = len(children) - len(kept)
+            next_level.extend(child for child, stat in kept)
+        level, level_depth = next_level, level_depth + 1
 
-def write_json(dictionary, uuid):
-    with open(os.path.join('pstats',uuid+'.json'),'w') as f:
-        f.write(json.dumps(dictionary))
+    included = set(pruned['stats'])
+    included.add(root)
+    for stat in pruned['stats'].itervalues():
+        stat[4] = dict((caller, call) for caller, call in stat[4].iteritems() if caller in included)
+    return pruned
 
+def frame_name(key):
+    """A call graph function key ("file::line::name") as a flame graph frame, "name (file:line)"."""
+    parts = key.split('::')
+    if len(parts) == 3:
+        key = '{2} ({0}:{1})'.format(*parts)
+    # semicolons separate frames in the folded format
+    return key.replace(';', ',')
 
+def folded_stacks(graph, min_fraction=0.001, max_depth=64, max_stacks=10000):
+    '''
+    Reconstructs the call paths of a call graph (as call_graph returns) in the folded stack
+    format of flame graphs, a "root;caller;function microseconds" line per path.
 
-if __name__ == '__main__':
+    pstats only keeps the totals of each caller and callee pair, so a function's time
+    under a path is its time called from the path's last function, shared in proportion
+    to how much of that function's cumulative time the path accounts for. A path is cut
+    off (the time of the callees left out counted as its last function's own time) when
+    it would recurse, go deeper than max_depth or take under min_fraction of the total
+    time, so there are at most max_depth / min_fraction paths. Only the max_stacks
+    longest running paths are returned.
+    '''
+    stats, callees = graph['stats'], graph['callees']
+    roots = [key for key, stat in stats.iteritems() if not stat[4]]
+    if not roots:
+        # everything is called from somewhere, e.g. a profile of one recursive function
+        roots = [key for key, stat in stats.iteritems() if key in stat[4]]
+    min_time = sum(stats[root][3] for root in roots) * min_fraction
 
-    for f in os.listdir('pstats'):
-        if '.' in f:
-            continue
-        stats = load(f)
-        callees = keys_to_str(stats.all_callees)
-        total_tt = stats.total_tt
-        stats = keys_to_str(stats.stats)
-        write_json({'stats':stats,'callees':callees,'total_tt':total_tt}, f)
-        exit(0)
+    folded = {}
+    work = [((root,), stats[root][3]) for root in roots]
+    while work:
+        path, path_time = work.pop()
+        key = path[-1]
+        cumtime = stats[key][3]
+        share = path_time / cumtime if cumtime else 0.0
+        children_time = 0.0
+        if len(path) < max_depth:
+            for callee, call in callees.get(key, {}).iteritems():
+                callee_time = call[3] * share
+                if callee in path or callee_time < min_time or callee not in stats:
+                    continue
+                work.append((path + (callee,), callee_time))
+                children_time += callee_time
+        own_time = path_time - children_time
+        if own_time > 0:
+            stack = ';'.join(frame_name(frame) for frame in path)
+            folded[stack] = folded.get(stack, 0) + own_time
+
+    lines = sorted(folded.iteritems(), key=lambda line: line[1], reverse=True)[:max_stacks]
+    return '\n'.join('{0} {1}'.format(stack, int(round(seconds * 1e6)))
+                      for stack, seconds in sorted(lines) if seconds >= 5e-7)
+
+def add_function_totals(totals, stats):
+    '''
+    Adds the call count, tottime and cumtime of each function of a pstats dictionary into
+    totals, a dictionary of function string -> [ncalls, tottime, cumtime]. Summed just as
+    pstats.Stats.add would, without keeping the callers.
+    '''
+    for function, stat in stats.iteritems():
+        key = to_str(function) if isinstance(function, tuple) else function
+        function_totals = totals.setdefault(key, [0, 0.0, 0.0])
+        function_totals[0] += stat[1]
+        function_totals[1] += stat[2]
+        function_totals[2] += stat[3]
+    return totals
+
+# the index of each diff sort in a function's totals
+diff_sorts = {'ncalls': 0, 'tottime': 1, 'cumtime': 2}
+
+def diff_function_totals(a_totals, a_count, b_totals, b_count, sort='tottime', limit=None):
+    '''
+    Compares the function totals of two sets of profiles, a_count and b_count profiles
+    each, per profile (i.e. per call of the call stack). Returns a row per function of
+    [function, a ncalls, b ncalls, ncalls delta, a tottime, b tottime, tottime delta,
+    a cumtime, b cumtime, cumtime delta], largest absolute delta of sort first.
+    '''
+    rows = []
+    for function in set(a_totals) | set(b_totals):
+        row = [function]
+        a_function = a_totals.get(function, (0, 0.0, 0.0))
+        b_function = b_totals.get(function, (0, 0.0, 0.0))
+        for index in xrange(3):
+            a_value = float(a_function[index]) / a_count if a_count else 0.0
+            b_value = float(b_function[index]) / b_count if b_count else 0.0
+            row += [a_value, b_value, b_value - a_value]
+        rows.append(row)
+    delta_index = 3 * diff_sorts[sort] + 3
+    rows.sort(key=lambda row: abs(row[delta_index]), reverse=True)
+    return rows[:limit] if limit else rows
+
+def to_str(tup):
+    if tup[0]=='~' and tup[1]==0:
+        return tup[2]
+    else:
+        return '{0}::{1}::{2}'.format(tup[0],tup[1],tup[2])
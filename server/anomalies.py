@@ -0,0 +1,221 @@
+"""
+Flags call stacks, SQL strings and file names whose recent latency or throughput is far
+outside their rolling baseline.
+
+Every anomaly_interval seconds the latest anomaly_window seconds of minute rollups are
+compared with the hourly rollups of the anomaly_baseline_days before it. For each name
+the baseline is the median and median absolute deviation (MAD) of its hourly average
+duration and hourly call count, all computed in one query with percentile_cont, so
+thousands of names are scored in a single pass over the rollups. A name is flagged when
+its recent value is more than anomaly_threshold scaled MADs from the median, its
+anomalies are stored in the anomalies table and, if anomaly_webhook_url is set, posted
+there as JSON.
+
+Only hours with calls count towards a name's baseline, and names with fewer than
+anomaly_min_points such hours are not scored.
+
+Runs every anomaly_interval seconds in the stats server (0 turns it off), or once with:
+
+    python anomalies.py
+"""
+import json
+import time
+import urllib2
+
+import cherrypy
+from cherrypy.process.plugins import Monitor
+import sqlalchemy
+
+import database as db
+import aggregate_json_ui
+
+
+# the MAD of normally distributed values times this estimates their standard deviation
+MAD_SCALE = 1.4826
+
+interval = 300
+window = 900
+# seconds left for ingestion to catch up before a minute is scored
+lag = 60
+baseline_days = 7
+threshold = 5.0
+# the least calls in the window (or expected in it, for a drop in throughput) to be flagged
+min_count = 20
+min_points = 24
+# the least spread assumed, as a fraction of the median, so very steady names are not flagged for tiny changes
+min_spread = 0.1
+keep_days = 30
+webhook_url = None
+webhook_timeout = 5
+
+last_run = {}
+
+
+def setup(cfg):
+    global interval, window, lag, baseline_days, threshold, min_count, min_points, min_spread
+    global keep_days, webhook_url, webhook_timeout
+    interval = int(cfg.get('anomaly_interval', 300))
+    window = int(cfg.get('anomaly_window', 900))
+    lag = int(cfg.get('anomaly_lag', 60))
+    baseline_days = float(cfg.get('anomaly_baseline_days', 7))
+    threshold = float(cfg.get('anomaly_threshold', 5))
+    min_count = int(cfg.get('anomaly_min_count', 20))
+    min_points = int(cfg.get('anomaly_min_points', 24))
+    min_spread = float(cfg.get('anomaly_min_spread', 0.1))
+    keep_days = float(cfg.get('anomaly_keep_days', 30))
+    webhook_url = cfg.get('anomaly_webhook_url') or None
+    webhook_timeout = float(cfg.get('anomaly_webhook_timeout', 5))
+
+def subscribe(engine=None):
+    """Runs the detector from a Monitor on the CherryPy engine, unless anomaly_interval is 0."""
+    if interval > 0:
+        Monitor(engine or cherrypy.engine, run, frequency=interval, name='Anomalies').subscribe()
+
+
+baseline_sql = """
+WITH baseline_buckets AS (
+    SELECT stat_type, name_id, bucket, sum(total) / sum(count) AS latency, sum(count) AS throughput
+    FROM stat_rollups
+    WHERE resolution = :baseline_resolution AND bucket >= :baseline_start AND bucket < :baseline_end
+    GROUP BY stat_type, name_id, bucket
+), medians AS (
+    SELECT stat_type, name_id, count(*) AS points,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY latency) AS latency_median,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY throughput) AS throughput_median
+    FROM baseline_buckets
+    GROUP BY stat_type, name_id
+    HAVING count(*) >= :min_points
+), deviations AS (
+    SELECT b.stat_type, b.name_id,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY abs(b.latency - m.latency_median)) AS latency_mad,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY abs(b.throughput - m.throughput_median)) AS throughput_mad
+    FROM baseline_buckets b JOIN medians m USING (stat_type, name_id)
+    GROUP BY b.stat_type, b.name_id
+), recent AS (
+    SELECT stat_type, name_id, sum(total) / sum(count) AS latency, sum(count) AS count
+    FROM stat_rollups
+    WHERE resolution = :recent_resolution AND bucket >= :window_start AND bucket < :window_end
+    GROUP BY stat_type, name_id
+)
+SELECT m.stat_type, m.name_id, m.latency_median, d.latency_mad, m.throughput_median, d.throughput_mad,
+       r.latency, coalesce(r.count, 0)
+FROM medians m
+JOIN deviations d USING (stat_type, name_id)
+LEFT JOIN recent r USING (stat_type, name_id)
+"""
+
+def score(value, median, mad):
+    """How many scaled MADs value is from median, the spread is at least min_spread of the median."""
+    spread = max(MAD_SCALE * mad, abs(median) * min_spread, 1e-9)
+    return (value - median) / spread
+
+def detect(db_session, window_start, window_end):
+    """
+    Scores every name with a baseline, returns a list of the flagged as
+    (stat_type, name_id, kind, value, baseline, deviation, score).
+    """
+    baseline_end = window_start // 3600 * 3600
+    rows = db_session.execute(sqlalchemy.text(baseline_sql),
+                              {'baseline_resolution': db.rollup_resolutions[-1],
+                               'baseline_start': baseline_end - int(baseline_days * 86400),
+                               'baseline_end': baseline_end,
+                               'min_points': min_points,
+                               'recent_resolution': db.rollup_resolutions[0],
+                               'window_start': window_start,
+                               'window_end': window_end}).fetchall()
+
+    flagged = []
+    hours = (window_end - window_start) / 3600.0
+    for stat_type, name_id, latency_median, latency_mad, throughput_median, throughput_mad, latency, count in rows:
+        if latency is not None and count >= min_count:
+            latency_score = score(latency, latency_median, latency_mad)
+            if latency_score >= threshold:
+                flagged.append((stat_type, name_id, 'latency', latency, latency_median, latency_mad, latency_score))
+
+        # calls per hour, comparable with the hourly baseline
+        throughput = count / hours
+        throughput_score = score(throughput, throughput_median, throughput_mad)
+        if ((throughput_score >= threshold and count >= min_count) or
+                (throughput_score <= -threshold and throughput_median * hours >= min_count)):
+            flagged.append((stat_type, name_id, 'throughput', throughput, throughput_median, throughput_mad, throughput_score))
+    return flagged
+
+def record(db_session, flagged, window_start, window_end, now):
+    """
+    Stores the flagged, extending any anomaly of the same name and kind flagged on the
+    previous run. Returns the newly recorded anomalies.
+    """
+    open_anomalies = {}
+    for anomaly in db_session.query(db.Anomaly).filter(db.Anomaly.window_end >= window_start - interval):
+        open_anomalies[(anomaly.stat_type, anomaly.name_id, anomaly.kind)] = anomaly
+
+    new_anomalies = []
+    for stat_type, name_id, kind, value, baseline, deviation, anomaly_score in flagged:
+        anomaly = open_anomalies.get((stat_type, name_id, kind))
+        if anomaly is not None:
+            anomaly.window_end = window_end
+            if abs(anomaly_score) > abs(anomaly.score):
+                anomaly.value, anomaly.score = value, anomaly_score
+            continue
+        anomaly = db.Anomaly(stat_type=stat_type, name_id=name_id, kind=kind, detected=now,
+                             window_start=window_start, window_end=window_end, value=value,
+                             baseline=baseline, deviation=deviation, score=anomaly_score)
+        db_session.add(anomaly)
+        new_anomalies.append(anomaly)
+    return new_anomalies
+
+def notify(anomalies):
+    """Posts anomalies, with their names, to the webhook as {"anomalies": [...]}."""
+    payload = []
+    for stat_type in db.generation_stat_types:
+        of_type = [anomaly for anomaly in anomalies if anomaly.stat_type == stat_type]
+        if of_type:
+            names = aggregate_json_ui.name_strings(aggregate_json_ui.stat_type_classes[stat_type],
+                                                   [anomaly.name_id for anomaly in of_type])
+            payload += [dict(anomaly.to_dict(), name=names.get(anomaly.name_id)) for anomaly in of_type]
+    request = urllib2.Request(webhook_url, json.dumps({'anomalies': payload}),
+                              {'Content-Type': 'application/json'})
+    urllib2.urlopen(request, timeout=webhook_timeout).close()
+
+
+def run():
+    """One pass of the detector, the results are kept in last_run."""
+    start = time.time()
+    window_end = int(start - lag) // 60 * 60
+    window_start = window_end - window
+    summary = {}
+    try:
+        db_session = db.session()
+        flagged = detect(db_session, window_start, window_end)
+        new_anomalies = record(db_session, flagged, window_start, window_end, start)
+        if keep_days > 0:
+            db_session.query(db.Anomaly).filter(db.Anomaly.window_end < start - keep_days * 86400) \
+                                        .delete(synchronize_session=False)
+        db_session.commit()
+        summary['flagged'] = len(flagged)
+        summary['new'] = len(new_anomalies)
+        if new_anomalies and webhook_url:
+            try:
+                notify(new_anomalies)
+            except Exception:
+                cherrypy.log('Anomaly webhook failed', traceback=True)
+                summary['webhook_failed'] = True
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        cherrypy.log('Anomaly detection failed', traceback=True)
+        summary['failed'] = True
+    summary['seconds'] = time.time() - start
+    last_run.clear()
+    last_run.update(summary)
+    cherrypy.log('Anomalies: {0}'.format(summary))
+    return summary
+
+
+if __name__ == '__main__':
+    from stats_server import load_config
+
+    cfg = load_config()
+    db.setup(cfg['database_username'], cfg['database_password'])
+    setup(cfg)
+    print run()
@@ -0,0 +1,102 @@
+"""
+Benchmarks the stat ingestion modes against the configured database.
+
+Synthetic packets are fed straight into the parse functions (bypassing the
+HTTP handlers and queue) with each ingest mode in turn and the throughput
+is reported in rows/sec, where rows are the stat rows plus their association
+rows. Run from the server directory with:
+
+    python benchmark_ingest.py [num_statements] [stack_depth]
+"""
+import sys
+import time
+import json
+import random
+import cProfile
+import cPickle
+
+import database as db
+import stat_handlers
+from stats_server import load_config
+
+
+def synthetic_metadata():
+    return {'product': 'benchmark',
+            'version': '0.0.1',
+            'ip_address': '127.0.0.1'}
+
+def synthetic_sql_packet(num_statements, stack_depth):
+    stats = []
+    for i in xrange(num_statements):
+        table = 'table_{0}'.format(i % 50)
+        stats.append({'datetime': time.time(),
+                      'duration': random.random() / 100,
+                      'sql_string': 'SELECT id, name FROM {0} WHERE id = ?'.format(table),
+                      'args': [str(random.randint(0, 1000))],
+                      'stack': [{'module': 'module_{0}.py'.format(depth % 20),
+                                 'function': 'function_{0}'.format(depth)}
+                                for depth in xrange(stack_depth)]})
+    return {'type': 'database', 'metadata': synthetic_metadata(), 'stats': stats}
+
+def synthetic_fn_packet(num_profiles):
+    profiler = cProfile.Profile()
+    profiler.runcall(json.dumps, range(1000))
+    profiler.create_stats()
+    pickled_stats = cPickle.dumps(profiler.stats)
+    stats = [{'datetime': time.time(),
+              'profile': pickled_stats,
+              'module': 'benchmark',
+              'class': None,
+              'function': 'handler_{0}'.format(i % 20)}
+             for i in xrange(num_profiles)]
+    return {'type': 'handler', 'metadata': synthetic_metadata(), 'stats': stats}
+
+def synthetic_file_packet(num_accesses):
+    stats = [{'datetime': time.time(),
+              'time_to_open': random.random() / 1000,
+              'duration': random.random() / 100,
+              'data_written': random.randint(0, 4096),
+              'mode': 'r',
+              'filename': '/tmp/file_{0}'.format(i % 100)}
+             for i in xrange(num_accesses)]
+    return {'type': 'file', 'metadata': synthetic_metadata(), 'stats': stats}
+
+
+def count_rows(packet):
+    """Number of rows a packet writes, used for rows/sec."""
+    num_metadata = len(packet['metadata'])
+    rows = 0
+    for profile in packet['stats']:
+        rows += 1 + num_metadata
+        rows += len(profile.get('args', [])) + len(profile.get('stack', []))
+    return rows
+
+def time_ingest(mode, parse_fn, packet_factory):
+    stat_handlers.ingest_mode = mode
+    packet = packet_factory()
+    rows = count_rows(packet)
+    start = time.time()
+    parse_fn(packet)
+    elapsed = time.time() - start
+    return rows, elapsed
+
+
+if __name__ == '__main__':
+    num_statements = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    stack_depth = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+    cfg = load_config()
+    db.setup(cfg['database_username'], cfg['database_password'])
+
+    benchmarks = [('sql', stat_handlers.parse_sql_packet,
+                   lambda: synthetic_sql_packet(num_statements, stack_depth)),
+                  ('function', stat_handlers.parse_fn_packet,
+                   lambda: synthetic_fn_packet(num_statements / 10)),
+                  ('file', stat_handlers.parse_file_packet,
+                   lambda: synthetic_file_packet(num_statements))]
+
+    print '{0:<10}{1:<8}{2:>10}{3:>12}{4:>14}'.format('packet', 'mode', 'rows', 'seconds', 'rows/sec')
+    for name, parse_fn, packet_factory in benchmarks:
+        for mode in ('orm', 'bulk'):
+            rows, elapsed = time_ingest(mode, parse_fn, packet_factory)
+            print '{0:<10}{1:<8}{2:>10}{3:>12.3f}{4:>14.0f}'.format(name, mode, rows, elapsed, rows / elapsed)
@@ -0,0 +1,302 @@
+"""
+A two tier cache of profiles' call graph JSON, gzip compressed.
+
+Profiles never change once written, so a call graph is only ever built once per uuid.
+The most recently viewed are kept in memory, and every graph built is written to
+pstats/callgraphs as <uuid>.json.gz. Once those files add up to more than the disk
+limit the least recently viewed are deleted (a read touches the file's modification
+time). The compressed bytes are served as they are to clients accepting gzip.
+
+Pruned views of a graph (analyse_stats.prune_call_graph) and its folded stacks for
+flame graphs (analyse_stats.folded_stacks) are cached in memory too, along with the
+last few full graphs they were cut from, parsed.
+
+Run from the server directory, this builds the graph of every profile not yet cached
+ahead of time (see precompute), stopping once the disk limit is reached:
+
+    python call_graph_cache.py [--workers N] [--limit N]
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import tempfile
+import multiprocessing
+from StringIO import StringIO
+from threading import Lock
+
+import analyse_stats as a
+import pstat_store
+from lru_cache import LRUCache
+
+
+EXTENSION = '.json.gz'
+
+
+class CallGraphCache(object):
+
+    def __init__(self, directory=os.path.join('pstats', 'callgraphs'), memory_size=100, disk_size=512 * 1024 * 1024,
+                 view_size=1000):
+        self.directory = directory
+        self.memory = LRUCache(memory_size)
+        self.views = LRUCache(view_size)
+        self.parsed = LRUCache(4)
+        self.disk_size = disk_size
+        self._disk_usage = None
+        self._disk_lock = Lock()
+
+    def path(self, uuid):
+        return os.path.join(self.directory, str(uuid) + EXTENSION)
+
+    def get(self, uuid):
+        """The gzipped call graph JSON of a profile, building it if it is not cached."""
+        uuid = str(uuid)
+        data = self.memory.get(uuid)
+        if data is not None:
+            return data
+        data = self._read(uuid)
+        if data is None:
+            data = compress(json.dumps(a.call_graph(a.load(uuid))))
+            self._write(uuid, data)
+        self.memory.set(uuid, data)
+        return data
+
+    def build(self, uuid):
+        """
+        Builds and writes a profile's call graph to the disk tier without evicting any
+        other graph to make room, returns its compressed size.
+        """
+        data = compress(json.dumps(a.call_graph(a.load(uuid))))
+        self._write(str(uuid), data, evict=False)
+        return len(data)
+
+    def get_pruned(self, uuid, **options):
+        """The gzipped JSON of a profile's call graph pruned by analyse_stats.prune_call_graph."""
+        return self._view(uuid, 'pruned', lambda graph: json.dumps(a.prune_call_graph(graph, **options)), options)
+
+    def get_folded(self, uuid, **options):
+        """The gzipped folded stacks of a profile, from analyse_stats.folded_stacks."""
+        return self._view(uuid, 'folded', lambda graph: a.folded_stacks(graph, **options), options)
+
+    def _view(self, uuid, kind, build, options):
+        uuid = str(uuid)
+        key = (uuid, kind, tuple(sorted(options.items())))
+        data = self.views.get(key)
+        if data is not None:
+            return data
+        graph = self.parsed.get(uuid)
+        if graph is None:
+            graph = json.loads(decompress(self.get(uuid)))
+            self.parsed.set(uuid, graph)
+        data = compress(build(graph))
+        self.views.set(key, data)
+        return data
+
+    def __contains__(self, uuid):
+        return str(uuid) in self.memory or os.path.isfile(self.path(uuid))
+
+    def _read(self, uuid):
+        path = self.path(uuid)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mark as recently used for eviction
+            os.utime(path, None)
+            return data
+        except (IOError, OSError):
+            return None
+
+    def _write(self, uuid, data, evict=True):
+        if self.disk_size <= 0:
+            return
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another thread or process
+                pass
+        # written to a temporary file and renamed, so readers never see part of a graph
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.rename(temporary_path, self.path(uuid))
+
+        with self._disk_lock:
+            if self._disk_usage is None:
+                self._disk_usage = self._scan_usage()
+            else:
+                self._disk_usage += len(data)
+            if evict and self._disk_usage > self.disk_size:
+                self._disk_usage = self._evict()
+
+    def _files(self):
+        """(modification time, size, path) of every cached graph on disk."""
+        files = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(EXTENSION):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _scan_usage(self):
+        if not os.path.isdir(self.directory):
+            return 0
+        return sum(size for mtime, size, path in self._files())
+
+    def _evict(self):
+        """Deletes the least recently used graphs until the disk tier is under 90% of its limit."""
+        files = sorted(self._files())
+        usage = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if usage <= self.disk_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            usage -= size
+        return usage
+
+    def remove(self, uuid):
+        """Drops a profile's graph from both tiers, e.g. once the profile has expired."""
+        uuid = str(uuid)
+        self.memory.delete(uuid)
+        self.parsed.delete(uuid)
+        try:
+            os.remove(self.path(uuid))
+        except OSError:
+            return False
+        return True
+
+    def uuids(self):
+        """The uuids of every graph cached on disk."""
+        if not os.path.isdir(self.directory):
+            return []
+        return [filename[:-len(EXTENSION)] for filename in os.listdir(self.directory)
+                if filename.endswith(EXTENSION)]
+
+
+def compress(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+cache = CallGraphCache()
+
+def setup(cfg, root='pstats'):
+    global cache
+    cache = CallGraphCache(os.path.join(root, 'callgraphs'),
+                           int(cfg.get('call_graph_cache_size', 100)),
+                           int(cfg.get('call_graph_cache_disk_mb', 512)) * 1024 * 1024,
+                           int(cfg.get('call_graph_view_cache_size', 1000)))
+
+
+def init_precompute_worker(cfg):
+    pstat_store.setup('pstats', int(cfg.get('pstats_segment_size_mb', 256)) * 1024 * 1024)
+    setup(cfg)
+    # each graph is only built once, there is no point holding it in the worker
+    cache.memory.resize(0)
+
+def precompute_call_graph(uuid):
+    """Builds and caches a profile's call graph, returns (uuid, compressed size, error message or None)."""
+    try:
+        return uuid, cache.build(uuid), None
+    except Exception as e:
+        return uuid, 0, '{0}: {1}'.format(type(e).__name__, e)
+
+def precompute(cfg, workers, limit=None, report_every=10):
+    """
+    Builds the cached call graph of every profile in the store not already cached, over
+    a pool of worker processes. Graphs are written without evicting any, and building
+    stops once the disk tier reaches call_graph_cache_disk_mb, so the precompute never
+    throws away what it, or the server, has already built. Returns (built, skipped,
+    failed) counts.
+    """
+    init_precompute_worker(cfg)
+    uuids = pstat_store.store.uuids()
+    pending = [uuid for uuid in uuids if uuid not in cache]
+    skipped = len(uuids) - len(pending)
+    if limit:
+        pending = pending[:limit]
+    usage = cache._scan_usage()
+    if usage >= cache.disk_size:
+        print 'The call graph disk cache is full ({0:.1f} of {1:.1f} MB), nothing to build'.format(
+            usage / 1048576.0, cache.disk_size / 1048576.0)
+        return 0, skipped, 0
+    print '{0} profiles, {1} already cached, building {2} with {3} workers'.format(
+        len(uuids), skipped, len(pending), workers)
+
+    built = failed = 0
+    start = last_report = time.time()
+    pool = multiprocessing.Pool(workers, init_precompute_worker, (cfg,))
+    try:
+        for uuid, size, error in pool.imap_unordered(precompute_call_graph, pending, chunksize=16):
+            if error:
+                failed += 1
+                print 'Failed to build {0}: {1}'.format(uuid, error)
+            else:
+                built += 1
+                usage += size
+            if usage >= cache.disk_size:
+                # graphs already being built by other workers may still be written
+                print 'The call graph disk cache is full ({0:.1f} MB), stopping'.format(usage / 1048576.0)
+                pool.terminate()
+                break
+            if time.time() - last_report >= report_every:
+                last_report = time.time()
+                elapsed = last_report - start
+                print '{0}/{1} built ({2} failed), {3:.1f} profiles/s'.format(
+                    built + failed, len(pending), failed, (built + failed) / elapsed)
+        else:
+            pool.close()
+    except KeyboardInterrupt:
+        # anything already written is kept, a re-run carries on from there
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time() - start
+    print 'Finished in {0:.1f}s: {1} built, {2} already cached, {3} failed ({4:.1f} profiles/s)'.format(
+        elapsed, built, skipped, failed, (built + failed) / elapsed if elapsed else 0)
+    return built, skipped, failed
+
+
+if __name__ == '__main__':
+    import fcntl
+    import optparse
+    from stats_server import load_config
+
+    parser = optparse.OptionParser(usage='python call_graph_cache.py [options]',
+                                   description='Builds the cached call graph of every profile not yet cached.')
+    parser.add_option('-w', '--workers', type='int', help='worker processes, precompute_workers by default')
+    parser.add_option('-l', '--limit', type='int', help='build at most this many call graphs')
+    options, args = parser.parse_args()
+
+    cfg = load_config()
+    workers = options.workers or int(cfg.get('precompute_workers', 0)) or multiprocessing.cpu_count()
+
+    if not os.path.isdir('pstats'):
+        print 'No pstats directory, run from the server directory'
+        sys.exit(1)
+    # so runs from cron never overlap
+    lock_file = open(os.path.join('pstats', '.precompute.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print 'Another precompute is already running'
+        sys.exit(0)
+
+    built, skipped, failed = precompute(cfg, workers, options.limit)
+    sys.exit(1 if failed else 0)
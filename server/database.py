@@ -1,13 +1,14 @@
 import sqlalchemy
-from sqlalchemy import Table, Column, Integer, String, Float, ForeignKey, UniqueConstraint
+from sqlalchemy import Table, Column, Integer, String, Float, Boolean, ForeignKey, UniqueConstraint, LargeBinary, Index, Sequence
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship, composite
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects.postgresql import ARRAY
 from threading import Thread
 from sqlparse import tokens as sql_tokens, parse as parse_sql
-import os
 from collections import defaultdict
 from operator import attrgetter
-import pstats
+import hashlib
+import pstat_store
 from alembic.config import Config
 from alembic import command as al_command
 
@@ -60,9 +61,10 @@ class CallStack(Base):
     __tablename__ = 'call_stacks'
     id = Column(Integer, primary_key=True)
     call_stack_name_id = Column(Integer, ForeignKey('call_stack_names.id'))
-    datetime = Column(Float)
+    datetime = Column(Float, index=True)
     duration = Column(Float)
-    pstat_uuid = Column(String)
+    pstat_uuid = Column(String, index=True)
+    metadata_set_id = Column(Integer, ForeignKey('metadata_sets.id'), index=True)
 
     name = relationship('CallStackName', cascade='all', backref='call_stacks')
     metadata_items = relationship('MetaData', secondary=call_stack_metadata_association_table, cascade='all', backref='call_stacks')
@@ -83,7 +85,7 @@ class CallStack(Base):
         return dict(response.items() + self._metadata().items())
     
     def _stats(self):
-        return pstats.Stats(os.path.join(os.getcwd(),'pstats',self.pstat_uuid))
+        return pstat_store.load_stats(self.pstat_uuid)
 
     def _metadata(self):
         list_dict = defaultdict(list)
@@ -130,6 +132,112 @@ class CallStackName(Base):
         self.class_name = name_dict['class_name']
         self.fn_name = name_dict['fn_name']
 
+class ProfileFunction(Base):
+    '''An interned (file, line, name) function key from a pstats profile.'''
+    __tablename__ = 'profile_functions'
+    id = Column(Integer, primary_key=True)
+    filename = Column(String)
+    line = Column(Integer)
+    name = Column(String)
+
+    __table_args__ = (UniqueConstraint('filename', 'line', 'name', name='_profile_function_uc'),)
+
+    def __init__(self, function_dict):
+        self.filename = function_dict['filename']
+        self.line = function_dict['line']
+        self.name = function_dict['name']
+
+    def to_str(self):
+        # matches analyse_stats.to_str
+        if self.filename == '~' and self.line == 0:
+            return self.name
+        return '{0}::{1}::{2}'.format(self.filename, self.line, self.name)
+
+    def __repr__(self):
+        return 'ProfileFunction({0})'.format(self.to_str())
+
+
+class CallStackFunction(Base):
+    '''
+    One function's stats within a call stack's profile. The call stack's name and
+    datetime are copied here so "who calls X" and "what is inside Y" can be answered
+    from this table and its indexes alone.
+    '''
+    __tablename__ = 'call_stack_functions'
+    call_stack_id = Column(Integer, ForeignKey('call_stacks.id'), primary_key=True)
+    function_id = Column(Integer, ForeignKey('profile_functions.id'), primary_key=True)
+    call_stack_name_id = Column(Integer, ForeignKey('call_stack_names.id'))
+    datetime = Column(Float)
+    ncalls = Column(Integer)
+    primcalls = Column(Integer)
+    tottime = Column(Float)
+    cumtime = Column(Float)
+    caller_ids = Column(ARRAY(Integer))
+
+    function = relationship('ProfileFunction')
+
+    __table_args__ = (Index('ix_call_stack_functions_function_datetime', 'function_id', 'datetime'),
+                      Index('ix_call_stack_functions_name_datetime', 'call_stack_name_id', 'datetime'))
+
+class MergedProfile(Base):
+    '''
+    The profiles of a call stack name within an hour merged into one (as pstats.Stats.add
+    would), kept up to date during ingestion. stats is a zlib compressed marshalled
+    pstats dictionary.
+    '''
+    __tablename__ = 'merged_profiles'
+    call_stack_name_id = Column(Integer, ForeignKey('call_stack_names.id'), primary_key=True)
+    bucket = Column(Integer, primary_key=True) # start of the hour, seconds since the epoch
+    count = Column(Integer)
+    total_tt = Column(Float)
+    stats = Column(LargeBinary)
+
+    name = relationship('CallStackName')
+
+    def __repr__(self):
+        return 'MergedProfile({0}, {1!s})'.format(self.call_stack_name_id, self.bucket)
+
+class RepeatedQuery(Base):
+    '''
+    An SQL statement run over and over from the same call site within one handler
+    request, a suspected N+1 query loop. Statements are grouped by their SQL fingerprint,
+    sql is one of them as an example and sql_string_id its SQLString, if the statement
+    has also been recorded from an SQL packet. wasted is the time of every run but one
+    (at the average duration), what batching them into one query could save.
+    '''
+    __tablename__ = 'repeated_queries'
+    id = Column(Integer, primary_key=True)
+    call_stack_id = Column(Integer, ForeignKey('call_stacks.id'))
+    call_stack_name_id = Column(Integer, ForeignKey('call_stack_names.id'))
+    sql_string_id = Column(Integer, ForeignKey('sql_strings.id'))
+    sql = Column(String)
+    fingerprint = Column(String)
+    call_site = Column(String) # file:line:function of the innermost frame outside the database libraries
+    datetime = Column(Float)
+    count = Column(Integer)
+    duration = Column(Float)
+    wasted = Column(Float)
+
+    __table_args__ = (Index('ix_repeated_queries_name_datetime', 'call_stack_name_id', 'datetime'),
+                      Index('ix_repeated_queries_datetime', 'datetime'),
+                      Index('ix_repeated_queries_call_stack_id', 'call_stack_id'))
+
+    def to_dict(self):
+        return {'id': self.id,
+                'call_stack_id': self.call_stack_id,
+                'call_stack_name_id': self.call_stack_name_id,
+                'sql_string_id': self.sql_string_id,
+                'sql': self.sql,
+                'fingerprint': self.fingerprint,
+                'call_site': self.call_site,
+                'datetime': self.datetime,
+                'count': self.count,
+                'duration': self.duration,
+                'wasted': self.wasted}
+
+    def __repr__(self):
+        return 'RepeatedQuery({0}, {1}, {2!s})'.format(self.call_stack_id, self.call_site, self.count)
+
 #========================================#
 
 sql_statement_metadata_association_table = Table('sql_statement_metadata_association', Base.metadata,
@@ -141,8 +249,9 @@ class SQLStatement(Base):
     __tablename__ = 'sql_statements'
     id = Column(Integer, primary_key=True)
     sql_string_id = Column(Integer, ForeignKey('sql_strings.id'))
-    datetime = Column(Float)
+    datetime = Column(Float, index=True)
     duration = Column(Float)
+    metadata_set_id = Column(Integer, ForeignKey('metadata_sets.id'), index=True)
 
     sql_string = relationship('SQLString', cascade='all', backref='sql_statements')
     sql_stack_items = relationship('SQLStackAssociation', cascade='all', backref='sql_statements')
@@ -192,6 +301,10 @@ class SQLString(Base):
     __tablename__ = 'sql_strings'
     id = Column(Integer, primary_key=True)
     sql = Column(String, unique=True)
+    # Memoised analysis of the statement so each distinct sql is only parsed once
+    identifiers = Column(String) # JSON list
+    statement_type = Column(String)
+    fingerprint = Column(String, index=True)
 
     def __init__(self, sql):
         if type(sql)==dict:
@@ -226,7 +339,8 @@ class SQLStackItem(Base):
         self.module = stat['module']
 
     def to_dict(self):
-        return {'module':self.module,
+        return {'id':self.id,
+                'module':self.module,
                 'function':self.function}
 
     def __repr__(self):
@@ -268,10 +382,11 @@ class FileAccess(Base):
     id = Column(Integer, primary_key=True)
     file_name_id = Column(Integer, ForeignKey('file_names.id'))
     time_to_open = Column(Float)
-    datetime = Column(Float)
+    datetime = Column(Float, index=True)
     duration = Column(Float)
     data_written = Column(Integer)
     mode = Column(String)
+    metadata_set_id = Column(Integer, ForeignKey('metadata_sets.id'), index=True)
     
     filename = relationship('FileName', cascade='all', backref='file_accesses')
     metadata_items = relationship('MetaData', secondary=file_access_metadata_association_table, cascade='all', backref='file_accesses')
@@ -321,6 +436,24 @@ class FileName(Base):
 
 #========================================#
 
+# Search indexes. Trigram GIN indexes serve the aggregate pages' ILIKE '%term%' searches,
+# the full text index matches whole SQL tokens (keywords, table and column identifiers).
+sql_search_vector = "to_tsvector('simple', regexp_replace(sql, '[^[:alnum:]_]+', ' ', 'g'))"
+trigram_indexes = [('sql_strings', 'sql'),
+                   ('file_names', 'filename'),
+                   ('call_stack_names', 'module_name'),
+                   ('call_stack_names', 'class_name'),
+                   ('call_stack_names', 'fn_name')]
+
+sqlalchemy.event.listen(Base.metadata, 'before_create', sqlalchemy.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+for table_name, column_name in trigram_indexes:
+    sqlalchemy.event.listen(Base.metadata.tables[table_name], 'after_create', sqlalchemy.DDL(
+        'CREATE INDEX ix_{0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'.format(table_name, column_name)))
+sqlalchemy.event.listen(SQLString.__table__, 'after_create', sqlalchemy.DDL(
+    'CREATE INDEX ix_sql_strings_sql_tsvector ON sql_strings USING gin (({0}))'.format(sql_search_vector)))
+
+#========================================#
+
 class MetaData(Base):
     __tablename__ = 'metadata_items'
     id = Column(Integer, primary_key=True)
@@ -344,3 +477,147 @@ class MetaData(Base):
     def __repr__(self):
         return 'MetaData({0}={1})'.format(self.key,self.value)
 
+
+def metadata_set_hash(metadata_pairs):
+    '''
+    The hash identifying a combination of metadata, the md5 of its sorted "key=value"
+    pairs joined with newlines (computed the same way in SQL by the metadata_sets migration).
+    '''
+    pairs = sorted(set((unicode(key), u'' if value is None else unicode(value)) for key, value in metadata_pairs))
+    return hashlib.md5(u'\n'.join(u'{0}={1}'.format(key, value) for key, value in pairs).encode('utf-8')).hexdigest()
+
+class MetadataSet(Base):
+    '''
+    A distinct combination of metadata items. Each stat row references the set of all
+    its metadata, so filtering by metadata resolves the few matching sets and then
+    selects rows with metadata_set_id IN (...).
+    '''
+    __tablename__ = 'metadata_sets'
+    id = Column(Integer, primary_key=True)
+    hash = Column(String, unique=True)
+    metadata_ids = Column(ARRAY(Integer)) # sorted
+
+    __table_args__ = (Index('ix_metadata_sets_metadata_ids', 'metadata_ids', postgresql_using='gin'),)
+
+    def __init__(self, metadata_set):
+        self.hash = metadata_set['hash']
+        self.metadata_ids = metadata_set.get('metadata_ids')
+
+    def __repr__(self):
+        return 'MetadataSet({0})'.format(self.id)
+
+
+#========================================#
+
+# Seconds per bucket of each rollup resolution, finest first
+rollup_resolutions = (60, 3600)
+
+class StatRollup(Base):
+    '''
+    Pre-aggregated durations of a stat type's rows per name (call stack name, SQL string
+    or file name), per combination of metadata and per minute or hour bucket. Kept up to
+    date during ingestion so aggregate pages need not scan the raw rows, the sketch of
+    the durations lets percentiles be found by merging rollups.
+    '''
+    __tablename__ = 'stat_rollups'
+    id = Column(Integer, primary_key=True)
+    stat_type = Column(String) # callstacks, sqlstatements or fileaccesses
+    resolution = Column(Integer)
+    bucket = Column(Integer) # start of the bucket, seconds since the epoch
+    name_id = Column(Integer)
+    metadata_set_id = Column(Integer)
+    count = Column(Integer)
+    total = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+    sketch = Column(LargeBinary) # a packed sketches.LogHistogram of the durations
+
+    __table_args__ = (UniqueConstraint('stat_type', 'resolution', 'bucket', 'name_id', 'metadata_set_id', name='_stat_rollup_uc'),)
+
+    def __repr__(self):
+        return 'StatRollup({0}, {1}, {2!s})'.format(self.stat_type, self.name_id, self.bucket)
+
+class Anomaly(Base):
+    '''
+    A name (call stack name, SQL string or file name) whose recent latency or throughput
+    was flagged by anomalies.py as far outside its rolling baseline. An anomaly still
+    flagged on the next run is extended (window_end, and the worst value and score)
+    rather than recorded again.
+    '''
+    __tablename__ = 'anomalies'
+    id = Column(Integer, primary_key=True)
+    stat_type = Column(String)
+    name_id = Column(Integer)
+    kind = Column(String) # latency or throughput
+    detected = Column(Float)
+    window_start = Column(Integer)
+    window_end = Column(Integer)
+    value = Column(Float) # recent average duration, or calls per hour
+    baseline = Column(Float) # median of the baseline
+    deviation = Column(Float) # median absolute deviation of the baseline
+    score = Column(Float)
+
+    __table_args__ = (Index('ix_anomalies_stat_type_window_end', 'stat_type', 'window_end'),)
+
+    def to_dict(self):
+        return {'id': self.id,
+                'stat_type': self.stat_type,
+                'name_id': self.name_id,
+                'kind': self.kind,
+                'detected': self.detected,
+                'window_start': self.window_start,
+                'window_end': self.window_end,
+                'value': self.value,
+                'baseline': self.baseline,
+                'deviation': self.deviation,
+                'score': self.score}
+
+    def __repr__(self):
+        return 'Anomaly({0}, {1}, {2}, {3!s})'.format(self.stat_type, self.name_id, self.kind, self.window_end)
+
+#========================================#
+
+# A generation counter per stat type, bumped after every committed change to the type's
+# stats so results cached from an older generation can be recognised as stale. Sequences
+# rather than a counter row, so concurrent ingest workers never wait on each other.
+generation_stat_types = ('callstacks', 'sqlstatements', 'fileaccesses')
+generation_sequences = dict((stat_type, Sequence('{0}_generation'.format(stat_type), metadata=Base.metadata))
+                            for stat_type in generation_stat_types)
+
+def bump_generation(db_session, stat_type):
+    db_session.execute(sqlalchemy.text("SELECT nextval('{0}_generation')".format(stat_type)))
+
+def get_generation(db_session, stat_type):
+    last_value, is_called = db_session.execute(sqlalchemy.text(
+                                'SELECT last_value, is_called FROM {0}_generation'.format(stat_type))).first()
+    return last_value if is_called else 0
+
+#========================================#
+
+class IngestPacket(Base):
+    '''
+    A packet of stats accepted by the server but not yet ingested. Packets are claimed
+    by ingest workers with SELECT ... FOR UPDATE SKIP LOCKED and deleted in the same
+    transaction as they are ingested, so nothing accepted is lost on a restart. Packets
+    failing ingest_max_attempts times are marked failed and left for inspection.
+    '''
+    __tablename__ = 'ingest_packets'
+    id = Column(Integer, primary_key=True)
+    stat_type = Column(String)
+    received = Column(Float)
+    payload = Column(LargeBinary)
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    failed = Column(Boolean, default=False)
+
+    __table_args__ = (Index('ix_ingest_packets_failed_id', 'failed', 'id'),)
+
+    def __init__(self, stat_type, received, payload):
+        self.stat_type = stat_type
+        self.received = received
+        self.payload = payload
+        self.attempts = 0
+        self.failed = False
+
+    def __repr__(self):
+        return 'IngestPacket({0}, {1!s})'.format(self.stat_type, int(self.received))
@@ -0,0 +1,45 @@
+"""
+Stand alone ingest worker for the durable (ingest_queue = database) ingestion queue.
+
+Claims packets accepted by any stats server from the ingest_packets table and
+ingests them. Any number of these can be run, on any number of machines, against
+the same database. Run from the server directory with:
+
+    python ingest_worker.py [num_workers]
+"""
+import sys
+import time
+from threading import Thread
+
+import cherrypy
+
+import database as db
+import pstat_store
+import stat_handlers
+from stats_server import load_config
+
+
+if __name__ == '__main__':
+    cfg = load_config()
+    if len(sys.argv) > 1:
+        cfg['ingest_workers'] = sys.argv[1]
+
+    db.setup(cfg['database_username'], cfg['database_password'])
+    pstat_store.setup('pstats', int(cfg.get('pstats_segment_size_mb', 256)) * 1024 * 1024)
+    stat_handlers.setup(cfg, start_workers=False)
+
+    workers = []
+    for i in xrange(int(cfg.get('ingest_workers', 4))):
+        worker_thread = Thread(target=stat_handlers.database_worker, name='Ingest worker {0}'.format(i))
+        worker_thread.daemon = True
+        worker_thread.start()
+        workers.append(worker_thread)
+    cherrypy.log('Started {0} ingest workers'.format(len(workers)))
+
+    try:
+        while True:
+            time.sleep(60)
+            cherrypy.log('Ingest metrics: {0}'.format(stat_handlers.ingest_metrics.snapshot()))
+    except KeyboardInterrupt:
+        # workers are daemon threads, any packets mid-ingest are rolled back and claimed again later.
+        pass
@@ -1,61 +1,262 @@
 # import sqlalchemy
 import database as db
 import cherrypy
+from sqlalchemy.orm import joinedload, subqueryload, subqueryload_all
 # from sqlalchemy import or_, and_
 from cgi import escape as html_escape
 import re
-import os.path
 import json
+import types
+import hashlib
+from functools import wraps
 import analyse_stats as a
+import pstats
+import pstat_store
+import call_graph_cache
 
-def retrieve_pstat(uuid):
-    if not os.path.isfile(os.path.join('pstats',uuid+'.json')):
-        stats = a.load(uuid)
-        callees = a.keys_to_str(stats.all_callees)
-        total_tt = stats.total_tt
-        stats = a.keys_to_str(stats.stats)
-        response = {'stats':stats,'callees':callees,'total_tt':total_tt}
-        a.write_json(response, uuid)
-        return response
+
+# rows returned by a list request by default and at most, and rows loaded per query as they stream
+list_page_size = 1000
+list_max_limit = 100000
+list_batch_size = 500
+
+# the default analyse_stats.folded_stacks arguments of a flame graph, max_stacks is also the most allowed
+flame_graph_min_fraction = 0.001
+flame_graph_max_depth = 64
+flame_graph_max_stacks = 10000
+
+def setup(cfg):
+    global list_page_size, list_max_limit, list_batch_size
+    global flame_graph_min_fraction, flame_graph_max_depth, flame_graph_max_stacks
+    list_page_size = int(cfg.get('list_page_size', 1000))
+    list_max_limit = int(cfg.get('list_max_limit', 100000))
+    list_batch_size = int(cfg.get('list_batch_size', 500))
+    flame_graph_min_fraction = float(cfg.get('flame_graph_min_fraction', 0.001))
+    flame_graph_max_depth = int(cfg.get('flame_graph_max_depth', 64))
+    flame_graph_max_stacks = int(cfg.get('flame_graph_max_stacks', 10000))
+
+# the relationships each model's to_dict reads, loaded once per batch rather than once per row
+list_load_options = {
+    db.CallStack: [joinedload(db.CallStack.name),
+                   subqueryload(db.CallStack.metadata_items)],
+    db.SQLStatement: [joinedload(db.SQLStatement.sql_string),
+                      subqueryload(db.SQLStatement.metadata_items),
+                      subqueryload_all(db.SQLStatement.arguments, db.SQLArgAssociation.arg)],
+    db.FileAccess: [joinedload(db.FileAccess.filename),
+                    subqueryload(db.FileAccess.metadata_items)],
+    db.SQLStackItem: []
+}
+
+def list_items(model, after=None, limit=None):
+    '''
+    A generator of the to_dict of up to limit rows of a model with ids greater than after,
+    in id order. Pass the last id returned as after to fetch the next page, fewer than
+    limit rows means there are no more. Rows are read list_batch_size at a time, each
+    batch's relationships eagerly loaded, so memory use does not grow with the limit.
+    '''
+    try:
+        after = int(after or 0)
+        limit = min(int(limit or list_page_size), list_max_limit)
+    except ValueError:
+        raise cherrypy.HTTPError(400, 'after and limit must be integers')
+    if limit <= 0:
+        raise cherrypy.HTTPError(400, 'limit must be positive')
+
+    def generate(after, remaining):
+        try:
+            while remaining > 0:
+                batch = db.session.query(model).options(*list_load_options[model]) \
+                                               .filter(model.id > after) \
+                                               .order_by(model.id) \
+                                               .limit(min(list_batch_size, remaining)).all()
+                for item in batch:
+                    yield item.to_dict()
+                if len(batch) < list_batch_size:
+                    break
+                after = batch[-1].id
+                remaining -= len(batch)
+        finally:
+            db.session.commit()
+    return generate(after, limit)
+
+def stream_json_array(items):
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item)
+        separator = ','
+    yield ']'
+
+def json_list_out(handler):
+    '''
+    Like the json_out tool, but a generator returned by the handler (e.g. list_items) is
+    streamed as it is produced, as a JSON array or, with format=ndjson, an object per line.
+    '''
+    @wraps(handler)
+    def wrapped(*args, **kwargs):
+        response_format = kwargs.pop('format', None)
+        result = handler(*args, **kwargs)
+        if not isinstance(result, types.GeneratorType):
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json.dumps(result)
+        if response_format == 'ndjson':
+            cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+            return (json.dumps(item) + '\n' for item in result)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return stream_json_array(result)
+    wrapped._cp_config = {'response.stream': True}
+    return wrapped
+
+def call_graph_options(threshold=None, top=None, sort=None, depth=None, root=None):
+    '''The analyse_stats.prune_call_graph arguments of a call graph request, those given.'''
+    options = {}
+    try:
+        if threshold:
+            options['threshold'] = float(threshold)
+        if top:
+            options['top'] = int(top)
+        if depth:
+            options['depth'] = int(depth)
+    except ValueError:
+        raise cherrypy.HTTPError(400, 'threshold, top and depth must be numbers')
+    if sort:
+        if sort not in a.call_graph_sorts:
+            raise cherrypy.HTTPError(400, 'sort must be one of {0}'.format(', '.join(a.call_graph_sorts)))
+        options['sort'] = sort
+    if root:
+        options['root'] = root
+    return options
+
+def flame_graph_options(min_fraction=None, max_depth=None, max_stacks=None):
+    '''The analyse_stats.folded_stacks arguments of a flame graph request, defaulting to the configured.'''
+    try:
+        return {'min_fraction': float(min_fraction) if min_fraction else flame_graph_min_fraction,
+                'max_depth': int(max_depth) if max_depth else flame_graph_max_depth,
+                'max_stacks': min(int(max_stacks), flame_graph_max_stacks) if max_stacks else flame_graph_max_stacks}
+    except ValueError:
+        raise cherrypy.HTTPError(400, 'min_fraction, max_depth and max_stacks must be numbers')
+
+def serve_gzipped(etag, content_type, load, cache_control='public, max-age=31536000'):
+    '''
+    Serves the gzipped data load returns under an ETag, as it is to clients accepting gzip,
+    answering a matching If-None-Match with a 304 without loading anything. load raising
+    a KeyError (e.g. the profile has expired) is a 404.
+    '''
+    cherrypy.response.headers['ETag'] = etag
+    cherrypy.response.headers['Cache-Control'] = cache_control
+    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+    if etag in [tag.strip() for tag in cherrypy.request.headers.get('If-None-Match', '').split(',')]:
+        raise cherrypy.HTTPRedirect([], 304)
+    try:
+        data = load()
+    except KeyError:
+        raise cherrypy.NotFound
+    cherrypy.response.headers['Content-Type'] = content_type
+    if any(encoding.value == 'gzip' and encoding.qvalue > 0
+           for encoding in cherrypy.request.headers.elements('Accept-Encoding')):
+        cherrypy.response.headers['Content-Encoding'] = 'gzip'
+        return data
+    return call_graph_cache.decompress(data)
+
+def options_etag(uuid, options=None):
+    if options:
+        return '"{0}-{1}"'.format(uuid, hashlib.md5(repr(sorted(options.items()))).hexdigest())
+    return '"{0}"'.format(uuid)
+
+def serve_call_graph(uuid, options=None):
+    '''
+    Serves a profile's call graph JSON from the call graph cache, pruned if any options
+    are given, still gzipped for clients accepting gzip. Profiles never change once
+    written, so the uuid (and options) make a strong ETag and clients may keep the graph
+    for as long as they like. A root not in the graph is a 404, as is an expired profile.
+    '''
+    if options:
+        load = lambda: call_graph_cache.cache.get_pruned(uuid, **options)
     else:
-        with open(os.path.join('pstats',str(uuid)+'.json')) as f:
-            return json.load(f)
+        load = lambda: call_graph_cache.cache.get(uuid)
+    return serve_gzipped(options_etag(uuid, options), 'application/json', load)
 
+def serve_flame_graph(uuid, options):
+    '''Serves a profile's folded stacks (see analyse_stats.folded_stacks) as serve_call_graph serves its graph.'''
+    return serve_gzipped(options_etag(uuid, dict(options, format='folded')), 'text/plain',
+                         lambda: call_graph_cache.cache.get_folded(uuid, **options))
 
 
 class JSONAPI(object):
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
-    def callstacks(self, id=None, **kwargs):
+    @json_list_out
+    def callstacks(self, id=None, after=None, limit=None, **kwargs):
         if id:
             item = db.session.query(db.CallStack).get(id)
             if item:
                 response = item.to_dict()
-                stats_object = item._stats()
-                stats = stats_object.stats
-                response['stats_keys'] = [str(key) for key in stats.keys()]
-                response['stats_values'] = [str(val) for val in stats.values()]
+                # the whole profile, the call stack page reads the call graph instead
+                if kwargs.get('include_stats', 'true') != 'false':
+                    stats_object = item._stats()
+                    stats = stats_object.stats
+                    response['stats_keys'] = [str(key) for key in stats.keys()]
+                    response['stats_values'] = [str(val) for val in stats.values()]
                 return response
             else:
                 raise cherrypy.NotFound
         else:
-            results = db.session.query(db.CallStack)
-            return [item.to_dict() for item in results.all()]
+            return list_items(db.CallStack, after, limit)
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
-    def callstackitems(self, callstack_id):
+    def callstackitems(self, callstack_id, threshold=None, top=None, sort=None, depth=None, root=None):
+        '''
+        The call graph of a call stack's profile, in full, or pruned to the callees over
+        threshold percent of the total time, the top callees of each function by sort
+        (tottime or cumtime) and depth levels from the roots, or from root's callees.
+        '''
+        options = call_graph_options(threshold, top, sort, depth, root)
         callstack = db.session.query(db.CallStack).get(callstack_id)
         if not callstack:
             raise cherrypy.NotFound
         uuid = callstack.pstat_uuid
-        return retrieve_pstat(uuid)
+        return serve_call_graph(uuid, options)
+
+    @cherrypy.expose
+    def flamegraph(self, callstack_id, min_fraction=None, max_depth=None, max_stacks=None):
+        '''
+        The call paths of a call stack's profile in the folded stack format of flame graphs,
+        a "function;callee;callee microseconds" line per path, cut off as
+        analyse_stats.folded_stacks describes.
+        '''
+        options = flame_graph_options(min_fraction, max_depth, max_stacks)
+        callstack = db.session.query(db.CallStack).get(callstack_id)
+        if not callstack:
+            raise cherrypy.NotFound
+        return serve_flame_graph(callstack.pstat_uuid, options)
 
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
-    def sqlstatements(self, id=None, **kwargs):
+    def mergedprofile(self, id, start_date=None, end_date=None, **kwargs):
+        '''
+        The call graph of every profile of a call stack name merged together, built from
+        the hourly merged profiles overlapping start_date to end_date.
+        '''
+        query = db.session.query(db.MergedProfile).filter(db.MergedProfile.call_stack_name_id == id)
+        if start_date:
+            query = query.filter(db.MergedProfile.bucket > int(float(start_date)) - 3600)
+        if end_date:
+            query = query.filter(db.MergedProfile.bucket < int(float(end_date)))
+        merged_profiles = query.filter(db.MergedProfile.count > 0).all()
+        if not merged_profiles:
+            raise cherrypy.NotFound
+
+        stats = pstat_store.merge_stats([pstat_store.unpack_stats(merged.stats) for merged in merged_profiles])
+        response = a.call_graph(pstats.Stats(pstat_store.BogusStats(stats)))
+        response['count'] = sum(merged.count for merged in merged_profiles)
+        response['start_date'] = min(merged.bucket for merged in merged_profiles)
+        response['end_date'] = max(merged.bucket for merged in merged_profiles) + 3600
+        return response
+
+    @cherrypy.expose
+    @json_list_out
+    def sqlstatements(self, id=None, after=None, limit=None, **kwargs):
         if id:
             item = db.session.query(db.SQLStatement).get(id)
             if item:
@@ -70,26 +271,23 @@ class JSONAPI(object):
             else:
                 raise cherrypy.NotFound
         else:
-            results = db.session.query(db.SQLStatement)
-            return [item.to_dict() for item in results.all()]
+            return list_items(db.SQLStatement, after, limit)
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
-    def sqlstackitems(self, id=None, **kwargs):
+    @json_list_out
+    def sqlstackitems(self, id=None, after=None, limit=None, **kwargs):
         if id:
             return db.session.query(db.SQLStackItem).get(id).to_dict()
         else:
-            results = db.session.query(db.SQLStackItem)
-            return [item.to_dict() for item in results.all()]
+            return list_items(db.SQLStackItem, after, limit)
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
-    def fileaccesses(self, id=None, **kwargs):
+    @json_list_out
+    def fileaccesses(self, id=None, after=None, limit=None, **kwargs):
         if id:
             return db.session.query(db.FileAccess).get(id).to_dict()
         else:
-            results = db.session.query(db.FileAccess)
-            return [item.to_dict() for item in results.all()]
+            return list_items(db.FileAccess, after, limit)
         
     table_metadata_keys_dict = {'callstacks':[['module','class','method'],['statement_identifiers','statement_type']],
                                 'sqlstatements':[[],[]],
@@ -116,20 +314,14 @@ class JSONAPI(object):
                 if key in results_list:
                     results_list.remove(key)
         else:
+            # the values of a key, see /api/facets for the values under the current filters
             results_list = []
             for key in kwargs:
                 if kwargs[key] in self.call_stack_metadata_dict:
-                    call_stack_attr_name = self.call_stack_metadata_dict[kwargs[key]][0]
                     call_stack_attr = self.call_stack_metadata_dict[kwargs[key]][1]
-                    call_stack_name_list = db.session.query(db.CallStackName).all()
-                    results_list += list(set([getattr(call_stack_name, call_stack_attr_name) for call_stack_name in call_stack_name_list]))
-            
-            metadata_list = db.session.query(db.MetaData).filter_by(**kwargs).all()
-            results_list += [metadata.__dict__['value'] for metadata in metadata_list]
-        
-        for result in results_list:
-            if result == None:
-                results_list.remove(result)
-        results_list = [str(result) for result in results_list]
-        results_list.sort(key=str.lower)
-        return results_list
+                    results_list += [row[0] for row in db.session.query(call_stack_attr).distinct()]
+
+            results_list += [row[0] for row in db.session.query(db.MetaData.value).filter_by(**kwargs).distinct()]
+
+        results_list = set(unicode(result) for result in results_list if result is not None)
+        return sorted(results_list, key=lambda result: result.lower())
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread safe, least recently used cache. Once maxsize items are held
+    the least recently used item is evicted to make room for a new one. A maxsize
+    of 0 disables the cache, every get is then a miss.
+    '''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._items) > max(maxsize, 0):
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        '''Returns a dictionary of the cache's size and hit/miss/eviction counters.'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._items),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
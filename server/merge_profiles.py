@@ -0,0 +1,92 @@
+"""
+Merges profiles ingested before merged profiles were kept (or while merge_profiles was
+off) into the hourly merged_profiles, so diffs and flame graphs read from the merged
+profiles include them. Run from the server directory with:
+
+    python merge_profiles.py
+
+Every call stack name and hour with more profiles than its merged profile counts is
+merged again from its profiles. Each hour's merged profile is locked while it is
+rebuilt, just as ingestion locks it to add to it, so this is safe to run alongside the
+stats server and to re-run. Hours whose raw profiles have since been expired by
+retention are left as they are.
+"""
+import time
+
+import sqlalchemy
+
+import database as db
+import pstat_store
+import stat_handlers
+
+
+unmerged_sql = """
+SELECT s.call_stack_name_id, s.bucket
+FROM (
+    SELECT call_stack_name_id, (floor(datetime / 3600) * 3600)::integer AS bucket, count(*) AS count
+    FROM call_stacks
+    WHERE call_stack_name_id IS NOT NULL AND datetime IS NOT NULL
+    GROUP BY 1, 2
+) s
+LEFT JOIN merged_profiles m USING (call_stack_name_id, bucket)
+WHERE s.count > coalesce(m.count, 0)
+ORDER BY 1, 2
+"""
+
+def merge_hour(db_session, call_stack_name_id, bucket):
+    """
+    Rebuilds the merged profile of a call stack name and hour from its profiles.
+    Returns the number of profiles merged and the number whose pstats could not be read.
+    """
+    table = db.MergedProfile.__table__
+    key = (call_stack_name_id, bucket)
+    # the profiles are read once the lock is held, any ingested since are then included
+    stat_handlers.lock_rows(db_session, table, ('call_stack_name_id', 'bucket'), [key],
+                            {'count': 0, 'total_tt': 0.0, 'stats': pstat_store.pack_stats({})})
+    query = db_session.query(db.CallStack.pstat_uuid, db.CallStack.duration)
+    query = query.filter(db.CallStack.call_stack_name_id == call_stack_name_id,
+                         db.CallStack.datetime >= bucket, db.CallStack.datetime < bucket + 3600)
+
+    merged, count, total_tt, unreadable = {}, 0, 0.0, 0
+    for pstat_uuid, duration in query.all():
+        try:
+            stats = pstat_store.store.read(pstat_uuid)
+        except KeyError:
+            unreadable += 1
+            continue
+        merged = pstat_store.merge_stats([merged, stats])
+        count += 1
+        total_tt += duration or 0.0
+
+    db_session.execute(table.update().where(sqlalchemy.and_(table.c.call_stack_name_id == call_stack_name_id,
+                                                            table.c.bucket == bucket)).values(
+                           count=count, total_tt=total_tt, stats=pstat_store.pack_stats(merged)))
+    db_session.commit()
+    return count, unreadable
+
+def merge_all(db_session):
+    start = time.time()
+    hours = db_session.execute(sqlalchemy.text(unmerged_sql)).fetchall()
+    db_session.commit()
+    merged = unreadable = 0
+    for i, (call_stack_name_id, bucket) in enumerate(hours, 1):
+        hour_merged, hour_unreadable = merge_hour(db_session, call_stack_name_id, bucket)
+        merged += hour_merged
+        unreadable += hour_unreadable
+        if i % 100 == 0:
+            print '{0} of {1} hours merged'.format(i, len(hours))
+    if hours:
+        # cached diffs and flame graphs of these hours are out of date
+        db.bump_generation(db_session, 'callstacks')
+        db_session.commit()
+    print 'Finished in {0:.1f}s: {1} hours, {2} profiles merged, {3} unreadable'.format(
+        time.time() - start, len(hours), merged, unreadable)
+
+
+if __name__ == '__main__':
+    from stats_server import load_config
+
+    cfg = load_config()
+    db.setup(cfg['database_username'], cfg['database_password'])
+    pstat_store.setup('pstats', int(cfg.get('pstats_segment_size_mb', 256)) * 1024 * 1024)
+    merge_all(db.session())
@@ -0,0 +1,52 @@
+"""
+Moves profiles written as one file per profile in the pstats directory into the
+pstats segment store. Safe to re-run, profiles already in the store are skipped.
+Run from the server directory with:
+
+    python migrate_pstats.py [--delete]
+
+With --delete the original files are removed once their profile is in the store.
+"""
+import os
+import sys
+import time
+import marshal
+
+import pstat_store
+
+
+def legacy_files(root):
+    for filename in os.listdir(root):
+        if '.' not in filename and os.path.isfile(os.path.join(root, filename)):
+            yield filename
+
+def migrate(store, delete=False):
+    migrated = skipped = failed = 0
+    start = time.time()
+    for uuid in legacy_files(store.root):
+        path = os.path.join(store.root, uuid)
+        if uuid not in store:
+            try:
+                with open(path, 'rb') as f:
+                    stats = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                print 'Skipping unreadable profile {0}'.format(uuid)
+                failed += 1
+                continue
+            store.write(uuid, stats)
+            migrated += 1
+        else:
+            skipped += 1
+        if delete:
+            os.remove(path)
+            # the cached call graph goes with the profile file
+            if os.path.isfile(path + '.json'):
+                os.remove(path + '.json')
+        if (migrated + skipped) % 1000 == 0:
+            print '{0} migrated, {1} already in the store'.format(migrated, skipped)
+    print 'Finished in {0:.1f}s: {1} migrated, {2} already in the store, {3} unreadable'.format(
+        time.time() - start, migrated, skipped, failed)
+
+
+if __name__ == '__main__':
+    migrate(pstat_store.store, delete='--delete' in sys.argv[1:])
@@ -0,0 +1,309 @@
+"""
+An append-only store for pstats profiles.
+
+Rather than one file per profile, profiles are zlib compressed and appended to large
+segment files under pstats/segments. Each record is the profile's uuid, the length of
+the compressed profile and then the profile itself. Alongside each segment is an index
+file with a "uuid offset length" line per record, these are loaded into memory to find
+profiles, which are then read from the memory mapped segments.
+
+Every process writes to its own segments (named after the host and pid) so ingest
+workers in other processes never interleave records, and readers pick up new records
+by reloading any index files which have grown. Writers hold a shared flock on a segment
+while appending and removing a segment takes an exclusive one, so a segment is never
+removed from under a writer in another process.
+"""
+import os
+import fcntl
+import mmap
+import zlib
+import socket
+import struct
+import marshal
+import pstats
+from threading import Lock
+
+
+SEGMENT_EXTENSION = '.seg'
+INDEX_EXTENSION = '.idx'
+HEADER = struct.Struct('!36sI')
+
+
+class BogusStats(object):
+    '''
+    A bogus class to put the stats into, this object can be used
+    to initilise a pstats object
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+       '''A phantom method to trick pstats into accepting its stats'''
+       pass
+
+
+class PstatStore(object):
+
+    def __init__(self, root='pstats', segment_size=256 * 1024 * 1024):
+        self.root = root
+        self.segment_dir = os.path.join(root, 'segments')
+        self.segment_size = segment_size
+        self._index = {}
+        self._index_sizes = {}
+        self._maps = {}
+        self._read_lock = Lock()
+        self._write_lock = Lock()
+        self._pid = None
+        self._segment = None
+        self._segment_number = 0
+        self._segment_file = None
+        self._index_file = None
+
+    #========================================#
+    # Writing
+
+    def _writer_prefix(self):
+        return '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+    def _open_segment(self):
+        """Opens a new segment for this process to append to."""
+        if not os.path.exists(self.segment_dir):
+            os.makedirs(self.segment_dir)
+        prefix = self._writer_prefix()
+        # numbers only go up, readers may still know a removed segment by its name
+        number = self._segment_number
+        while os.path.exists(os.path.join(self.segment_dir, '{0}-{1:06d}{2}'.format(prefix, number, SEGMENT_EXTENSION))):
+            number += 1
+        self._segment_number = number + 1
+        self._segment = '{0}-{1:06d}'.format(prefix, number)
+        self._segment_file = open(os.path.join(self.segment_dir, self._segment + SEGMENT_EXTENSION), 'ab')
+        self._index_file = open(os.path.join(self.segment_dir, self._segment + INDEX_EXTENSION), 'a')
+
+    def _close_segment(self):
+        if self._segment_file:
+            self._segment_file.close()
+            self._index_file.close()
+        self._segment = self._segment_file = self._index_file = None
+
+    def write(self, uuid, stats):
+        """Appends the stats dictionary of a profile to this process' current segment."""
+        data = pack_stats(stats)
+        with self._write_lock:
+            # a forked process (e.g. the ingest process pool) must not share its parent's segment
+            if self._pid != os.getpid():
+                self._segment = self._segment_file = self._index_file = None
+                self._segment_number = 0
+                self._pid = os.getpid()
+            if self._segment_file is None or self._segment_file.tell() >= self.segment_size:
+                self._close_segment()
+                self._open_segment()
+            fcntl.flock(self._segment_file, fcntl.LOCK_SH)
+            if os.fstat(self._segment_file.fileno()).st_nlink == 0:
+                # removed by retention while this process was idle
+                self._forget_segment(self._segment)
+                self._close_segment()
+                self._open_segment()
+                fcntl.flock(self._segment_file, fcntl.LOCK_SH)
+
+            try:
+                self._segment_file.write(HEADER.pack(str(uuid), len(data)))
+                offset = self._segment_file.tell()
+                self._segment_file.write(data)
+                self._segment_file.flush()
+                # only index the record once it is fully written
+                self._index_file.write('{0} {1} {2}\n'.format(uuid, offset, len(data)))
+                self._index_file.flush()
+            finally:
+                fcntl.flock(self._segment_file, fcntl.LOCK_UN)
+            segment = self._segment
+
+        with self._read_lock:
+            self._index[str(uuid)] = (segment, offset, len(data))
+
+    #========================================#
+    # Reading
+
+    def _reload_index(self):
+        """Reads any new lines from index files which have grown since they were last read."""
+        if not os.path.exists(self.segment_dir):
+            return
+        for filename in os.listdir(self.segment_dir):
+            if not filename.endswith(INDEX_EXTENSION):
+                continue
+            path = os.path.join(self.segment_dir, filename)
+            size = os.path.getsize(path)
+            read_to = self._index_sizes.get(filename, 0)
+            if size <= read_to:
+                continue
+            segment = filename[:-len(INDEX_EXTENSION)]
+            with open(path) as f:
+                f.seek(read_to)
+                for line in f:
+                    if not line.endswith('\n'):
+                        # partially written line, pick it up next time
+                        break
+                    uuid, offset, length = line.split()
+                    self._index[uuid] = (segment, int(offset), int(length))
+                    read_to += len(line)
+            self._index_sizes[filename] = read_to
+
+    def _locate(self, uuid):
+        with self._read_lock:
+            location = self._index.get(uuid)
+            if location is None:
+                self._reload_index()
+                location = self._index.get(uuid)
+            return location
+
+    def _map(self, segment, end):
+        """Memory maps a segment, remapping if it has grown past the current map."""
+        with self._read_lock:
+            segment_map = self._maps.get(segment)
+            if segment_map is None or len(segment_map) < end:
+                # the old map is left for any reader still using it to release
+                with open(os.path.join(self.segment_dir, segment + SEGMENT_EXTENSION), 'rb') as f:
+                    segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = segment_map
+            return segment_map
+
+    def __contains__(self, uuid):
+        return self._locate(str(uuid)) is not None
+
+    def read(self, uuid):
+        """Returns the stats dictionary of a profile."""
+        uuid = str(uuid)
+        location = self._locate(uuid)
+        if location is None:
+            # profiles written before the segment store are still individual files
+            legacy_path = os.path.join(self.root, uuid)
+            if os.path.isfile(legacy_path):
+                with open(legacy_path, 'rb') as f:
+                    return marshal.load(f)
+            raise KeyError(uuid)
+        segment, offset, length = location
+        try:
+            segment_map = self._map(segment, offset + length)
+        except (IOError, OSError):
+            # the segment has since been removed by retention
+            raise KeyError(uuid)
+        return unpack_stats(segment_map[offset:offset + length])
+
+    def uuids(self):
+        """All uuids in the store, including legacy files not yet migrated."""
+        with self._read_lock:
+            self._reload_index()
+            uuids = set(self._index)
+        if os.path.isdir(self.root):
+            uuids.update(filename for filename in os.listdir(self.root)
+                         if '.' not in filename and os.path.isfile(os.path.join(self.root, filename)))
+        return uuids
+
+    def segments(self):
+        """Names of all segments in the store."""
+        if not os.path.exists(self.segment_dir):
+            return []
+        return sorted(filename[:-len(SEGMENT_EXTENSION)] for filename in os.listdir(self.segment_dir)
+                      if filename.endswith(SEGMENT_EXTENSION))
+
+    def segment_path(self, segment):
+        return os.path.join(self.segment_dir, segment + SEGMENT_EXTENSION)
+
+    def segment_uuids(self, segment):
+        """The uuids of the records in a segment, read from its index."""
+        path = os.path.join(self.segment_dir, segment + INDEX_EXTENSION)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [line.split()[0] for line in f if line.endswith('\n')]
+
+    def remove_segment(self, segment, written_before=None):
+        """
+        Deletes a whole segment and its index, returns False (and deletes nothing) if it
+        is the segment this process is currently appending to, another process is
+        appending to it or it has been written to since written_before.
+        """
+        with self._write_lock:
+            if segment == self._segment and self._pid == os.getpid():
+                return False
+            paths = [os.path.join(self.segment_dir, segment + extension)
+                     for extension in (SEGMENT_EXTENSION, INDEX_EXTENSION)]
+            try:
+                segment_file = open(paths[0], 'rb')
+            except IOError:
+                segment_file = None
+            try:
+                if segment_file:
+                    try:
+                        fcntl.flock(segment_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        return False
+                    if written_before is not None and \
+                            max(os.path.getmtime(path) for path in paths if os.path.exists(path)) > written_before:
+                        return False
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+            finally:
+                # closing releases the lock, writers then find the segment removed
+                if segment_file:
+                    segment_file.close()
+        self._forget_segment(segment)
+        return True
+
+    def _forget_segment(self, segment):
+        """Drops a removed segment's map and index entries."""
+        with self._read_lock:
+            self._maps.pop(segment, None)
+            self._index_sizes.pop(segment + INDEX_EXTENSION, None)
+            for uuid in [uuid for uuid, location in self._index.iteritems() if location[0] == segment]:
+                del self._index[uuid]
+
+    def rebuild_index(self, segment):
+        """Rewrites a segment's index by scanning its records, e.g. after a crash lost the index."""
+        path = os.path.join(self.segment_dir, segment + SEGMENT_EXTENSION)
+        entries = []
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                uuid, length = HEADER.unpack(header)
+                offset = f.tell()
+                if len(f.read(length)) < length:
+                    break
+                entries.append('{0} {1} {2}\n'.format(uuid, offset, length))
+        with open(os.path.join(self.segment_dir, segment + INDEX_EXTENSION), 'w') as f:
+            f.writelines(entries)
+        with self._read_lock:
+            self._index_sizes.pop(segment + INDEX_EXTENSION, None)
+            self._reload_index()
+
+
+def pack_stats(stats):
+    return zlib.compress(marshal.dumps(stats))
+
+def unpack_stats(data):
+    return marshal.loads(zlib.decompress(data))
+
+def merge_stats(stats_list):
+    """Merges pstats dictionaries as pstats.Stats.add does, returns the merged dictionary."""
+    # pstats refuses to construct or add empty stats, e.g. a new MergedProfile's
+    stats_list = [stats for stats in stats_list if stats]
+    if not stats_list:
+        return {}
+    merged = pstats.Stats(BogusStats(dict(stats_list[0])))
+    # one at a time, Stats.add recurses once per argument
+    for stats in stats_list[1:]:
+        merged.add(BogusStats(stats))
+    return merged.stats
+
+
+store = PstatStore()
+
+def setup(root='pstats', segment_size=256 * 1024 * 1024):
+    global store
+    store = PstatStore(root, segment_size)
+
+def load_stats(uuid):
+    """Returns a pstats.Stats object for the profile with the given uuid."""
+    return pstats.Stats(BogusStats(store.read(uuid)))
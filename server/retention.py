@@ -0,0 +1,195 @@
+"""
+Expires raw stats once they are older than a configurable time to live per stat type.
+
+Raw rows (with their metadata, argument, stack and per function rows) are deleted in
+batches of ids, oldest first, each batch in its own transaction so ingestion is never
+blocked for long. The hourly StatRollups and MergedProfiles are kept, so the aggregate
+pages still cover expired data, while the minute rollups can be given their own time
+to live. Once every profile in a pstats segment has expired the whole segment is
+deleted, as are legacy profile files and cached call graph JSON whose profile is gone.
+
+Runs every retention_interval seconds in the stats server, or once with:
+
+    python retention.py
+"""
+import os
+import time
+
+import cherrypy
+from cherrypy.process.plugins import Monitor
+import sqlalchemy
+from sqlalchemy import and_
+
+import database as db
+import pstat_store
+import call_graph_cache
+
+
+# stat type -> (model, columns of the rows to delete along with it)
+stat_tables = {'callstacks': (db.CallStack,
+                              [db.call_stack_metadata_association_table.c.call_stack_id,
+                               db.CallStackFunction.__table__.c.call_stack_id,
+                               db.RepeatedQuery.__table__.c.call_stack_id]),
+               'sqlstatements': (db.SQLStatement,
+                                 [db.sql_statement_metadata_association_table.c.sql_statement_id,
+                                  db.SQLArgAssociation.__table__.c.sql_statement_id,
+                                  db.SQLStackAssociation.__table__.c.sql_statement_id]),
+               'fileaccesses': (db.FileAccess,
+                                [db.file_access_metadata_association_table.c.file_access_id])}
+
+# days to keep, 0 keeps forever
+ttl_days = {'callstacks': 0, 'sqlstatements': 0, 'fileaccesses': 0}
+minute_rollup_ttl_days = 0
+batch_size = 10000
+# files modified more recently than this are never collected, their rows may not be committed yet
+pstats_grace = 3600
+interval = 3600
+
+last_run = {}
+
+
+def setup(cfg):
+    global minute_rollup_ttl_days, batch_size, pstats_grace, interval
+    for stat_type in ttl_days:
+        ttl_days[stat_type] = float(cfg.get('retention_{0}_days'.format(stat_type), 0))
+    minute_rollup_ttl_days = float(cfg.get('retention_minute_rollups_days', 0))
+    batch_size = int(cfg.get('retention_batch_size', 10000))
+    pstats_grace = int(cfg.get('retention_pstats_grace', 3600))
+    interval = int(cfg.get('retention_interval', 3600))
+
+def enabled():
+    return any(ttl_days.values()) or minute_rollup_ttl_days > 0
+
+def subscribe(engine=None):
+    """Runs the retention job from a Monitor on the CherryPy engine, if any TTL is set."""
+    if enabled():
+        Monitor(engine or cherrypy.engine, run, frequency=interval, name='Retention').subscribe()
+
+
+def expire_stats(stat_type, cutoff):
+    """Deletes the stat type's rows (and dependent rows) from before cutoff, returns the number deleted."""
+    model, dependent_columns = stat_tables[stat_type]
+    deleted = 0
+    while True:
+        db_session = db.session()
+        ids = [row[0] for row in db_session.query(model.id).filter(model.datetime < cutoff)
+                                                           .order_by(model.id).limit(batch_size)]
+        if not ids:
+            db_session.commit()
+            return deleted
+        for column in dependent_columns:
+            db_session.execute(column.table.delete().where(column.in_(ids)))
+        db_session.execute(model.__table__.delete().where(model.__table__.c.id.in_(ids)))
+        db_session.commit()
+        deleted += len(ids)
+
+def expire_rollups(resolution, cutoff):
+    """Deletes the rollups of a resolution with buckets starting before cutoff."""
+    table = db.StatRollup.__table__
+    deleted = 0
+    while True:
+        db_session = db.session()
+        expired = sqlalchemy.select([table.c.id], and_(table.c.resolution == resolution,
+                                                       table.c.bucket < cutoff)).limit(batch_size)
+        result = db_session.execute(table.delete().where(table.c.id.in_(expired)))
+        db_session.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+
+def referenced_uuids(uuids):
+    """The subset of uuids still referenced by a call stack."""
+    uuids = list(uuids)
+    referenced = set()
+    db_session = db.session()
+    for i in xrange(0, len(uuids), batch_size):
+        referenced.update(row[0] for row in db_session.query(db.CallStack.pstat_uuid)
+                                                      .filter(db.CallStack.pstat_uuid.in_(uuids[i:i + batch_size])))
+    db_session.commit()
+    return referenced
+
+def collect_pstats(store=None):
+    """
+    Deletes segments none of whose profiles are referenced any more, and legacy profile
+    files and cached call graphs of unreferenced profiles. Returns (segments, files) deleted.
+    """
+    store = store or pstat_store.store
+    grace_cutoff = time.time() - pstats_grace
+
+    removed_segments = 0
+    for segment in store.segments():
+        if os.path.getmtime(store.segment_path(segment)) > grace_cutoff:
+            continue
+        uuids = store.segment_uuids(segment)
+        # anything written since the uuids were read keeps the segment
+        if not referenced_uuids(uuids) and store.remove_segment(segment, grace_cutoff):
+            removed_segments += 1
+
+    candidates = {}
+    if os.path.isdir(store.root):
+        for filename in os.listdir(store.root):
+            path = os.path.join(store.root, filename)
+            if not os.path.isfile(path) or os.path.getmtime(path) > grace_cutoff:
+                continue
+            if filename.endswith('.json'):
+                candidates.setdefault(filename[:-len('.json')], []).append(path)
+            elif '.' not in filename:
+                candidates.setdefault(filename, []).append(path)
+    graph_cache = call_graph_cache.cache
+    for uuid in graph_cache.uuids():
+        path = graph_cache.path(uuid)
+        if os.path.isfile(path) and os.path.getmtime(path) <= grace_cutoff:
+            candidates.setdefault(uuid, []).append(path)
+
+    removed_files = 0
+    referenced = referenced_uuids(candidates)
+    for uuid, paths in candidates.iteritems():
+        if uuid not in referenced:
+            graph_cache.memory.delete(uuid)
+            graph_cache.parsed.delete(uuid)
+            for path in paths:
+                os.remove(path)
+                removed_files += 1
+    return removed_segments, removed_files
+
+
+def run():
+    """One pass of the retention job, the results are kept in last_run."""
+    start = time.time()
+    summary = {}
+    try:
+        for stat_type, days in ttl_days.items():
+            if days > 0:
+                summary[stat_type] = expire_stats(stat_type, start - days * 86400)
+                if summary[stat_type]:
+                    db.bump_generation(db.session(), stat_type)
+                    db.session.commit()
+        if minute_rollup_ttl_days > 0:
+            summary['minute_rollups'] = expire_rollups(db.rollup_resolutions[0], start - minute_rollup_ttl_days * 86400)
+            if summary['minute_rollups']:
+                for stat_type in db.generation_stat_types:
+                    db.bump_generation(db.session(), stat_type)
+                db.session.commit()
+        if ttl_days['callstacks'] > 0:
+            summary['pstats_segments'], summary['pstats_files'] = collect_pstats()
+    except Exception:
+        db.session.rollback()
+        cherrypy.log('Retention failed', traceback=True)
+        summary['failed'] = True
+    summary['seconds'] = time.time() - start
+    last_run.clear()
+    last_run.update(summary)
+    cherrypy.log('Retention: {0}'.format(summary))
+    return summary
+
+
+if __name__ == '__main__':
+    from stats_server import load_config
+
+    cfg = load_config()
+    db.setup(cfg['database_username'], cfg['database_password'])
+    pstat_store.setup('pstats', int(cfg.get('pstats_segment_size_mb', 256)) * 1024 * 1024)
+    call_graph_cache.setup(cfg)
+    setup(cfg)
+    print run()
@@ -0,0 +1,87 @@
+"""
+Mergeable quantile sketches of durations.
+
+A LogHistogram counts durations in logarithmically sized buckets, bucket i holding
+durations in (gamma^(i-1), gamma^i], so any quantile it reports is within
+RELATIVE_ACCURACY of the true value. Histograms of the same gamma merge exactly by
+adding their bucket counts, so the sketches of every rollup bucket in a window can be
+combined into the sketch of the whole window without revisiting the raw durations.
+"""
+import math
+import zlib
+import marshal
+
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+# durations of a nanosecond or less (including zero) share the lowest bucket
+MIN_VALUE = 1e-9
+
+
+def bucket_index(value):
+    return int(math.ceil(math.log(max(value, MIN_VALUE)) / LOG_GAMMA))
+
+
+class LogHistogram(object):
+
+    def __init__(self, counts=None):
+        self.counts = counts or {}
+
+    def add(self, value, count=1):
+        index = bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def add_bucket(self, index, count):
+        """Adds count durations to a bucket, for histograms counted elsewhere (e.g. in SQL)."""
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+        return self
+
+    def count(self):
+        return sum(self.counts.itervalues())
+
+    def quantile(self, q):
+        """The duration at quantile q (0 to 1), or None for an empty histogram."""
+        total = self.count()
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                break
+        # the midpoint of the bucket, relatively, is within RELATIVE_ACCURACY of any value in it
+        return 2 * GAMMA ** index / (GAMMA + 1)
+
+    def percentiles(self, percentiles):
+        return [self.quantile(p / 100.0) for p in percentiles]
+
+    def to_bytes(self):
+        return zlib.compress(marshal.dumps(self.counts))
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls()
+        return cls(marshal.loads(zlib.decompress(data)))
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __repr__(self):
+        return 'LogHistogram({0} durations in {1} buckets)'.format(self.count(), len(self.counts))
+
+
+def merge_all(sketches):
+    """Merges an iterable of histograms (or their packed bytes) into a new histogram."""
+    merged = LogHistogram()
+    for sketch in sketches:
+        if not isinstance(sketch, LogHistogram):
+            sketch = LogHistogram.from_bytes(sketch)
+        merged.merge(sketch)
+    return merged
@@ -1,16 +1,28 @@
 import cherrypy
 from cherrypy._cpcompat import ntou, json_decode
 import zlib
+import json
+import re
+import hashlib
 import database as db
-import os
 import cPickle
 import pstats
 import uuid
-from threading import Thread
-from Queue import Queue
+import time
+import random
+from threading import Thread, Lock, local
+from Queue import Queue, Full
+from multiprocessing import Pool
+from collections import defaultdict, deque
 from sqlparse import tokens as sql_tokens, parse as parse_sql
-from sqlalchemy import and_
+import sqlalchemy
+from sqlalchemy import and_, or_, tuple_
 from operator import attrgetter
+from lru_cache import LRUCache
+import pstat_store
+import sketches
+import aggregate_json_ui
+from pstat_store import BogusStats
 
 
 allowed_content_types = [ntou('application/json'),
@@ -37,28 +49,385 @@ def decompress_json(entity):
     except ValueError:
         raise cherrypy.HTTPError(400, 'Invalid JSON document')
 
-stat_handler_queue = Queue()
-        
+# Bounded queue of [stat_type, packet, received_time] waiting to be ingested,
+# replaced with one of the configured size by setup().
+stat_handler_queue = Queue(1000)
+worker_threads = []
+process_pool = None
+retry_after = 30
+ingest_mode = 'bulk'
+# 'memory' keeps packets on stat_handler_queue, 'database' on the ingest_packets table.
+ingest_queue = 'memory'
+claim_batch_size = 10
+max_attempts = 5
+poll_interval = 1.0
+# Whether to also save a CallStackFunction row per function of each profile.
+explode_profiles = False
+# Whether to merge each profile into its call stack name's MergedProfile for the hour.
+merge_profiles = True
+
+# Process wide cache of dimension row ids (metadata, call stack names, SQL strings etc.)
+# shared by every ingestion thread, keyed by dimension_key(). Ids are only cached once
+# the transaction which found or inserted them commits, see PendingCacheEntries.
+dimension_cache = LRUCache(100000)
+
+def dimension_key(model, **kwargs):
+    return (model.__tablename__, tuple(sorted(kwargs.items())))
+
+
+class PendingCacheEntries(local):
+    '''
+    The cache entries of rows an ingestion thread's transaction has inserted or read,
+    held back until it commits. A row inserted by a transaction which is then rolled
+    back must never reach the caches shared with the other threads.
+    '''
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, cache, key, value):
+        self.entries.append((cache, key, value))
+
+    def savepoint(self):
+        return len(self.entries)
+
+    def rollback(self, savepoint=0):
+        """Drops the entries added since the savepoint, by default all of them."""
+        del self.entries[savepoint:]
+
+    def commit(self):
+        """Call once the transaction has committed."""
+        for cache, key, value in self.entries:
+            cache.set(key, value)
+        self.entries = []
+
+pending_cache_entries = PendingCacheEntries()
+
+
+def setup(cfg, start_workers=True):
+    """
+    Configure the ingestion pipeline from the server config dictionary and start the workers.
+    Call after pstat_store.setup, the process pool's processes store pstats with its store.
+    """
+    global ingest_mode, ingest_queue, stat_handler_queue, process_pool, retry_after
+    global claim_batch_size, max_attempts, poll_interval, explode_profiles, merge_profiles
+    ingest_mode = cfg.get('ingest_mode', 'bulk')
+    if ingest_mode not in ('bulk', 'orm'):
+        raise ValueError('Unknown ingest_mode {0!r}, expected bulk or orm'.format(ingest_mode))
+    ingest_queue = cfg.get('ingest_queue', 'memory')
+    if ingest_queue not in ('memory', 'database'):
+        raise ValueError('Unknown ingest_queue {0!r}, expected memory or database'.format(ingest_queue))
+    explode_profiles = cfg.get('explode_profiles', 'false').lower() == 'true'
+    merge_profiles = cfg.get('merge_profiles', 'true').lower() == 'true'
+    dimension_cache.resize(int(cfg.get('dimension_cache_size', 100000)))
+    sql_analysis_cache.resize(int(cfg.get('sql_analysis_cache_size', 10000)))
+
+    retry_after = int(cfg.get('ingest_retry_after', 30))
+    stat_handler_queue = Queue(int(cfg.get('ingest_queue_size', 1000)))
+    claim_batch_size = int(cfg.get('ingest_claim_batch_size', 10))
+    max_attempts = int(cfg.get('ingest_max_attempts', 5))
+    poll_interval = float(cfg.get('ingest_poll_interval', 1))
+
+    num_processes = int(cfg.get('ingest_processes', 0))
+    if num_processes > 0:
+        process_pool = Pool(num_processes)
+
+    if start_workers:
+        target = database_worker if ingest_queue == 'database' else worker
+        for i in xrange(int(cfg.get('ingest_workers', 4))):
+            worker_thread = Thread(target=target, name='Ingest worker {0}'.format(i))
+            worker_thread.daemon = True
+            worker_thread.start()
+            worker_threads.append(worker_thread)
+
+
+# the generation counter bumped by ingesting each packet type
+packet_generations = {'function': 'callstacks',
+                      'handler': 'callstacks',
+                      'database': 'sqlstatements',
+                      'file': 'fileaccesses'}
+
+def bump_generations(stat_types):
+    """Bumps the generation counters of packet types whose stats have been committed."""
+    db_session = db.session()
+    for generation_type in set(packet_generations[stat_type] for stat_type in stat_types):
+        db.bump_generation(db_session, generation_type)
+    db_session.commit()
+
+
+def ingest_packet(stat_type, packet):
+    """Ingests a single packet, returns the number of stats ingested."""
+    if process_pool:
+        packet = process_pool.apply(prepare_packet, (stat_type, packet))
+    parse_functions[stat_type](packet)
+    return len(packet['stats'])
+
+
+# PostgreSQL's deadlock_detected and serialization_failure, which another attempt may not hit
+transient_error_codes = ('40P01', '40001')
+
+def transient_failure(ex):
+    """Whether ingesting a packet failed because of concurrent workers, rather than the packet."""
+    return isinstance(ex, sqlalchemy.exc.DBAPIError) and getattr(ex.orig, 'pgcode', None) in transient_error_codes
+
+def ingest_with_retries(stat_type, packet):
+    """
+    Ingests a packet from the memory queue, retrying deadlocks and serialization failures
+    up to max_attempts in all. Returns the number of stats ingested.
+    """
+    assign_pstat_uuids(stat_type, packet)
+    for attempt in xrange(1, max_attempts + 1):
+        try:
+            return ingest_packet(stat_type, packet)
+        except Exception, ex:
+            if attempt >= max_attempts or not transient_failure(ex):
+                raise
+            db.session.rollback()
+            pending_cache_entries.rollback()
+            cherrypy.log('Retrying {0} stats packet after: {1}'.format(stat_type, ex.orig))
+            # an earlier attempt may have stored some of the packet's pstats
+            packet['retry'] = True
+            time.sleep(random.uniform(0, 0.1 * attempt))
+
 def worker():
     while True:
-        item = stat_handler_queue.get()
-        fn = item[0]
-        fn(item[1])
-        stat_handler_queue.task_done()
-        
-worker_thread = Thread(target=worker)
-worker_thread.daemon = True
-worker_thread.start()
+        stat_type, packet, received = stat_handler_queue.get()
+        start = time.time()
+        try:
+            num_stats = ingest_with_retries(stat_type, packet)
+        except Exception:
+            db.session.rollback()
+            pending_cache_entries.rollback()
+            ingest_metrics.record_failure(stat_type)
+            cherrypy.log('Failed to ingest {0} stats packet'.format(stat_type), traceback=True)
+        else:
+            # the parse functions commit
+            pending_cache_entries.commit()
+            ingest_metrics.record(stat_type, num_stats, received, start, time.time())
+            bump_generations([stat_type])
+        finally:
+            stat_handler_queue.task_done()
+
+
+def assign_pstat_uuids(stat_type, packet):
+    """Gives each profile of a packet its pstat_uuid up front, for packets which may be retried."""
+    if stat_type in ('function', 'handler'):
+        for profile in packet['stats']:
+            profile.setdefault('pstat_uuid', str(uuid.uuid4()))
+
+
+def enqueue_packet(db_session, stat_type, packet):
+    """
+    Writes a packet to the durable ingestion queue. Profiles are given their pstat_uuid
+    here so every attempt at ingesting the packet stores their pstats under the same uuid.
+    """
+    assign_pstat_uuids(stat_type, packet)
+    payload = zlib.compress(json.dumps(packet))
+    db_session.add(db.IngestPacket(stat_type, time.time(), payload))
+    db_session.commit()
+
+
+def database_queue_full(db_session):
+    """
+    Whether ingest_queue_size packets are already waiting on the durable queue, only
+    counting that far so a long queue is no slower to check.
+    """
+    if stat_handler_queue.maxsize <= 0:
+        return False
+    statement = sqlalchemy.text('SELECT count(*) FROM (SELECT 1 FROM ingest_packets WHERE NOT failed LIMIT :limit) waiting')
+    return db_session.execute(statement, {'limit': stat_handler_queue.maxsize}).scalar() >= stat_handler_queue.maxsize
+
+
+def claim_packets(db_session, batch_size):
+    """
+    Locks up to batch_size packets from the durable queue. Packets locked by other
+    workers are skipped, so any number of workers (in any number of processes) can
+    claim from the queue at once. The locks are held until the transaction ends.
+    """
+    statement = sqlalchemy.text('SELECT id, stat_type, received, payload, attempts FROM ingest_packets '
+                                'WHERE NOT failed ORDER BY id LIMIT :batch_size '
+                                'FOR UPDATE SKIP LOCKED')
+    return db_session.execute(statement, {'batch_size': batch_size}).fetchall()
+
+
+def ingest_claimed_packets(db_session):
+    """
+    Claims a batch of packets from the durable queue and ingests them. Each packet is
+    ingested in a savepoint so a bad packet only rolls back itself, ingested packets
+    are deleted in the same transaction they were written in. If the process dies part
+    way through nothing is committed and the packets are claimed again by the next worker.
+
+    Returns the number of packets claimed.
+    """
+    claimed = claim_packets(db_session, claim_batch_size)
+    ingested = set()
+    for packet_id, stat_type, received, payload, attempts in claimed:
+        start = time.time()
+        packet = json.loads(zlib.decompress(payload))
+        # an earlier attempt may have stored some of the packet's pstats
+        packet['retry'] = attempts > 0
+        db_session.begin_nested()
+        savepoint = pending_cache_entries.savepoint()
+        try:
+            # parse functions commit, which releases the savepoint
+            num_stats = ingest_packet(stat_type, packet)
+        except Exception, ex:
+            db_session.rollback()
+            pending_cache_entries.rollback(savepoint)
+            ingest_metrics.record_failure(stat_type)
+            cherrypy.log('Failed to ingest {0} stats packet {1}'.format(stat_type, packet_id), traceback=True)
+            db_session.query(db.IngestPacket).filter(db.IngestPacket.id == packet_id).update(
+                {'attempts': db.IngestPacket.attempts + 1,
+                 'last_error': str(ex),
+                 'failed': db.IngestPacket.attempts + 1 >= max_attempts}, synchronize_session=False)
+        else:
+            db_session.query(db.IngestPacket).filter(db.IngestPacket.id == packet_id).delete(synchronize_session=False)
+            ingest_metrics.record(stat_type, num_stats, received, start, time.time())
+            ingested.add(stat_type)
+    db_session.commit()
+    pending_cache_entries.commit()
+    bump_generations(ingested)
+    return len(claimed)
+
+
+def database_worker():
+    while True:
+        try:
+            if ingest_claimed_packets(db.session()) == 0:
+                time.sleep(poll_interval)
+        except Exception:
+            db.session.rollback()
+            pending_cache_entries.rollback()
+            cherrypy.log('Failed to claim stats packets', traceback=True)
+            time.sleep(poll_interval)
+
+
+def prepare_packet(stat_type, packet):
+    """
+    Does the CPU heavy, database free, part of ingesting a packet (unpickling and
+    dumping pstats, parsing SQL) so it can be run in the process pool.
+    """
+    if stat_type in ('function', 'handler'):
+        for profile in packet['stats']:
+            if 'profile' in profile:
+                store_profile(profile, packet.get('retry'))
+            # no need to send the pickled profile back from the pool
+            profile.pop('profile', None)
+        packet['analysed_sql'] = analyse_packet_sql([{'sql_string': repeat['sql']}
+                                                     for profile in packet['stats']
+                                                     for repeat in profile.get('sql_repeats', [])],
+                                                    packet.get('analysed_sql'))
+    elif stat_type == 'database':
+        packet['analysed_sql'] = analyse_packet_sql(packet['stats'], packet.get('analysed_sql'))
+    return packet
+
+
+class IngestMetrics(object):
+    '''
+    Thread safe counters of the ingestion workers' progress per stat type, along with
+    the number of stats processed over the last window seconds for processing rates.
+    '''
+
+    def __init__(self, window=60):
+        self.window = window
+        self.rejected = defaultdict(int)
+        self._types = defaultdict(lambda: {'packets': 0,
+                                           'stats': 0,
+                                           'failures': 0,
+                                           'processing_time': 0.0,
+                                           'lag': 0.0,
+                                           'max_lag': 0.0})
+        self._recent = defaultdict(deque)
+        self._lock = Lock()
+
+    def record(self, stat_type, num_stats, received, start, end):
+        with self._lock:
+            metrics = self._types[stat_type]
+            metrics['packets'] += 1
+            metrics['stats'] += num_stats
+            metrics['processing_time'] += end - start
+            # lag is how long the packet waited in the queue and was processed for
+            metrics['lag'] = end - received
+            metrics['max_lag'] = max(metrics['max_lag'], metrics['lag'])
+            self._recent[stat_type].append((end, num_stats))
+            self._expire(stat_type, end)
+
+    def record_failure(self, stat_type):
+        with self._lock:
+            self._types[stat_type]['failures'] += 1
+
+    def record_rejected(self, stat_type):
+        with self._lock:
+            self.rejected[stat_type] += 1
+
+    def _expire(self, stat_type, now):
+        recent = self._recent[stat_type]
+        while recent and recent[0][0] < now - self.window:
+            recent.popleft()
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            types = {}
+            # including types whose packets have all been rejected so far
+            for stat_type in set(self._types) | set(self.rejected):
+                self._expire(stat_type, now)
+                types[stat_type] = dict(self._types[stat_type])
+                types[stat_type]['rejected'] = self.rejected[stat_type]
+                types[stat_type]['stats_per_sec'] = sum(num for _, num in self._recent[stat_type]) / float(self.window)
+            return types
+
+ingest_metrics = IngestMetrics()
+
+
+def queue_metrics():
+    """
+    Depth of the ingestion queue and the age of the oldest packet waiting on it. Failed
+    packets of the database queue are counted separately, they are no longer waiting.
+    """
+    if ingest_queue == 'database':
+        depth, oldest = db.session.query(sqlalchemy.func.count(db.IngestPacket.id),
+                                         sqlalchemy.func.min(db.IngestPacket.received)).filter(
+                                             db.IngestPacket.failed == False).first()
+        failed = db.session.query(db.IngestPacket).filter(db.IngestPacket.failed == True).count()
+    else:
+        with stat_handler_queue.mutex:
+            oldest = stat_handler_queue.queue[0][2] if stat_handler_queue.queue else None
+            depth = len(stat_handler_queue.queue)
+        failed = None
+    # the durable queue is limited to the same size
+    max_depth = stat_handler_queue.maxsize
+    return {'backend': ingest_queue,
+            'depth': depth,
+            'max_depth': max_depth,
+            'failed': failed,
+            'oldest_age': time.time() - oldest if oldest else 0.0,
+            'workers': len(worker_threads),
+            'processes': process_pool._processes if process_pool else 0}
+
+
+class MetricsAPI(object):
+    '''Exposes the ingestion pipeline's metrics as JSON.'''
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def index(self):
+        return {'queue': queue_metrics(),
+                'types': ingest_metrics.snapshot(),
+                'dimension_cache': dimension_cache.stats(),
+                'sql_analysis_cache': sql_analysis_cache.stats(),
+                'aggregate_cache': aggregate_json_ui.result_cache.stats()}
+
 
 class StatHandler(object):
     '''
-    A base stat handler for incoming stats. By initialising with a given push function
+    A base stat handler for incoming stats. By initialising with a given stat type
     the various handlers can be created for different stat types.
     '''
     exposed = True
 
-    def __init__(self, parse_fn):
-        self.parse_fn = parse_fn
+    def __init__(self, stat_type):
+        self.stat_type = stat_type
 
     @cherrypy.tools.json_in(content_type=allowed_content_types, processor=decompress_json)
     def POST(self):
@@ -67,186 +436,897 @@ class StatHandler(object):
         if cherrypy.request.remote.name:
             cherrypy.serving.request.json['metadata']['hostname'] = cherrypy.request.remote.name
 
-        stat_handler_queue.put([self.parse_fn, cherrypy.serving.request.json])
+        if ingest_queue == 'database':
+            db_session = db.session()
+            if database_queue_full(db_session):
+                db_session.rollback()
+                return self.reject()
+            enqueue_packet(db_session, self.stat_type, cherrypy.serving.request.json)
+            cherrypy.response.status = 202
+            return 'Hello, World.'
+
+        try:
+            stat_handler_queue.put_nowait([self.stat_type, cherrypy.serving.request.json, time.time()])
+        except Full:
+            return self.reject()
 
         cherrypy.response.status = 202 # Send back Accepted so they know it's successfully into the processing queue.
         return 'Hello, World.'
 
+    def reject(self):
+        # Tell the sender to back off and try again later rather than letting the queue grow without limit.
+        ingest_metrics.record_rejected(self.stat_type)
+        cherrypy.response.status = 503
+        cherrypy.response.headers['Retry-After'] = str(retry_after)
+        return 'Ingestion queue is full.'
 
-class BogusStats(object):
-    '''
-    A bogus class to put the stats into, this object can be used
-    to initilise a pstats object
-    '''
-    def __init__(self, stats):
-        self.stats = stats
 
-    def create_stats(self):
-       '''A phantom method to trick pstats into accepting its stats''' 
-       pass
+def parse_fn_packet(packet):
+    if ingest_mode == 'bulk':
+        bulk_parse_fn_packet(packet)
+    else:
+        orm_parse_fn_packet(packet)
+
+def parse_sql_packet(packet):
+    if ingest_mode == 'bulk':
+        bulk_parse_sql_packet(packet)
+    else:
+        orm_parse_sql_packet(packet)
 
+def parse_file_packet(packet):
+    if ingest_mode == 'bulk':
+        bulk_parse_file_packet(packet)
+    else:
+        orm_parse_file_packet(packet)
 
-def parse_fn_packet(packet):
-    db_session = db.Session()
+
+def store_profile(profile, retry=False):
+    """
+    Unpickle the pstats of a profile, append them to the pstats store and
+    set the duration and pstat_uuid of the profile. Profiles from the durable
+    queue already have their uuid, a retry does not store them again.
+    """
+    # pull and unpickle pstats
+    stats = cPickle.loads(str(profile['profile']))
+    # need to make it a bogus stats object for it to initialise
+    # (needs a create_stats method and stats attr)
+    profile['duration'] = pstats.Stats(BogusStats(stats)).total_tt
+    if 'pstat_uuid' not in profile:
+        profile['pstat_uuid'] = str(uuid.uuid4())
+    if not (retry and profile['pstat_uuid'] in pstat_store.store):
+        pstat_store.store.write(profile['pstat_uuid'], stats)
+    if explode_profiles or merge_profiles:
+        # kept for save_function_stats and save_merged_profiles
+        profile['stats'] = stats
+
+
+def function_key(key):
+    """A pstats (file, line, name) key with its strings as unicode, as they come back from the database."""
+    filename, line, name = key
+    if isinstance(filename, str):
+        filename = filename.decode('utf-8', 'replace')
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    return (filename, line, name)
+
+def save_function_stats(db_session, call_stacks):
+    """
+    Explodes profiles into a CallStackFunction row per function, call_stacks is a list
+    of (call_stack_id, call_stack_name_id, datetime, stats dictionary) tuples.
+    """
+    keys = set()
+    for call_stack_id, call_stack_name_id, datetime, stats in call_stacks:
+        for key, (primcalls, ncalls, tottime, cumtime, callers) in stats.items():
+            keys.add(function_key(key))
+            keys.update(function_key(caller) for caller in callers)
+    function_ids = bulk_get_or_create_ids(db_session, db.ProfileFunction, ('filename', 'line', 'name'), keys)
+
+    rows = []
+    for call_stack_id, call_stack_name_id, datetime, stats in call_stacks:
+        for key, (primcalls, ncalls, tottime, cumtime, callers) in stats.items():
+            rows.append({'call_stack_id': call_stack_id,
+                         'function_id': function_ids[function_key(key)],
+                         'call_stack_name_id': call_stack_name_id,
+                         'datetime': datetime,
+                         'ncalls': ncalls,
+                         'primcalls': primcalls,
+                         'tottime': tottime,
+                         'cumtime': cumtime,
+                         'caller_ids': [function_ids[function_key(caller)] for caller in callers]})
+    bulk_insert(db_session, db.CallStackFunction.__table__, rows)
+
+
+def save_merged_profiles(db_session, profiles):
+    """
+    Merges profiles into the MergedProfile of their call stack name and hour, profiles
+    is a list of (call_stack_name_id, datetime, duration, stats dictionary) tuples.
+    """
+    buckets = defaultdict(list)
+    for call_stack_name_id, datetime, duration, stats in profiles:
+        buckets[(call_stack_name_id, int(datetime // 3600 * 3600))].append((duration, stats))
+
+    empty_stats = pstat_store.pack_stats({})
+    rows = lock_rows(db_session, db.MergedProfile.__table__, ('call_stack_name_id', 'bucket'), buckets.keys(),
+                     {'count': 0, 'total_tt': 0.0, 'stats': empty_stats})
+    for key, bucket_profiles in buckets.items():
+        row = rows[key]
+        stats_list = [pstat_store.unpack_stats(row['stats'])] + [stats for duration, stats in bucket_profiles]
+        db_session.execute(db.MergedProfile.__table__.update().where(and_(
+                               db.MergedProfile.call_stack_name_id == key[0],
+                               db.MergedProfile.bucket == key[1])).values(
+                               count=row['count'] + len(bucket_profiles),
+                               total_tt=row['total_tt'] + sum(duration for duration, stats in bucket_profiles),
+                               stats=pstat_store.pack_stats(pstat_store.merge_stats(stats_list))))
+
+
+def save_repeated_queries(db_session, call_stacks, analysed_sql=None):
+    """
+    Saves the statements handler requests ran repeatedly from one call site (the agent's
+    sql_repeats), call_stacks is a list of (call_stack_id, call_stack_name_id, datetime,
+    sql_repeats) tuples. Repeats are regrouped by the SQL fingerprint, which is finer
+    than the agent's, and their SQL strings analysed as if they came in an SQL packet.
+    The example SQL is kept on the RepeatedQuery, which only references an SQLString
+    already recorded from an SQL packet, repeats never add SQL strings of their own.
+
+    Returns the analyses and the analyses saved, for mark_sql_analysis_saved.
+    """
+    repeats = [{'sql_string': repeat['sql']} for call_stack in call_stacks for repeat in call_stack[3]]
+    if not repeats:
+        return {}, set()
+    analyses, unsaved = get_sql_analysis(db_session, repeats, analysed_sql)
+    sql_string_ids = dict((key[0], _id) for key, _id in
+                          bulk_get_ids(db_session, db.SQLString, ('sql',), [(sql,) for sql in analyses]).items())
+    saved = set(sql for sql in unsaved if sql in sql_string_ids)
+    save_sql_analysis(db_session, sql_string_ids, analyses, saved)
+
+    rows = {}
+    for call_stack_id, call_stack_name_id, datetime, sql_repeats in call_stacks:
+        for repeat in sql_repeats:
+            fingerprint = analyses[repeat['sql']][2]
+            key = (call_stack_id, fingerprint, repeat['call_site'])
+            row = rows.get(key)
+            if row is None:
+                rows[key] = {'call_stack_id': call_stack_id,
+                             'call_stack_name_id': call_stack_name_id,
+                             'sql_string_id': sql_string_ids.get(repeat['sql']),
+                             'sql': repeat['sql'],
+                             'fingerprint': fingerprint,
+                             'call_site': repeat['call_site'],
+                             'datetime': datetime,
+                             'count': repeat['count'],
+                             'duration': repeat['duration']}
+            else:
+                row['count'] += repeat['count']
+                row['duration'] += repeat['duration']
+                if row['sql_string_id'] is None and repeat['sql'] in sql_string_ids:
+                    # prefer an example which links to its statements
+                    row['sql_string_id'], row['sql'] = sql_string_ids[repeat['sql']], repeat['sql']
+    for row in rows.values():
+        # every run but one, at the average duration
+        row['wasted'] = row['duration'] * (row['count'] - 1) / row['count']
+    bulk_insert(db_session, db.RepeatedQuery.__table__, rows.values())
+    return analyses, saved
+
+
+def save_rollups(db_session, stat_type, stats):
+    """
+    Adds stats to the minute and hour StatRollups, stats is a list of
+    (name_id, datetime, duration, metadata_set_id) tuples.
+
+    The counters are summed by the upsert itself, which also locks the rows so the
+    duration sketches returned can be merged with the new durations and written back.
+    """
+    rollups = {}
+    for name_id, datetime, duration, metadata_set_id in stats:
+        for resolution in db.rollup_resolutions:
+            key = (resolution, int(datetime // resolution * resolution), name_id, metadata_set_id)
+            if key in rollups:
+                rollup = rollups[key]
+                rollup['count'] += 1
+                rollup['total'] += duration
+                rollup['min'] = min(rollup['min'], duration)
+                rollup['max'] = max(rollup['max'], duration)
+            else:
+                rollup = rollups[key] = {'count': 1, 'total': duration, 'min': duration, 'max': duration,
+                                         'sketch': sketches.LogHistogram()}
+            rollup['sketch'].add(duration)
+
+    sketch_updates = []
+    # sorted so concurrent workers take the row locks in the same order
+    for chunk in chunks(sorted(rollups)):
+        values = []
+        params = {'stat_type': stat_type}
+        for i, key in enumerate(chunk):
+            rollup = rollups[key]
+            values.append('(:stat_type, :resolution{0}, :bucket{0}, :name_id{0}, :metadata_set_id{0}, '
+                          ':count{0}, :total{0}, :min{0}, :max{0})'.format(i))
+            params.update({'resolution{0}'.format(i): key[0],
+                           'bucket{0}'.format(i): key[1],
+                           'name_id{0}'.format(i): key[2],
+                           'metadata_set_id{0}'.format(i): key[3],
+                           'count{0}'.format(i): rollup['count'],
+                           'total{0}'.format(i): rollup['total'],
+                           'min{0}'.format(i): rollup['min'],
+                           'max{0}'.format(i): rollup['max']})
+        result = db_session.execute(sqlalchemy.text(
+            'INSERT INTO stat_rollups (stat_type, resolution, bucket, name_id, metadata_set_id, count, total, min, max) '
+            'VALUES {0} ON CONFLICT (stat_type, resolution, bucket, name_id, metadata_set_id) DO UPDATE SET '
+            'count = stat_rollups.count + excluded.count, '
+            'total = stat_rollups.total + excluded.total, '
+            'min = least(stat_rollups.min, excluded.min), '
+            'max = greatest(stat_rollups.max, excluded.max) '
+            'RETURNING id, resolution, bucket, name_id, metadata_set_id, sketch'.format(', '.join(values))), params)
+        for row in result:
+            sketch = sketches.LogHistogram.from_bytes(row['sketch'])
+            sketch.merge(rollups[(row['resolution'], row['bucket'], row['name_id'], row['metadata_set_id'])]['sketch'])
+            sketch_updates.append({'rollup_id': row['id'], 'rollup_sketch': sketch.to_bytes()})
+
+    if sketch_updates:
+        table = db.StatRollup.__table__
+        db_session.execute(table.update().where(table.c.id == sqlalchemy.bindparam('rollup_id')).values(
+                               sketch=sqlalchemy.bindparam('rollup_sketch', type_=sqlalchemy.LargeBinary)), sketch_updates)
+
+
+def analyse_sql(sql_string):
+    """Returns the identifiers, statement type and normalised fingerprint of an SQL string."""
+    parsed_sql = parse_sql(sql_string)[0]
+    sql_identifiers = []
+    for token in parsed_sql.tokens:
+        for item in token.flatten():
+            if item.ttype == sql_tokens.Name:
+                sql_identifiers.append(item.value)
+    statement_type = sql_string.split()[0]
+    return sql_identifiers, statement_type, sql_fingerprint(parsed_sql)
+
+def sql_fingerprint(parsed_sql):
+    """
+    Normalises a parsed statement so statements differing only in literal values,
+    placeholders, whitespace or keyword case share a fingerprint.
+    """
+    parts = []
+    for item in parsed_sql.flatten():
+        if item.is_whitespace():
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        elif item.ttype in sql_tokens.Literal or item.ttype in sql_tokens.Name.Placeholder:
+            parts.append('?')
+        elif item.ttype in sql_tokens.Keyword:
+            parts.append(item.value.upper())
+        else:
+            parts.append(item.value)
+    # IN lists of any length are the same statement
+    return in_list_pattern.sub('(?)', ''.join(parts).strip())
+
+in_list_pattern = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+
+# Memoised analyse_sql results keyed by sql_analysis_key(), values are
+# (analysis, saved) where saved says whether the analysis is on the SQLString row.
+sql_analysis_cache = LRUCache(10000)
+
+def sql_analysis_key(sql_string):
+    return hashlib.sha1(sql_string.encode('utf-8')).digest()
+
+def analyse_packet_sql(stats, analysed_sql=None):
+    """Analyses each distinct SQL string of a packet once, returns a dictionary of sql -> analysis."""
+    analysed_sql = analysed_sql or {}
+    for profile in stats:
+        sql = profile['sql_string']
+        if sql not in analysed_sql:
+            cached = sql_analysis_cache.get(sql_analysis_key(sql))
+            if cached:
+                analysed_sql[sql] = cached[0]
+            else:
+                analysed_sql[sql] = analyse_sql(sql)
+                sql_analysis_cache.set(sql_analysis_key(sql), (analysed_sql[sql], False))
+    return analysed_sql
+
+def get_sql_analysis(db_session, stats, analysed_sql=None):
+    """
+    Gets the analysis of each distinct SQL string of a packet, only parsing SQL which
+    has never been seen before. Analyses come from the in memory cache, then from the
+    columns on SQLString, then from analysed_sql (e.g. parsed in the process pool) and
+    finally from parsing.
+
+    Returns a dictionary of sql -> analysis and the set of SQL strings whose analysis
+    is not yet saved to their SQLString row.
+    """
+    analyses = {}
+    for sql in set(profile['sql_string'] for profile in stats):
+        cached = sql_analysis_cache.get(sql_analysis_key(sql))
+        if cached and cached[1]:
+            analyses[sql] = cached[0]
+
+    lookup = [sql for sql in set(profile['sql_string'] for profile in stats) if sql not in analyses]
+    for chunk in chunks(lookup):
+        query = db_session.query(db.SQLString.sql,
+                                 db.SQLString.identifiers,
+                                 db.SQLString.statement_type,
+                                 db.SQLString.fingerprint)
+        query = query.filter(db.SQLString.sql.in_(chunk), db.SQLString.statement_type != None)
+        for sql, identifiers, statement_type, fingerprint in query:
+            analyses[sql] = (json.loads(identifiers), statement_type, fingerprint)
+            sql_analysis_cache.set(sql_analysis_key(sql), (analyses[sql], True))
+
+    unsaved = set(sql for sql in lookup if sql not in analyses)
+    analyses.update(analyse_packet_sql([{'sql_string': sql} for sql in unsaved], analysed_sql))
+    return analyses, unsaved
+
+def save_sql_analysis(db_session, sql_string_ids, analyses, unsaved):
+    """Writes the analysis of newly seen SQL strings to their SQLString rows."""
+    # sorted so concurrent workers update the rows they share in the same order
+    for sql in sorted(unsaved):
+        sql_identifiers, statement_type, fingerprint = analyses[sql]
+        db_session.query(db.SQLString).filter(db.SQLString.id == sql_string_ids[sql]).update(
+            {'identifiers': json.dumps(sql_identifiers),
+             'statement_type': statement_type,
+             'fingerprint': fingerprint}, synchronize_session=False)
+
+def mark_sql_analysis_saved(analyses, unsaved):
+    """
+    Caches the analyses as saved once the ingest transaction commits. A packet from the
+    durable queue commits only its savepoint, the batch commits later.
+    """
+    for sql in unsaved:
+        pending_cache_entries.add(sql_analysis_cache, sql_analysis_key(sql), (analyses[sql], True))
+
+
+#========================================#
+# Row at a time ingestion through the ORM
+
+def orm_parse_fn_packet(packet):
+    db_session = db.session()
     
     # Get global metadata
-    metadata_list = get_metadata_list(packet['metadata'], db_session)
+    metadata_ids = get_metadata_ids(packet['metadata'], db_session)
+    metadata_set_id = get_metadata_set_id(db_session, packet['metadata'], metadata_ids)
+    call_stacks = []
     
     for profile in packet['stats']:
-        # pull and unpickle pstats
-        stats = cPickle.loads(str(profile['profile']))
-        # need to make it a bogus stats object for it to initialise
-        # (needs a create_stats method and stats attr)
-        stats = BogusStats(stats)
-        stats = pstats.Stats(stats)
-        profile['duration'] = stats.total_tt
-        _id = str(uuid.uuid4())
-        while os.path.isfile(os.path.join(os.getcwd(),'pstats',_id)):
-            _id = str(uuid.uuid4())
-        profile['pstat_uuid'] = _id
-        stats.dump_stats('pstats\\'+_id)
-
-        # callstack names
-        call_stack_name = get_or_create(db_session,
-                                       db.CallStackName,
-                                       module_name = profile['module'],
-                                       class_name = profile['class'],
-                                       fn_name = profile['function'])
-        
+        if 'profile' in profile:
+            store_profile(profile, packet.get('retry'))
+
         # Add call stack
         call_stack = db.CallStack(profile)
-        call_stack.name = call_stack_name
-        call_stack.metadata_items = metadata_list
+        call_stack.call_stack_name_id = get_or_create_id(db_session,
+                                                         db.CallStackName,
+                                                         module_name = profile['module'],
+                                                         class_name = profile['class'],
+                                                         fn_name = profile['function'])
+        call_stack.metadata_set_id = metadata_set_id
         # add to session
         db_session.add(call_stack)
+        call_stacks.append((call_stack, profile))
+
+    db_session.flush()
+    insert_metadata_associations(db_session, db.call_stack_metadata_association_table, 'call_stack_id',
+                                 [(stack.id, metadata_ids) for stack, stack_profile in call_stacks])
+    save_rollups(db_session, 'callstacks', [(stack.call_stack_name_id, stack.datetime, stack.duration, metadata_set_id)
+                                            for stack, stack_profile in call_stacks])
+    if explode_profiles:
+        save_function_stats(db_session, [(stack.id, stack.call_stack_name_id, stack.datetime, stack_profile['stats'])
+                                         for stack, stack_profile in call_stacks])
+    if merge_profiles:
+        save_merged_profiles(db_session, [(stack.call_stack_name_id, stack.datetime, stack.duration, stack_profile['stats'])
+                                          for stack, stack_profile in call_stacks])
+    analysed_sql, unsaved = save_repeated_queries(db_session,
+                                                  [(stack.id, stack.call_stack_name_id, stack.datetime,
+                                                    stack_profile.get('sql_repeats', []))
+                                                   for stack, stack_profile in call_stacks],
+                                                  packet.get('analysed_sql'))
 
     db_session.commit()
+    mark_sql_analysis_saved(analysed_sql, unsaved)
  
 
-def parse_sql_packet(packet):
-    db_session = db.Session()
+def orm_parse_sql_packet(packet):
+    db_session = db.session()
                     
     # Get flush metadata
-    global_metadata_list = get_metadata_list(packet['metadata'], db_session)
+    global_metadata_ids = get_metadata_ids(packet['metadata'], db_session)
+    analysed_sql, unsaved = get_sql_analysis(db_session, packet['stats'], packet.get('analysed_sql'))
+    sql_statements = []
+    sql_string_ids = {}
     
     for profile in packet['stats']:
         
         # get-or-set all arguments (do not map relationship yet)
-        sql_arg_list = get_arg_list(db_session, profile['args'])
+        sql_arg_ids = get_arg_ids(db_session, profile['args'])
 
         # get-or-set all stack items (do not map relationship yet)
-        sql_stack_item_list = get_stack_list(db_session, profile['stack'])
+        sql_stack_item_ids = get_stack_ids(db_session, profile['stack'])
 
         # Parse SQL string
-        parsed_sql = parse_sql(profile['sql_string'])[0]
-        sql_identifiers = []
-        for token in parsed_sql.tokens:
-            for item in token.flatten():
-                if item.ttype == sql_tokens.Name:
-                    sql_identifiers.append(item.value)
-        statement_type = profile['sql_string'].split()[0]
+        sql_identifiers, statement_type, fingerprint = analysed_sql[profile['sql_string']]
 
         # get-or-set the metadata
-        sql_identifiers = get_metadata_list({'statement_identifiers':sql_identifiers,
-                                             'statement_type':statement_type},
-                                            db_session)
-        metadata_list = global_metadata_list + sql_identifiers
+        statement_metadata = {'statement_identifiers':sql_identifiers,
+                              'statement_type':statement_type}
+        metadata_ids = sorted(set(global_metadata_ids + get_metadata_ids(statement_metadata, db_session)))
 
         # get-or-set the sql string
-        sql_string = get_or_create(db_session,
-                                   db.SQLString,
-                                   sql=profile['sql_string'])
+        sql_string_ids[profile['sql_string']] = get_or_create_id(db_session,
+                                                                 db.SQLString,
+                                                                 sql=profile['sql_string'])
         
         # create the statement object
         sql_statement = db.SQLStatement(profile)
 
         # add the arg asssociatons
-        for i, arg in enumerate(sql_arg_list):
+        for i, arg_id in enumerate(sql_arg_ids):
             sql_arg_assoc = db.SQLArgAssociation(index=i)
-            sql_arg_assoc.arg = arg
+            sql_arg_assoc.sql_argument_id = arg_id
             sql_statement.arguments.append(sql_arg_assoc)
 
         # add the stack asssociatons
-        for i, stack_item in enumerate(sql_stack_item_list):
+        for i, stack_item_id in enumerate(sql_stack_item_ids):
             sql_stack_item_assoc = db.SQLStackAssociation(index=i)
-            sql_stack_item_assoc.stack_item = stack_item
+            sql_stack_item_assoc.sql_stack_item_id = stack_item_id
             sql_statement.sql_stack_items.append(sql_stack_item_assoc)
 
-        # add the metadata
-        sql_statement.metadata_items = metadata_list
+        # add the metadata set
+        statement_metadata.update(packet['metadata'])
+        sql_statement.metadata_set_id = get_metadata_set_id(db_session, statement_metadata, metadata_ids)
 
         # add the sql string
-        sql_statement.sql_string = sql_string
+        sql_statement.sql_string_id = sql_string_ids[profile['sql_string']]
 
         # Add sql statement to session
         db_session.add(sql_statement)
-    
+        sql_statements.append((sql_statement, metadata_ids))
+
+    db_session.flush()
+    insert_metadata_associations(db_session, db.sql_statement_metadata_association_table, 'sql_statement_id',
+                                 [(statement.id, statement_metadata_ids)
+                                  for statement, statement_metadata_ids in sql_statements])
+    save_sql_analysis(db_session, sql_string_ids, analysed_sql, unsaved)
+    save_rollups(db_session, 'sqlstatements', [(statement.sql_string_id, statement.datetime, statement.duration,
+                                                statement.metadata_set_id)
+                                               for statement, statement_metadata_ids in sql_statements])
     db_session.commit()
+    mark_sql_analysis_saved(analysed_sql, unsaved)
 
 
-def parse_file_packet(packet):
-    db_session = db.Session()
+def orm_parse_file_packet(packet):
+    db_session = db.session()
                     
     # Get flush metadata
-    metadata_list = get_metadata_list(packet['metadata'], db_session)
+    metadata_ids = get_metadata_ids(packet['metadata'], db_session)
+    metadata_set_id = get_metadata_set_id(db_session, packet['metadata'], metadata_ids)
+    file_accesses = []
     
     for profile in packet['stats']:
-        # Add filename
-        filename = get_or_create(db_session,
-                                 db.FileName,
-                                 filename=profile['filename'])
         # Add file access row
         file_access = db.FileAccess(profile)
-        file_access.filename = filename
-        file_access.metadata_items = metadata_list
+        file_access.file_name_id = get_or_create_id(db_session,
+                                                    db.FileName,
+                                                    filename=profile['filename'])
+        file_access.metadata_set_id = metadata_set_id
         # add to session
         db_session.add(file_access)
+        file_accesses.append(file_access)
 
+    db_session.flush()
+    insert_metadata_associations(db_session, db.file_access_metadata_association_table, 'file_access_id',
+                                 [(access.id, metadata_ids) for access in file_accesses])
+    save_rollups(db_session, 'fileaccesses', [(access.file_name_id, access.datetime, access.duration, metadata_set_id)
+                                              for access in file_accesses])
     db_session.commit()
     
 
-def get_metadata_list(metadata_dictionary, db_session):
-    metadata_list = []
+def get_metadata_ids(metadata_dictionary, db_session):
+    metadata_ids = set()
     for metadata_key in metadata_dictionary.keys():
         # make each value in the dictionary a list, even if only one value
         if not isinstance(metadata_dictionary[metadata_key], list):
             metadata_dictionary[metadata_key] = [metadata_dictionary[metadata_key]]
         for dict_value in metadata_dictionary[metadata_key]:
-            metadata_list.append(get_or_create(db_session,
-                                               db.MetaData,
-                                               key=metadata_key,
-                                               value=dict_value))
-    return list(set(metadata_list))
+            metadata_ids.add(get_or_create_id(db_session,
+                                              db.MetaData,
+                                              key=metadata_key,
+                                              value=dict_value))
+    return sorted(metadata_ids)
+
 
+def get_metadata_set_id(db_session, metadata_dictionary, metadata_ids):
+    metadata_set_hash = db.metadata_set_hash(metadata_pairs(metadata_dictionary))
+    return get_or_create_id(db_session, db.MetadataSet, {'metadata_ids': metadata_ids}, hash=metadata_set_hash)
 
-def get_arg_list(db_session, args):
-    arg_list = []
+
+def insert_metadata_associations(db_session, table, column, rows):
+    """Links stats to their metadata, rows is a list of (stat id, metadata ids) tuples."""
+    bulk_insert(db_session, table, [{column: _id, 'metadata_id': metadata_id}
+                                    for _id, metadata_ids in rows
+                                    for metadata_id in metadata_ids])
+
+
+def get_arg_ids(db_session, args):
+    arg_ids = []
     for arg in args:
-        sql_arg = get_or_create(db_session,
-                                db.SQLArg,
-                                value=arg)
-        arg_list.append(sql_arg)
-    return arg_list
-
-def get_stack_list(db_session, stack):
-    sql_stack_item_list = []
+        arg_ids.append(get_or_create_id(db_session,
+                                        db.SQLArg,
+                                        value=arg))
+    return arg_ids
+
+def get_stack_ids(db_session, stack):
+    sql_stack_item_ids = []
     for stack_item in stack:
-        sql_stack_item = get_or_create(db_session,
-                                       db.SQLStackItem,
-                                       function=stack_item['function'],
-                                       module=stack_item['module'])
-        sql_stack_item_list.append(sql_stack_item)
-    return sql_stack_item_list
-
-def get_or_create(session, model, **kwargs):
-    instance = session.query(model).filter_by(**kwargs).first()
-    if not instance:
-        instance = model(kwargs)
-        session.add(instance)
-    return instance
-
-
-function_stat_handler = StatHandler(parse_fn_packet)
-handler_stat_handler = StatHandler(parse_fn_packet)
-sql_stat_handler = StatHandler(parse_sql_packet)
-file_stat_handler = StatHandler(parse_file_packet)
+        sql_stack_item_ids.append(get_or_create_id(db_session,
+                                                   db.SQLStackItem,
+                                                   function=stack_item['function'],
+                                                   module=stack_item['module']))
+    return sql_stack_item_ids
+
+def get_or_create_id(session, model, extra=None, **kwargs):
+    """
+    The id of the dimension row with the given column values, inserting it (with any
+    extra column values) if there is none. Ids are returned rather than rows so a
+    cached id costs no query, the stats set their foreign key columns to it.
+    """
+    cache_key = dimension_key(model, **kwargs)
+    _id = dimension_cache.get(cache_key)
+    if _id is not None:
+        return _id
+
+    row = session.query(model.id).filter_by(**kwargs).first()
+    if row:
+        _id = row[0]
+    else:
+        values = dict(kwargs, **(extra or {}))
+        instance = model(values)
+        try:
+            # a savepoint, as a concurrent worker may insert the same row first
+            with session.begin_nested():
+                session.add(instance)
+        except sqlalchemy.exc.DBAPIError, ex:
+            # a unique violation, not always wrapped as an IntegrityError
+            row = session.query(model.id).filter_by(**kwargs).first()
+            if row is None:
+                raise ex
+            _id = row[0]
+        else:
+            _id = instance.id
+    pending_cache_entries.add(dimension_cache, cache_key, _id)
+    return _id
+
+
+#========================================#
+# Set based ingestion, a packet at a time
+
+# Rows per INSERT/SELECT statement, keeps statements a sensible size
+# for large packets.
+bulk_chunk_size = 1000
+
+def chunks(items, size=None):
+    size = size or bulk_chunk_size
+    for i in xrange(0, len(items), size):
+        yield items[i:i+size]
+
+
+def bulk_parse_fn_packet(packet):
+    db_session = db.session()
+
+    metadata_ids = bulk_get_metadata_ids(db_session, packet['metadata'])
+    metadata_set_id = bulk_get_metadata_set_id(db_session, packet['metadata'], metadata_ids)
+
+    for profile in packet['stats']:
+        if 'profile' in profile:
+            store_profile(profile, packet.get('retry'))
+
+    name_ids = bulk_get_or_create_ids(db_session,
+                                      db.CallStackName,
+                                      ('module_name', 'class_name', 'fn_name'),
+                                      [(profile['module'], profile['class'], profile['function'])
+                                       for profile in packet['stats']])
+
+    call_stack_ids = reserve_ids(db_session, db.CallStack, len(packet['stats']))
+    call_stack_rows = []
+    metadata_rows = []
+    for call_stack_id, profile in zip(call_stack_ids, packet['stats']):
+        call_stack_rows.append({'id': call_stack_id,
+                                'call_stack_name_id': name_ids[(profile['module'], profile['class'], profile['function'])],
+                                'datetime': profile['datetime'],
+                                'duration': profile['duration'],
+                                'pstat_uuid': profile['pstat_uuid'],
+                                'metadata_set_id': metadata_set_id})
+        metadata_rows += [{'call_stack_id': call_stack_id, 'metadata_id': metadata_id}
+                          for metadata_id in metadata_ids]
+
+    bulk_insert(db_session, db.CallStack.__table__, call_stack_rows)
+    bulk_insert(db_session, db.call_stack_metadata_association_table, metadata_rows)
+    save_rollups(db_session, 'callstacks', [(row['call_stack_name_id'], row['datetime'], row['duration'], metadata_set_id)
+                                            for row in call_stack_rows])
+
+    if explode_profiles:
+        save_function_stats(db_session, [(row['id'], row['call_stack_name_id'], row['datetime'], profile['stats'])
+                                         for row, profile in zip(call_stack_rows, packet['stats'])])
+    if merge_profiles:
+        save_merged_profiles(db_session, [(row['call_stack_name_id'], row['datetime'], row['duration'], profile['stats'])
+                                          for row, profile in zip(call_stack_rows, packet['stats'])])
+    analysed_sql, unsaved = save_repeated_queries(db_session,
+                                                  [(row['id'], row['call_stack_name_id'], row['datetime'],
+                                                    profile.get('sql_repeats', []))
+                                                   for row, profile in zip(call_stack_rows, packet['stats'])],
+                                                  packet.get('analysed_sql'))
+
+    db_session.commit()
+    mark_sql_analysis_saved(analysed_sql, unsaved)
+
+
+def bulk_parse_sql_packet(packet):
+    db_session = db.session()
+    stats = packet['stats']
+
+    global_metadata_ids = bulk_get_metadata_ids(db_session, packet['metadata'])
+
+    # Analyse every SQL string once, then resolve the statement
+    # metadata alongside everything else.
+    analysed_sql, unsaved = get_sql_analysis(db_session, stats, packet.get('analysed_sql'))
+
+    statement_metadata = set()
+    for sql_identifiers, statement_type, fingerprint in analysed_sql.values():
+        statement_metadata.update(('statement_identifiers', identifier) for identifier in sql_identifiers)
+        statement_metadata.add(('statement_type', statement_type))
+    metadata_ids = bulk_get_or_create_ids(db_session, db.MetaData, ('key', 'value'), statement_metadata)
+
+    # every statement of an SQL string shares its metadata, and so its metadata set
+    global_metadata = metadata_pairs(packet['metadata'])
+    sql_metadata = {}
+    for sql, (sql_identifiers, statement_type, fingerprint) in analysed_sql.items():
+        sql_pairs = set(('statement_identifiers', identifier) for identifier in sql_identifiers)
+        sql_pairs.add(('statement_type', statement_type))
+        sql_metadata_ids = set(global_metadata_ids)
+        sql_metadata_ids.update(metadata_ids[pair] for pair in sql_pairs)
+        sql_metadata[sql] = (db.metadata_set_hash(global_metadata | sql_pairs), sql_metadata_ids)
+    metadata_set_ids = bulk_get_metadata_set_ids(db_session, dict(sql_metadata.values()))
+
+    sql_string_ids = bulk_get_or_create_ids(db_session, db.SQLString, ('sql',),
+                                            [(sql,) for sql in analysed_sql])
+    save_sql_analysis(db_session, dict((sql, sql_string_ids[(sql,)]) for sql in unsaved), analysed_sql, unsaved)
+    arg_ids = bulk_get_or_create_ids(db_session, db.SQLArg, ('value',),
+                                     [(arg,) for profile in stats for arg in profile['args']])
+    stack_item_ids = bulk_get_or_create_ids(db_session, db.SQLStackItem, ('module', 'function'),
+                                            [(stack_item['module'], stack_item['function'])
+                                             for profile in stats for stack_item in profile['stack']])
+
+    statement_ids = reserve_ids(db_session, db.SQLStatement, len(stats))
+    statement_rows = []
+    arg_rows = []
+    stack_rows = []
+    metadata_rows = []
+    rollup_stats = []
+    for statement_id, profile in zip(statement_ids, stats):
+        sql = profile['sql_string']
+        metadata_hash, statement_metadata_ids = sql_metadata[sql]
+        statement_rows.append({'id': statement_id,
+                               'sql_string_id': sql_string_ids[(sql,)],
+                               'datetime': profile['datetime'],
+                               'duration': profile['duration'],
+                               'metadata_set_id': metadata_set_ids[metadata_hash]})
+        arg_rows += [{'sql_statement_id': statement_id, 'sql_argument_id': arg_ids[(arg,)], 'index': i}
+                     for i, arg in enumerate(profile['args'])]
+        stack_rows += [{'sql_statement_id': statement_id,
+                        'sql_stack_item_id': stack_item_ids[(stack_item['module'], stack_item['function'])],
+                        'index': i}
+                       for i, stack_item in enumerate(profile['stack'])]
+        metadata_rows += [{'sql_statement_id': statement_id, 'metadata_id': metadata_id}
+                          for metadata_id in statement_metadata_ids]
+        rollup_stats.append((sql_string_ids[(sql,)], profile['datetime'], profile['duration'], metadata_set_ids[metadata_hash]))
+
+    bulk_insert(db_session, db.SQLStatement.__table__, statement_rows)
+    bulk_insert(db_session, db.SQLArgAssociation.__table__, arg_rows)
+    bulk_insert(db_session, db.SQLStackAssociation.__table__, stack_rows)
+    bulk_insert(db_session, db.sql_statement_metadata_association_table, metadata_rows)
+    save_rollups(db_session, 'sqlstatements', rollup_stats)
+
+    db_session.commit()
+    mark_sql_analysis_saved(analysed_sql, unsaved)
+
+
+def bulk_parse_file_packet(packet):
+    db_session = db.session()
+
+    metadata_ids = bulk_get_metadata_ids(db_session, packet['metadata'])
+    metadata_set_id = bulk_get_metadata_set_id(db_session, packet['metadata'], metadata_ids)
+    file_name_ids = bulk_get_or_create_ids(db_session, db.FileName, ('filename',),
+                                           [(profile['filename'],) for profile in packet['stats']])
+
+    file_access_ids = reserve_ids(db_session, db.FileAccess, len(packet['stats']))
+    file_access_rows = []
+    metadata_rows = []
+    for file_access_id, profile in zip(file_access_ids, packet['stats']):
+        file_access_rows.append({'id': file_access_id,
+                                 'file_name_id': file_name_ids[(profile['filename'],)],
+                                 'time_to_open': profile['time_to_open'],
+                                 'datetime': profile['datetime'],
+                                 'duration': profile['duration'],
+                                 'data_written': profile['data_written'],
+                                 'mode': profile['mode'],
+                                 'metadata_set_id': metadata_set_id})
+        metadata_rows += [{'file_access_id': file_access_id, 'metadata_id': metadata_id}
+                          for metadata_id in metadata_ids]
+
+    bulk_insert(db_session, db.FileAccess.__table__, file_access_rows)
+    bulk_insert(db_session, db.file_access_metadata_association_table, metadata_rows)
+    save_rollups(db_session, 'fileaccesses', [(row['file_name_id'], row['datetime'], row['duration'], metadata_set_id)
+                                              for row in file_access_rows])
+
+    db_session.commit()
+
+
+def metadata_pairs(metadata_dictionary):
+    """The set of (key, value) pairs of a metadata dictionary, whose values may be lists."""
+    pairs = set()
+    for metadata_key, values in metadata_dictionary.items():
+        if not isinstance(values, list):
+            values = [values]
+        pairs.update((metadata_key, value) for value in values)
+    return pairs
+
+def bulk_get_metadata_ids(db_session, metadata_dictionary):
+    """Set based version of get_metadata_ids, returns a list of metadata ids."""
+    return list(set(bulk_get_or_create_ids(db_session, db.MetaData, ('key', 'value'),
+                                           metadata_pairs(metadata_dictionary)).values()))
+
+def bulk_get_metadata_set_id(db_session, metadata_dictionary, metadata_ids):
+    """The id of the MetadataSet of a metadata dictionary, whose metadata ids are already resolved."""
+    metadata_hash = db.metadata_set_hash(metadata_pairs(metadata_dictionary))
+    return bulk_get_metadata_set_ids(db_session, {metadata_hash: metadata_ids})[metadata_hash]
+
+def bulk_get_metadata_set_ids(db_session, metadata_sets):
+    """Resolves a dictionary of metadata set hash -> metadata ids to a dictionary of hash -> MetadataSet id."""
+    ids = bulk_get_or_create_ids(db_session, db.MetadataSet, ('hash',), [(metadata_hash,) for metadata_hash in metadata_sets],
+                                 extra=(('metadata_ids',), dict(((metadata_hash,), (sorted(set(metadata_ids)),))
+                                                             for metadata_hash, metadata_ids in metadata_sets.items())))
+    return dict((key[0], _id) for key, _id in ids.items())
+
+
+def bulk_get_or_create_ids(db_session, model, columns, keys, extra=None):
+    """
+    Resolves dimension rows (e.g. metadata, stack items) to their ids, creating any
+    which do not exist yet. Keys are tuples of values ordered as columns. Rows with
+    columns beyond their key take them from extra, a (column names, dictionary of
+    key -> tuple of values) pair.
+
+    Rather than a SELECT (and maybe an INSERT) per key, existing rows are found with
+    one SELECT per chunk, the missing rows are inserted with
+    INSERT ... ON CONFLICT DO NOTHING RETURNING and any rows a concurrent worker
+    inserted under us are picked up with a final SELECT.
+
+    Any ids held in the dimension cache are used without touching the database.
+
+    Returns a dictionary of key -> id.
+    """
+    keys = set(keys)
+    ids = bulk_get_ids(db_session, model, columns, keys)
+
+    # sorted so concurrent workers inserting the same new rows wait on each other
+    # in the same order, rather than deadlock
+    missing = sorted((key for key in keys if key not in ids), key=null_safe_key)
+    table = model.__table__
+    extra_columns, extra_values = extra or ((), {})
+    column_list = ', '.join('"{0}"'.format(column) for column in columns)
+    insert_column_list = ', '.join('"{0}"'.format(column) for column in tuple(columns) + tuple(extra_columns))
+    for chunk in chunks(missing):
+        values = []
+        params = {}
+        for i, key in enumerate(chunk):
+            row = tuple(key) + tuple(extra_values.get(key, ()))
+            names = ['v{0}_{1}'.format(i, j) for j in xrange(len(row))]
+            values.append('({0})'.format(', '.join(':' + name for name in names)))
+            params.update(zip(names, row))
+        statement = sqlalchemy.text('INSERT INTO {0} ({1}) VALUES {2} ON CONFLICT DO NOTHING RETURNING id, {3}'.format(
+                                        table.name, insert_column_list, ', '.join(values), column_list))
+        for row in db_session.execute(statement, params):
+            ids[tuple(row[1:])] = row[0]
+            pending_cache_entries.add(dimension_cache, dimension_key(model, **dict(zip(columns, row[1:]))), row[0])
+
+    missing = [key for key in keys if key not in ids]
+    if missing:
+        ids.update(select_dimension_ids(db_session, model, columns, missing))
+    return ids
+
+
+def bulk_get_ids(db_session, model, columns, keys):
+    """
+    The ids of the dimension rows which already exist, from the dimension cache or
+    else the database. Returns a dictionary of key -> id, without the keys not found.
+    """
+    keys = set(keys)
+    ids = {}
+    for key in keys:
+        _id = dimension_cache.get(dimension_key(model, **dict(zip(columns, key))))
+        if _id is not None:
+            ids[key] = _id
+
+    missing = [key for key in keys if key not in ids]
+    ids.update(select_dimension_ids(db_session, model, columns, missing))
+    return ids
+
+
+def null_safe_key(key):
+    """A sort key for dimension keys which may hold NULLs, NULLs first."""
+    return tuple((value is not None, value) for value in key)
+
+
+def select_dimension_ids(db_session, model, columns, keys):
+    """Bulk SELECT of dimension ids by key, a chunk of keys per query."""
+    ids = {}
+    model_columns = [getattr(model, column) for column in columns]
+    for chunk in chunks(list(keys)):
+        if len(model_columns) == 1:
+            clause = model_columns[0].in_([key[0] for key in chunk if key[0] is not None])
+            if any(key[0] is None for key in chunk):
+                clause = or_(clause, model_columns[0] == None)
+        else:
+            # tuple IN can't match NULLs, so keys containing one are matched explicitly.
+            clauses = [and_(*[column == value for column, value in zip(model_columns, key)])
+                       for key in chunk if None in key]
+            not_null_keys = [key for key in chunk if None not in key]
+            if not_null_keys:
+                clauses.append(tuple_(*model_columns).in_(not_null_keys))
+            clause = or_(*clauses)
+        for row in db_session.query(model.id, *model_columns).filter(clause):
+            ids[tuple(row[1:])] = row[0]
+            # may be a row this transaction inserted
+            pending_cache_entries.add(dimension_cache, dimension_key(model, **dict(zip(columns, row[1:]))), row[0])
+    return ids
+
+
+def lock_rows(db_session, table, key_columns, keys, defaults):
+    """
+    Makes sure a row exists for each key (inserting it with the default values if not)
+    and locks the rows with SELECT ... FOR UPDATE for a read-modify-write, so concurrent
+    workers updating the same rows queue up rather than overwrite one another. Rows are
+    locked in key order to avoid deadlocks.
+
+    Returns a dictionary of key -> row.
+    """
+    keys = sorted(set(keys))
+    column_list = ', '.join('"{0}"'.format(column) for column in list(key_columns) + sorted(defaults))
+    for chunk in chunks(keys):
+        values = []
+        params = {}
+        for i, key in enumerate(chunk):
+            names = ['k{0}_{1}'.format(i, j) for j in xrange(len(key_columns))]
+            params.update(zip(names, key))
+            values.append('({0})'.format(', '.join([':' + name for name in names] +
+                                                   [':' + column for column in sorted(defaults)])))
+        params.update(defaults)
+        # typed so defaults such as binary data are bound correctly
+        default_params = [sqlalchemy.bindparam(column, type_=table.c[column].type) for column in defaults]
+        db_session.execute(sqlalchemy.text('INSERT INTO {0} ({1}) VALUES {2} ON CONFLICT DO NOTHING'.format(
+                               table.name, column_list, ', '.join(values)), bindparams=default_params), params)
+
+    rows = {}
+    columns = [table.c[column] for column in key_columns]
+    for chunk in chunks(keys):
+        query = sqlalchemy.select([table], tuple_(*columns).in_(chunk), order_by=columns, for_update=True)
+        for row in db_session.execute(query):
+            rows[tuple(row[column] for column in key_columns)] = row
+    return rows
+
+
+def reserve_ids(db_session, model, count):
+    """Takes count ids from the table's sequence so rows can be inserted with known ids."""
+    if count == 0:
+        return []
+    statement = sqlalchemy.text("SELECT nextval('{0}_id_seq') FROM generate_series(1, :count)".format(
+                                    model.__tablename__))
+    return [row[0] for row in db_session.execute(statement, {'count': count})]
+
+
+def bulk_insert(db_session, table, rows):
+    """Multi-row INSERTs of plain dictionaries, a chunk of rows per statement."""
+    for chunk in chunks(rows):
+        db_session.execute(table.insert().values(chunk))
+
+
+parse_functions = {'function': parse_fn_packet,
+                   'handler': parse_fn_packet,
+                   'database': parse_sql_packet,
+                   'file': parse_file_packet}
+
+function_stat_handler = StatHandler('function')
+handler_stat_handler = StatHandler('handler')
+sql_stat_handler = StatHandler('database')
+file_stat_handler = StatHandler('file')
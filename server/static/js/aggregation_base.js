@@ -1,5 +1,6 @@
 var oTable,
-	numBars = 6;
+	numBars = 6,
+	anomalous = {};
 
 function trunc(string, numChars) {
 	return string.length > numChars ? string.substring(0, numChars - 3) + '...' : string;
@@ -58,6 +59,37 @@ function draw_bar_graphs(kwargs) {
 	});
 }
 
+function mark_anomalous_row(nRow, id) {
+	if (id in anomalous)
+		$(nRow).addClass('anomalous').attr('title', anomalous[id]);
+}
+
+function load_anomalies(data) {
+	var list = $('#anomalies ul');
+	list.empty();
+	anomalous = {};
+
+	$.each(data, function(i, anomaly) {
+		var change = anomaly.kind == 'latency' ?
+				'average ' + anomaly.value.toFixed(5) + 's, usually ' + anomaly.baseline.toFixed(5) + 's' :
+				Math.round(anomaly.value) + ' calls/hour, usually ' + Math.round(anomaly.baseline),
+			description = anomaly.kind + ' ' + change + ' (score ' + anomaly.score.toFixed(1) + ')';
+
+		if (!(anomaly.name_id in anomalous))
+			anomalous[anomaly.name_id] = description;
+		list.append($('<li></li>')
+			.append($('<a></a>').attr('href', '/' + url_name + '/' + anomaly.name_id)
+				.text(trunc((anomaly.name || String(anomaly.name_id)).replace('\n', ''), 80)))
+			.append(' ' + description + ', ' + new Date(anomaly.window_end * 1000).toLocaleString()));
+	});
+	$('#anomalies').toggle(data.length > 0);
+
+	// mark any rows already drawn
+	$.each(oTable.fnGetNodes(), function(i, nRow) {
+		mark_anomalous_row(nRow, oTable.fnGetData(nRow)[0]);
+	});
+}
+
 $(document).ready(function() {
 	oTable = $('#main').dataTable({
 			"bServerSide": true,
@@ -78,6 +110,10 @@ $(document).ready(function() {
 				{ "asSorting": [ "desc", "asc" ] },
 				{ "asSorting": [ "desc", "asc" ] },
 				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
+				{ "asSorting": [ "desc", "asc" ] },
 				{ "asSorting": [ "desc", "asc" ] }
 			],
 
@@ -87,10 +123,12 @@ $(document).ready(function() {
 					window.location.href = '/' + url_name + '/' + aData[0] + '?' + $.param(kwargs);
 				});
 				$('td:eq(0)', nRow).text(trunc(aData[1], 100));
+				mark_anomalous_row(nRow, aData[0]);
 			}
 	});
 	
 	$('#tabs').tabs();
+	$.getJSON('/api/anomalies/' + url_name, load_anomalies);
 	$('#filters').on('load change', function(e, kwargs) {
 		oTable.fnSettings().sAjaxSource = '/api/' + url_name + '?datatables=true&' + $.param(kwargs);
 		oTable.fnDraw();
@@ -1,46 +1,88 @@
-function draw(data){
+// the filters picked in the side bar, and those plus the window zoomed into
+var filter_kwargs = {},
+	graph_kwargs = {};
+
+function draw(data, resolution){
+	// without a resolution each datum is a call [duration, datetime, id], otherwise
+	// a bucket of calls [avg, midpoint, id (of a lone call), min, max, count]
 	var height = 400,
 		width = $('.item_container').width(),
 		margins = {'x': 50, 'y': 80};
 
 	$('#function_graph svg').remove();
 
-	d3.select('#function_graph')
+	var svg = d3.select('#function_graph')
 		.append('svg')
-		.attr('width', width).attr('height', height)
-		.selectAll('circle')
-		.data(data)
-		.enter()
-		.append('circle')
+		.attr('width', width).attr('height', height);
 
 	var x_extent = d3.extent(data, function(d){ return d[1] * 1000; });
+	if (resolution)
+		x_extent = [x_extent[0] - resolution * 500, x_extent[1] + resolution * 500];
 	var x_scale = d3.time.scale().range([margins['y'], width - 10]).domain(x_extent);
 
-	var y_extent = d3.extent(data, function(d){ return d[0]; });
+	var y_extent = [d3.min(data, function(d){ return resolution ? d[3] : d[0]; }),
+					d3.max(data, function(d){ return resolution ? d[4] : d[0]; })];
 	var y_scale = d3.scale.linear().range([height - margins['x'], margins['x']]).domain(y_extent);
 
-	d3.selectAll('circle')
-		.attr('cx', function(d){ return x_scale(d[1] * 1000); })
-		.attr('cy', function(d){ return y_scale(d[0]); })
-		.attr('r', 5)
-		.attr('class', 'datum')
-		.attr('data-id', function(d){ return d[2]; });
+	// drag over the graph to zoom into a window
+	var brush = d3.svg.brush()
+		.x(x_scale)
+		.on('brushend', function(){
+			if (!brush.empty()) {
+				var extent = brush.extent();
+				zoom(extent[0] / 1000, extent[1] / 1000);
+			}
+		});
+	svg.append('g')
+		.attr('class', 'brush')
+		.call(brush)
+		.selectAll('rect')
+			.attr('y', margins['x'])
+			.attr('height', height - 2 * margins['x']);
+
+	if (resolution) {
+		// the range of durations in each bucket
+		svg.selectAll('line.range')
+			.data(data)
+			.enter()
+			.append('line')
+			.attr('class', 'range')
+			.attr('x1', function(d){ return x_scale(d[1] * 1000); })
+			.attr('x2', function(d){ return x_scale(d[1] * 1000); })
+			.attr('y1', function(d){ return y_scale(d[3]); })
+			.attr('y2', function(d){ return y_scale(d[4]); });
+	}
 
 	var line = d3.svg.line()
 		 .x(function(d){ return x_scale(d[1] * 1000); })
 		 .y(function(d){ return y_scale(d[0]); });
 
-	d3.select('svg').append('path').attr('d', line(data));
+	svg.append('path').attr('d', line(data));
+
+	svg.selectAll('circle')
+		.data(data)
+		.enter()
+		.append('circle')
+		.attr('cx', function(d){ return x_scale(d[1] * 1000); })
+		.attr('cy', function(d){ return y_scale(d[0]); })
+		.attr('r', 5)
+		.attr('class', function(d){ return d[2] == null ? 'datum bucket' : 'datum'; })
+		.on('click', function(d){
+			if (d[2] != null)
+				window.location.href = '/tables/' + url_name + '/' + d[2];
+			else
+				zoom(d[1] - resolution / 2, d[1] + resolution / 2);
+		})
+		.append('title')
+			.text(function(d){ return resolution ? d[5] + ' calls, avg ' + d[0] + ' (' + d[3] + ' - ' + d[4] + ')' : d[0]; });
 
 	var x_axis = d3.svg.axis().scale(x_scale);
-	d3.select('svg')
-		.append('g')
+	svg.append('g')
 		.attr('class','x axis')
 		.attr('transform', 'translate(0,' + (height - margins['x']) + ')')
 		.call(x_axis);
 		
-	d3.select('svg')
-		.append("text")
+	svg.append("text")
 			.attr("class", "x label")
 			.attr("text-anchor", "middle")
 			.attr("x", width / 2)
@@ -48,24 +90,17 @@ function draw(data){
 		.text("Time");
 
 	var y_axis = d3.svg.axis().scale(y_scale).orient('left');
-	d3.select('svg')
-		.append('g')
+	svg.append('g')
 			.attr('class', 'y axis')
 			.attr('transform', 'translate(' + margins['y'] + ', 0)')
 		.call(y_axis);
 		
-	d3.select('svg')
-		.append("text")
+	svg.append("text")
 			.attr("class", "y label")
 			.attr("x", height / 2)
 			.attr("y", 0)
 			.attr("transform", "rotate(90)")
 		.text("Duration (secs)");
-
-	//mouseover points
-	$('.datum').click(function(){
-		window.location.href = '/tables/' + url_name + '/' + $(this).attr('data-id');
-	});
 }
 
 function load_stats(data) {
@@ -76,32 +111,52 @@ function load_stats(data) {
 		$('.stat_avg').text(item[4]);
 		$('.stat_min').text(item[5]);
 		$('.stat_max').text(item[6]);
+		$('.stat_p50').text(item[7]);
+		$('.stat_p90').text(item[8]);
+		$('.stat_p95').text(item[9]);
+		$('.stat_p99').text(item[10]);
 
-		draw(item[7]);
+		draw(item[11], item[12]);
 	}
 }
 
+function fetch_graph(kwargs) {
+	graph_kwargs = kwargs;
+	$('#reset_zoom').toggle(kwargs !== filter_kwargs);
+	$.getJSON('/api/' + url_name + '/' + item_id + '?', kwargs, load_stats);
+}
+
+function zoom(start_date, end_date) {
+	fetch_graph($.extend({}, graph_kwargs, {'start_date': start_date, 'end_date': end_date}));
+}
+
 function filter_graph(e) {
 	var start_date = new Date($('#filter_from').val()) / 1000,
 		end_date = new Date($('#filter_to').val()) / 1000;
 
-	var date_limit = '';
+	var date_limit = {};
 	if (start_date)
-		date_limit += 'start_date=' + start_date + '&';
+		date_limit['start_date'] = start_date;
 	if (end_date)
-		date_limit += 'end_date=' + end_date + '&';
+		date_limit['end_date'] = end_date;
 
-	$.getJSON('/api/' + url_name + '/' + item_id + '?' + date_limit, load_stats, noDataError);
+	filter_kwargs = $.extend({}, filter_kwargs, date_limit);
+	fetch_graph(filter_kwargs);
 }
 
 function load_graph(e, kwargs) {
-	$.getJSON('/api/' + url_name + '/' + item_id + '?', kwargs, load_stats);
+	filter_kwargs = kwargs || {};
+	fetch_graph(filter_kwargs);
 }
 
 $(document).ready(function(){
 	$.datepicker.formatDate('@');
 	$('#filter_from').datepicker().change(filter_graph);
 	$('#filter_to').datepicker().change(filter_graph);
+	$('#reset_zoom').hide().click(function(e){
+		e.preventDefault();
+		fetch_graph(filter_kwargs);
+	});
 
 	$('#filters').on('load change', load_graph);
 });
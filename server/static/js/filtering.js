@@ -9,10 +9,11 @@ function filter_key() {
 		var loader = $('.loader');
 		loader.show();
 
-		$.getJSON('/tables/api/metadata', {key: filter_key}, function(data) {
+		// only the values found under the filters already picked, with how many stats have each
+		$.getJSON('/api/facets/' + url_name, $.extend({key: filter_key}, kwargs), function(data) {
 			// Insert the new options from the array
-			$.each(data, function(value) { // Use $.each over the built in forEach so we don't have to deal with problems with null values, it'll just gloss over that for us :)
-				val_select.append($("<option />").val(data[value]).text(data[value]));
+			$.each(data, function(i, facet) {
+				val_select.append($("<option />").val(facet[0]).text(facet[0] + ' (' + facet[1] + ')'));
 			});
 
 			loader.hide();
@@ -0,0 +1,151 @@
+// Draws folded stacks ("a;b;c microseconds" lines) as a flame graph, the roots along the
+// bottom and each function's callees stacked above it, as wide as their share of the time.
+// Only frames at least a pixel wide are drawn, so large profiles stay quick to redraw.
+var flame_graph = {root: null, zoomed: null, row_height: 16, min_width: 1, request: 0};
+
+function parse_folded(text){
+	var root = {name: 'all', total: 0, children: {}, parent: null};
+	$.each(text.split('\n'), function(i, line){
+		var split = line.lastIndexOf(' '),
+			value = +line.slice(split + 1);
+		if (split < 1 || !value)
+			return;
+		var node = root;
+		root.total += value;
+		$.each(line.slice(0, split).split(';'), function(j, name){
+			var child = node.children[name];
+			if (!child)
+				child = node.children[name] = {name: name, total: 0, children: {}, parent: node};
+			child.total += value;
+			node = child;
+		});
+	});
+	layout_frames(root, 0, 0);
+	return root;
+}
+
+function layout_frames(node, x, depth){
+	// children in name order, so the same functions line up between redraws
+	node.x = x;
+	node.depth = depth;
+	node.children = d3.values(node.children).sort(function(a, b){ return d3.ascending(a.name, b.name); });
+	$.each(node.children, function(i, child){
+		layout_frames(child, x, depth + 1);
+		x += child.total;
+	});
+}
+
+function frame_colour(name){
+	// a warm colour from the function's name, so it is the same wherever it appears
+	var hash = 0;
+	for (var i = 0; i < name.length; i++)
+		hash = (hash * 31 + name.charCodeAt(i)) % 1000;
+	return d3.hsl(10 + hash % 45, 0.75, 0.55 + (hash % 7) / 50).toString();
+}
+
+function visible_frames(width){
+	// the zoomed frame's ancestors span the whole width, its callees are scaled to fit
+	var zoomed = flame_graph.zoomed,
+		scale = width / zoomed.total,
+		frames = [],
+		node;
+	for (node = zoomed; node; node = node.parent)
+		frames.push({node: node, x: 0, width: width});
+
+	function add_callees(node){
+		$.each(node.children, function(i, child){
+			var frame_width = child.total * scale;
+			if (frame_width < flame_graph.min_width)
+				return;
+			frames.push({node: child, x: (child.x - zoomed.x) * scale, width: frame_width});
+			add_callees(child);
+		});
+	}
+	add_callees(zoomed);
+	return frames;
+}
+
+function draw_flame_graph(){
+	var root = flame_graph.root,
+		width = $('#flame_graph').width(),
+		frames = visible_frames(width),
+		max_depth = d3.max(frames, function(frame){ return frame.node.depth; }),
+		row_height = flame_graph.row_height,
+		height = (max_depth + 1) * row_height;
+
+	$('#flame_graph svg').remove();
+	var svg = d3.select('#flame_graph')
+		.append('svg')
+		.attr('width', width).attr('height', height);
+
+	var frame = svg.selectAll('g.frame')
+		.data(frames)
+		.enter()
+		.append('g')
+		.attr('class', 'frame')
+		.attr('transform', function(d){ return 'translate(' + d.x + ',' + (height - (d.node.depth + 1) * row_height) + ')'; })
+		.on('click', function(d){
+			flame_graph.zoomed = d.node;
+			draw_flame_graph();
+		});
+
+	frame.append('rect')
+		.attr('width', function(d){ return d.width; })
+		.attr('height', row_height - 1)
+		.attr('fill', function(d){ return d.node.parent ? frame_colour(d.node.name) : '#ddd'; });
+
+	frame.append('title')
+		.text(function(d){
+			return d.node.name + ' (' + (d.node.total / 1000).toFixed(3) + 'ms, ' +
+				(100 * d.node.total / root.total).toFixed(2) + '%)';
+		});
+
+	// labels cut to the characters which fit, about 7px each
+	frame.filter(function(d){ return d.width > 35; })
+		.append('text')
+		.attr('x', 3)
+		.attr('y', row_height - 4)
+		.text(function(d){
+			var fits = Math.floor((d.width - 6) / 7);
+			return d.node.name.length > fits ? d.node.name.slice(0, fits - 2) + '..' : d.node.name;
+		});
+
+	$('#flame_graph_zoomed').text(flame_graph.zoomed.parent ? flame_graph.zoomed.name : '');
+	$('#reset_flame_graph').toggle(flame_graph.zoomed != root);
+}
+
+function load_flame_graph(url, kwargs){
+	// only the latest request is drawn, filters may change again before it returns
+	var request = ++flame_graph.request;
+	$('.loader').show();
+	$('#flame_graph_error').hide();
+	$.ajax({url: url, data: kwargs, dataType: 'text'})
+		.done(function(text){
+			if (request != flame_graph.request)
+				return;
+			flame_graph.root = flame_graph.zoomed = parse_folded(text);
+			if (flame_graph.root.total) {
+				draw_flame_graph();
+			} else {
+				$('#flame_graph svg').remove();
+				$('#flame_graph_error').text('No time was recorded in these profiles.').show();
+			}
+		})
+		.fail(function(){
+			if (request != flame_graph.request)
+				return;
+			$('#flame_graph svg').remove();
+			$('#flame_graph_error').text('No profiles were found.').show();
+		})
+		.always(function(){
+			$('.loader').hide();
+		});
+}
+
+$(document).ready(function(){
+	$('#reset_flame_graph').click(function(e){
+		e.preventDefault();
+		flame_graph.zoomed = flame_graph.root;
+		draw_flame_graph();
+	});
+});
@@ -2,15 +2,22 @@ import ConfigParser
 import cherrypy
 import sys
 import database as db
+import pstat_store
+import call_graph_cache
 import os
 import mako.template
 
+import json_ui
 from json_ui import JSONAPI
 from table_ui import Tables
+import aggregate_json_ui
 from aggregate_json_ui import AggregateAPI
 from aggregate_table_ui import AggregatePages
 
-from stat_handlers import function_stat_handler, handler_stat_handler, sql_stat_handler, file_stat_handler
+import stat_handlers
+import retention
+import anomalies
+from stat_handlers import function_stat_handler, handler_stat_handler, sql_stat_handler, file_stat_handler, MetricsAPI
 
 
 # add gzip to allowed content types for decompressing JSON if compressed.
@@ -49,12 +56,16 @@ def start_cherrypy(host, port):
     cherrypy.tree.mount(handler_stat_handler,  '/handler',    method_dispatch_cfg )
     cherrypy.tree.mount(sql_stat_handler,      '/database',   method_dispatch_cfg )
     cherrypy.tree.mount(file_stat_handler,     '/file',       method_dispatch_cfg )
+    cherrypy.tree.mount(MetricsAPI(),          '/metrics')
 
     cherrypy.tree.mount(Tables(),              '/tables')
     cherrypy.tree.mount(JSONAPI(),             '/tables/api')
     cherrypy.tree.mount(AggregatePages(),      '/',           front_end_config)
     cherrypy.tree.mount(AggregateAPI(),        '/api')
 
+    retention.subscribe()
+    anomalies.subscribe()
+
     # Attach the signal handlers to detect keyboard interrupt
     if hasattr(cherrypy.engine, 'signal_handler'):
         cherrypy.engine.signal_handler.subscribe()
@@ -94,6 +105,14 @@ if __name__ == '__main__':
         # Ensure we have a pstats directory to write into.
         if not os.path.exists('pstats'):
             os.makedirs('pstats')
+        pstat_store.setup('pstats', int(cfg.get('pstats_segment_size_mb', 256)) * 1024 * 1024)
+        # after the pstat store, the ingest process pool forks with it
+        stat_handlers.setup(cfg)
+        retention.setup(cfg)
+        anomalies.setup(cfg)
+        aggregate_json_ui.setup(cfg)
+        json_ui.setup(cfg)
+        call_graph_cache.setup(cfg)
 
         start_cherrypy(cfg['server_host'], cfg['server_port'])
     except Exception, ex:
@@ -23,6 +23,21 @@ class Tables(object):
 
         return mytemplate.render(call_stack=call_stack, metadata_id=metadata_id, encoded_kwargs=urlencode(kwargs))
 
+    @cherrypy.expose
+    def flamegraph(self, id, **kwargs):
+        call_stack = db.session.query(db.CallStack).get(id)
+
+        if call_stack == None:
+            raise cherrypy.HTTPError(404)
+
+        breadcrumbs = [('/callstacks', 'Aggregation'),
+                       ('/callstacks/{0}'.format(call_stack.name.id), 'Aggregation Item'),
+                       ('/tables/callstacks/{0}'.format(call_stack.id), 'Call Stack')]
+        mytemplate = Template(filename=os.path.join(self.templates_dir,'flamegraph.html'), lookup=self.template_lookup)
+
+        return mytemplate.render(call_stack_name=str(call_stack.name.full_name), breadcrumbs=breadcrumbs, kwargs={},
+                                 data_url='/tables/api/flamegraph/{0}'.format(call_stack.id), filtered=False)
+
     @cherrypy.expose
     def sqlstatements(self, id, **kwargs):
         sql_statement = db.session.query(db.SQLStatement).get(id)
@@ -0,0 +1,105 @@
+import cProfile
+import pstats
+import unittest
+
+import analyse_stats
+import pstat_store
+
+
+MAIN, WORK, TINY = 'app.py::1::main', 'app.py::5::work', 'app.py::9::tiny'
+
+def example_graph():
+    """main (1s) calls work (0.9s) twice and tiny (0.001s) once."""
+    return {'total_tt': 1.0,
+            'stats': {MAIN: [1, 1, 0.099, 1.0, {}],
+                      WORK: [2, 2, 0.9, 0.9, {MAIN: [2, 2, 0.9, 0.9]}],
+                      TINY: [1, 1, 0.001, 0.001, {MAIN: [1, 1, 0.001, 0.001]}]},
+            'callees': {MAIN: {WORK: [2, 2, 0.9, 0.9], TINY: [1, 1, 0.001, 0.001]}}}
+
+def leaf(n):
+    return sum(xrange(n))
+
+def handler():
+    return [leaf(10000) for i in xrange(10)]
+
+
+class PruneCallGraphTest(unittest.TestCase):
+
+    def test_unpruned(self):
+        pruned = analyse_stats.prune_call_graph(example_graph())
+        self.assertEqual(pruned['roots'], [MAIN])
+        self.assertEqual(set(pruned['stats']), set([MAIN, WORK, TINY]))
+        self.assertEqual(pruned['omitted'], {})
+        self.assertEqual(pruned['truncated'], {})
+
+    def test_threshold(self):
+        pruned = analyse_stats.prune_call_graph(example_graph(), threshold=1)
+        self.assertEqual(set(pruned['stats']), set([MAIN, WORK]))
+        self.assertEqual(pruned['callees'][MAIN].keys(), [WORK])
+        self.assertEqual(pruned['omitted'], {MAIN: 1})
+
+    def test_top(self):
+        pruned = analyse_stats.prune_call_graph(example_graph(), top=1, sort='tottime')
+        self.assertEqual(pruned['callees'][MAIN].keys(), [WORK])
+        self.assertEqual(pruned['omitted'], {MAIN: 1})
+
+    def test_depth(self):
+        pruned = analyse_stats.prune_call_graph(example_graph(), depth=1)
+        self.assertEqual(pruned['stats'].keys(), [MAIN])
+        self.assertEqual(pruned['truncated'], {MAIN: 2})
+
+    def test_root(self):
+        pruned = analyse_stats.prune_call_graph(example_graph(), root=MAIN)
+        self.assertEqual(sorted(pruned['roots']), [WORK, TINY])
+        self.assertEqual(set(pruned['stats']), set([WORK, TINY]))
+        # callers narrowed to those kept, and root
+        self.assertEqual(pruned['stats'][WORK][4].keys(), [MAIN])
+
+    def test_leaves_graph_alone(self):
+        graph = example_graph()
+        analyse_stats.prune_call_graph(graph, threshold=1)
+        self.assertEqual(graph, example_graph())
+
+
+class FoldedStacksTest(unittest.TestCase):
+
+    def folded(self, graph, **kwargs):
+        lines = analyse_stats.folded_stacks(graph, **kwargs).split('\n')
+        return dict((line.rsplit(' ', 1)[0], int(line.rsplit(' ', 1)[1])) for line in lines)
+
+    def test_paths(self):
+        self.assertEqual(self.folded(example_graph()),
+                         {'main (app.py:1)': 99000,
+                          'main (app.py:1);work (app.py:5)': 900000,
+                          'main (app.py:1);tiny (app.py:9)': 1000})
+
+    def test_min_fraction(self):
+        # tiny's time is counted as main's own
+        self.assertEqual(self.folded(example_graph(), min_fraction=0.01),
+                         {'main (app.py:1)': 100000,
+                          'main (app.py:1);work (app.py:5)': 900000})
+
+    def test_max_depth(self):
+        self.assertEqual(self.folded(example_graph(), max_depth=1), {'main (app.py:1)': 1000000})
+
+    def test_recursion(self):
+        graph = {'total_tt': 1.0,
+                 'stats': {MAIN: [3, 1, 1.0, 1.0, {MAIN: [2, 0, 0.6, 0.6]}]},
+                 'callees': {MAIN: {MAIN: [2, 0, 0.6, 0.6]}}}
+        self.assertEqual(self.folded(graph), {'main (app.py:1)': 1000000})
+
+    def test_profile(self):
+        profile = cProfile.Profile()
+        profile.runcall(handler)
+        profile.create_stats()
+        graph = analyse_stats.call_graph(pstats.Stats(pstat_store.BogusStats(profile.stats)))
+        stacks = self.folded(graph, min_fraction=0)
+        leaf_stacks = [stack.split(';') for stack in stacks if stack.split(';')[-1].startswith('leaf (')]
+        self.assertTrue(leaf_stacks)
+        # leaf is only ever called from handler
+        for frames in leaf_stacks:
+            self.assertTrue(frames[-2].startswith('handler ('))
+
+
+if __name__ == '__main__':
+    unittest.main()
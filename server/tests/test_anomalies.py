@@ -0,0 +1,32 @@
+import unittest
+
+import anomalies
+
+
+class ScoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.min_spread = anomalies.min_spread
+        anomalies.min_spread = 0.1
+
+    def tearDown(self):
+        anomalies.min_spread = self.min_spread
+
+    def test_scaled_mad(self):
+        self.assertAlmostEqual(anomalies.score(10 + 3 * anomalies.MAD_SCALE, 10, 1), 3)
+        self.assertAlmostEqual(anomalies.score(10 - 2 * anomalies.MAD_SCALE, 10, 1), -2)
+        self.assertEqual(anomalies.score(10, 10, 1), 0)
+
+    def test_min_spread(self):
+        # no deviation at all, the spread is min_spread of the median
+        self.assertAlmostEqual(anomalies.score(12, 10, 0), 2)
+        anomalies.min_spread = 0.5
+        self.assertAlmostEqual(anomalies.score(12, 10, 0), 0.4)
+
+    def test_zero_median(self):
+        self.assertAlmostEqual(anomalies.score(0, 0, 0), 0)
+        self.assertGreater(anomalies.score(1, 0, 0), 1e6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import uuid
+import shutil
+import tempfile
+import unittest
+
+import call_graph_cache
+import pstat_store
+
+
+def example_stats(calls=1):
+    return {('app.py', 1, 'main'): (calls, calls, 0.1 * calls, 1.0 * calls, {}),
+            ('app.py', 5, 'work'): (2 * calls, 2 * calls, 0.9 * calls, 0.9 * calls,
+                                    {('app.py', 1, 'main'): (2 * calls, 2 * calls, 0.9 * calls, 0.9 * calls)})}
+
+
+class CallGraphCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_store = pstat_store.store
+        pstat_store.setup(self.root)
+        self.uuids = [str(uuid.uuid4()) for i in xrange(3)]
+        for calls, profile_uuid in enumerate(self.uuids, 1):
+            pstat_store.store.write(profile_uuid, example_stats(calls))
+
+    def tearDown(self):
+        pstat_store.store = self.old_store
+        shutil.rmtree(self.root)
+
+    def cache(self, disk_size):
+        return call_graph_cache.CallGraphCache(os.path.join(self.root, 'callgraphs'), disk_size=disk_size)
+
+    def test_get_evicts(self):
+        cache = self.cache(1)
+        for profile_uuid in self.uuids:
+            cache.get(profile_uuid)
+        self.assertEqual(cache.uuids(), [])
+
+    def test_build_never_evicts(self):
+        cache = self.cache(1)
+        sizes = [cache.build(profile_uuid) for profile_uuid in self.uuids]
+        self.assertEqual(sorted(cache.uuids()), sorted(self.uuids))
+        self.assertEqual(cache._scan_usage(), sum(sizes))
+        # and a graph built ahead of time is read back as it is
+        self.assertEqual(call_graph_cache.decompress(cache.get(self.uuids[0])),
+                         call_graph_cache.decompress(cache._read(self.uuids[0])))
+
+
+if __name__ == '__main__':
+    unittest.main()
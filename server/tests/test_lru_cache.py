@@ -0,0 +1,62 @@
+import unittest
+
+from lru_cache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # reading a makes b the least recently used
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_set_replaces(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('a', 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_stats(self):
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.get('a')
+        self.assertEqual(cache.get('missing', 'default'), 'default')
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']), (1, 1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_zero_maxsize_disables(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_resize_evicts(self):
+        cache = LRUCache(5)
+        for i in xrange(5):
+            cache.set(i, i)
+        cache.resize(2)
+        self.assertEqual(len(cache), 2)
+        self.assertIn(4, cache)
+        self.assertNotIn(0, cache)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        self.assertNotIn('a', cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
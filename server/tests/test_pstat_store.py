@@ -0,0 +1,105 @@
+import os
+import time
+import uuid
+import shutil
+import marshal
+import tempfile
+import unittest
+
+import pstat_store
+
+
+def example_stats(calls=1):
+    return {('app.py', 1, 'main'): (calls, calls, 0.1 * calls, 1.0 * calls, {}),
+            ('app.py', 5, 'work'): (2 * calls, 2 * calls, 0.9 * calls, 0.9 * calls,
+                                    {('app.py', 1, 'main'): (2 * calls, 2 * calls, 0.9 * calls, 0.9 * calls)})}
+
+
+class PstatStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = pstat_store.PstatStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        uuids = [str(uuid.uuid4()) for i in xrange(3)]
+        for calls, profile_uuid in enumerate(uuids, 1):
+            self.store.write(profile_uuid, example_stats(calls))
+        for calls, profile_uuid in enumerate(uuids, 1):
+            self.assertIn(profile_uuid, self.store)
+            self.assertEqual(self.store.read(profile_uuid), example_stats(calls))
+        self.assertEqual(len(self.store.segments()), 1)
+
+    def test_read_from_another_store(self):
+        # e.g. written by an ingest process, read by the stats server
+        profile_uuid = str(uuid.uuid4())
+        self.store.write(profile_uuid, example_stats())
+        reader = pstat_store.PstatStore(self.root)
+        self.assertEqual(reader.read(profile_uuid), example_stats())
+        self.assertEqual(reader.uuids(), set([profile_uuid]))
+
+    def test_legacy_file(self):
+        profile_uuid = str(uuid.uuid4())
+        with open(os.path.join(self.root, profile_uuid), 'wb') as f:
+            marshal.dump(example_stats(), f)
+        self.assertEqual(self.store.read(profile_uuid), example_stats())
+        self.assertIn(profile_uuid, self.store.uuids())
+
+    def test_missing(self):
+        self.assertNotIn(str(uuid.uuid4()), self.store)
+        self.assertRaises(KeyError, self.store.read, str(uuid.uuid4()))
+
+    def test_segments_roll_over(self):
+        store = pstat_store.PstatStore(self.root, segment_size=1)
+        uuids = [str(uuid.uuid4()) for i in xrange(3)]
+        for profile_uuid in uuids:
+            store.write(profile_uuid, example_stats())
+        segments = store.segments()
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(sum((store.segment_uuids(segment) for segment in segments), []), uuids)
+
+    def test_remove_segment(self):
+        store = pstat_store.PstatStore(self.root, segment_size=1)
+        old_uuid, new_uuid = str(uuid.uuid4()), str(uuid.uuid4())
+        store.write(old_uuid, example_stats())
+        store.write(new_uuid, example_stats())
+        old_segment, current_segment = store.segments()
+        # the segment being appended to is never removed
+        self.assertFalse(store.remove_segment(current_segment))
+        # nor one written to after written_before
+        self.assertFalse(store.remove_segment(old_segment, time.time() - 3600))
+        self.assertTrue(store.remove_segment(old_segment, time.time() + 1))
+        self.assertEqual(store.segments(), [current_segment])
+        self.assertRaises(KeyError, store.read, old_uuid)
+        self.assertEqual(store.read(new_uuid), example_stats())
+        # new segments are not given the removed segment's name
+        store.write(str(uuid.uuid4()), example_stats())
+        self.assertNotIn(old_segment, store.segments())
+
+    def test_rebuild_index(self):
+        profile_uuid = str(uuid.uuid4())
+        self.store.write(profile_uuid, example_stats())
+        segment, = self.store.segments()
+        os.remove(os.path.join(self.store.segment_dir, segment + pstat_store.INDEX_EXTENSION))
+        reader = pstat_store.PstatStore(self.root)
+        self.assertNotIn(profile_uuid, reader)
+        reader.rebuild_index(segment)
+        self.assertEqual(reader.read(profile_uuid), example_stats())
+
+
+class MergeStatsTest(unittest.TestCase):
+
+    def test_merge(self):
+        merged = pstat_store.merge_stats([example_stats(1), example_stats(2)])
+        self.assertEqual(merged, example_stats(3))
+
+    def test_empty(self):
+        self.assertEqual(pstat_store.merge_stats([]), {})
+        self.assertEqual(pstat_store.merge_stats([{}, example_stats()]), example_stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
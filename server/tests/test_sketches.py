@@ -0,0 +1,51 @@
+import unittest
+
+import sketches
+
+
+class LogHistogramTest(unittest.TestCase):
+
+    def assertWithinAccuracy(self, value, expected):
+        self.assertLessEqual(abs(value - expected), expected * sketches.RELATIVE_ACCURACY)
+
+    def test_quantiles(self):
+        histogram = sketches.LogHistogram()
+        for value in xrange(1, 1001):
+            histogram.add(value / 1000.0)
+        self.assertEqual(histogram.count(), 1000)
+        self.assertWithinAccuracy(histogram.quantile(0), 0.001)
+        self.assertWithinAccuracy(histogram.quantile(0.5), 0.5)
+        self.assertWithinAccuracy(histogram.quantile(1), 1.0)
+        for value, expected in zip(histogram.percentiles([90, 99]), [0.9, 0.99]):
+            self.assertWithinAccuracy(value, expected)
+
+    def test_empty(self):
+        self.assertIsNone(sketches.LogHistogram().quantile(0.5))
+        self.assertEqual(sketches.LogHistogram.from_bytes(None).count(), 0)
+
+    def test_zero_duration(self):
+        histogram = sketches.LogHistogram()
+        histogram.add(0)
+        self.assertLessEqual(histogram.quantile(0.5), sketches.MIN_VALUE * sketches.GAMMA)
+
+    def test_merge_matches_single_histogram(self):
+        values = [0.0001 * i ** 2 for i in xrange(1, 500)]
+        whole, first, second = sketches.LogHistogram(), sketches.LogHistogram(), sketches.LogHistogram()
+        for i, value in enumerate(values):
+            whole.add(value)
+            (first if i % 2 else second).add(value)
+        merged = sketches.merge_all([first, second.to_bytes()])
+        self.assertEqual(merged.counts, whole.counts)
+        self.assertEqual(merged.percentiles([50, 95]), whole.percentiles([50, 95]))
+        # merging into a new histogram leaves the inputs alone
+        self.assertEqual(first.count() + second.count(), len(values))
+
+    def test_bytes_round_trip(self):
+        histogram = sketches.LogHistogram()
+        histogram.add(0.25, count=3)
+        histogram.add_bucket(sketches.bucket_index(2.0), 2)
+        self.assertEqual(sketches.LogHistogram.from_bytes(histogram.to_bytes()).counts, histogram.counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
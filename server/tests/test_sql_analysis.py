@@ -0,0 +1,40 @@
+import unittest
+
+import stat_handlers
+
+
+class SQLAnalysisTest(unittest.TestCase):
+
+    def fingerprint(self, sql):
+        return stat_handlers.analyse_sql(sql)[2]
+
+    def test_analyse_sql(self):
+        identifiers, statement_type, fingerprint = stat_handlers.analyse_sql(
+            "SELECT name FROM items WHERE id = 4 AND kind = 'a'")
+        self.assertEqual(identifiers, ['name', 'items', 'id', 'kind'])
+        self.assertEqual(statement_type, 'SELECT')
+        self.assertEqual(fingerprint, 'SELECT name FROM items WHERE id = ? AND kind = ?')
+
+    def test_literals_and_placeholders(self):
+        self.assertEqual(self.fingerprint('SELECT * FROM items WHERE id = 1'),
+                         self.fingerprint('SELECT * FROM items WHERE id = %s'))
+        self.assertEqual(self.fingerprint("UPDATE items SET name = 'x' WHERE id = 2"),
+                         self.fingerprint('UPDATE items SET name = :name WHERE id = :id'))
+
+    def test_whitespace_and_keyword_case(self):
+        self.assertEqual(self.fingerprint('select  *\n  from items where id = 1'),
+                         'SELECT * FROM items WHERE id = ?')
+
+    def test_in_lists(self):
+        self.assertEqual(self.fingerprint('SELECT * FROM items WHERE id IN (1, 2, 3)'),
+                         self.fingerprint('SELECT * FROM items WHERE id IN (%s, %s)'))
+        self.assertEqual(self.fingerprint('SELECT * FROM items WHERE id IN (1, 2, 3)'),
+                         'SELECT * FROM items WHERE id IN (?)')
+
+    def test_different_statements(self):
+        self.assertNotEqual(self.fingerprint('SELECT * FROM items WHERE id = 1'),
+                            self.fingerprint('SELECT * FROM orders WHERE id = 1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
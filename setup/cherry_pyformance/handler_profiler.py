@@ -15,6 +15,7 @@ import copy
 import time
 import cPickle
 import traceback
+import threading
 
 from cherry_pyformance import cfg, get_stat, stat_logger
 
@@ -22,6 +23,22 @@ from cherry_pyformance import cfg, get_stat, stat_logger
 
 handler_stats_buffer = {}
 
+# The handler request being profiled on each thread. While a handler runs, sql_calls
+# holds the SQL statements it has run, grouped by fingerprint and call site, for the
+# SQL profiler to add to.
+in_flight = threading.local()
+
+
+def repeated_queries(sql_calls):
+    """
+    The statements of a request run at least repeat_threshold times from the same
+    call site, likely N+1 query loops, with one of their SQL strings as an example.
+    """
+    threshold = int(cfg['sql'].get('repeat_threshold', 5))
+    return [{'sql': sql, 'call_site': call_site, 'count': count, 'duration': duration}
+            for (fingerprint, call_site), (count, duration, sql) in sql_calls.iteritems()
+            if count >= threshold]
+
 
 #=====================================================#
 
@@ -64,9 +81,17 @@ class StatsTool(cherrypy.Tool):
         # handler calls could be occuring simultaneously during the lifetime of
         # the tool instance.
         handler = cherrypy.serving.request.handler
+        group_sql = cfg['sql'].get('sql_enabled') and int(cfg['sql'].get('repeat_threshold', 5)) > 0
         def wrapper(*args, **kwargs):
-            # profile the handler
-            return handler_stats_buffer[req_id]['profile'].runcall(handler, *args, **kwargs)
+            if group_sql:
+                in_flight.sql_calls = {}
+            try:
+                # profile the handler
+                return handler_stats_buffer[req_id]['profile'].runcall(handler, *args, **kwargs)
+            finally:
+                if group_sql:
+                    handler_stats_buffer[req_id]['sql_calls'] = in_flight.sql_calls
+                    del in_flight.sql_calls
         cherrypy.serving.request.handler = wrapper
 
     def record_stop(self):
@@ -84,6 +109,8 @@ class StatsTool(cherrypy.Tool):
             handler_stats_buffer[req_id]['module'] = _module
             handler_stats_buffer[req_id]['class'] = _class
             handler_stats_buffer[req_id]['function'] = _method
+            handler_stats_buffer[req_id]['sql_repeats'] = repeated_queries(
+                handler_stats_buffer[req_id].pop('sql_calls', {}))
             
             stats = handler_stats_buffer[req_id]['profile']
             stats.create_stats()
@@ -1,10 +1,22 @@
+import os
+import re
+import sys
 import time
 import inspect
 from cherry_pyformance import cfg, stat_logger
+from handler_profiler import in_flight
 
 
 sql_stats_buffer = {}
 
+# frames in these files are skipped when finding the call site of a statement
+package_directory = os.path.dirname(os.path.realpath(__file__))
+library_paths = [path.strip() for path in cfg['sql'].get('library_paths', 'site-packages,dist-packages').split(',')
+                 if path.strip()]
+# co_filename -> (in this package, in a library), worked out once per file so finding
+# the call site of a statement never touches the filesystem
+skipped_files = {}
+
 
 ###============================================================###
 
@@ -136,12 +148,61 @@ class SqliteConnectionFactory(object):
 
 ###============================================================###
 
+literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|(?<!:):\w+")
+in_list_pattern = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+whitespace_pattern = re.compile(r'\s+')
+
+def sql_fingerprint(sql):
+    """
+    A rough normalisation of an SQL string, literals and placeholders replaced by ?,
+    so the statements of a loop share a fingerprint whether or not they bind their
+    arguments. The server fingerprints the SQL properly when it is ingested.
+    """
+    sql = whitespace_pattern.sub(' ', literal_pattern.sub('?', sql)).strip()
+    return in_list_pattern.sub('(?)', sql)
+
+def call_site():
+    """file:line:function of the innermost frame outside this package and the database libraries."""
+    frame = sys._getframe(1)
+    fallback = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        skipped = skipped_files.get(filename)
+        if skipped is None:
+            skipped = skipped_files[filename] = (os.path.realpath(filename).startswith(package_directory),
+                                                 any(path in filename for path in library_paths))
+        in_package, in_library = skipped
+        if not in_package:
+            if fallback is None:
+                fallback = frame
+            if not in_library:
+                break
+        frame = frame.f_back
+    frame = frame or fallback
+    if frame is None:
+        return 'unknown'
+    return '{0}:{1}:{2}'.format(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+def group_sql(sql, duration):
+    """Counts a statement towards its fingerprint and call site in the handler request in flight, if any."""
+    sql_calls = getattr(in_flight, 'sql_calls', None)
+    if sql_calls is None:
+        return
+    key = (sql_fingerprint(sql), call_site())
+    call = sql_calls.get(key)
+    if call is None:
+        sql_calls[key] = [1, duration, sql]
+    else:
+        call[0] += 1
+        call[1] += duration
+
 def profile_sql(action, sql, *args, **kwargs):
     start_time = time.time()
     start_clock = time.clock()
     output = action(sql, *args, **kwargs)
     end_clock = time.clock()
     time_diff = end_clock-start_clock
+    group_sql(sql, time_diff)
     if time_diff > 0:
         stack = inspect.stack()
         for i in range(len(stack)):